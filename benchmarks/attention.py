@@ -0,0 +1,156 @@
+"""Check the batched Attn against the per-dialog, per-position loop it
+replaced, values and gradients, for every attention type, and compare
+their times over a decode of --dec_steps tokens, with the keys projected
+at every step and once by Attn.prepare.
+
+    python benchmarks/attention.py --repeat 5
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import params
+from models.attention_module import Attn
+
+
+def loop_score(attn, query, encoder_output):
+    """The original score of one query against one encoder output."""
+    if attn.method == 'dot':
+        return torch.matmul(encoder_output, query)
+    elif attn.method == 'general':
+        return torch.matmul(attn.attn(encoder_output), query)
+    elif attn.method == 'concat':
+        energy = attn.attn_2(
+            torch.cat((query, attn.attn_1(encoder_output)), 0))
+        return attn.v.matmul(energy)
+
+
+def loop_attn(attn, query, encoder_outputs, tgt_index):
+    """The original loop over batch x positions."""
+    context = []
+    for b in range(encoder_outputs.size(0)):
+        this_len = tgt_index[b] + 1
+        attn_energies = torch.zeros(this_len, device=encoder_outputs.device)
+        for i in range(this_len):
+            attn_energies[i] = loop_score(attn, query[b, :],
+                                          encoder_outputs[b, i])
+        c = F.softmax(attn_energies,
+                      dim=0).matmul(encoder_outputs[b, :this_len, :])
+        context.append(c)
+    return torch.stack(context)
+
+
+def run(fn, attn, query, encoder_outputs, tgt_index):
+    """Contexts and the gradients of a fixed projection of them with respect
+    to the inputs and the parameters."""
+    attn.zero_grad()
+    query = query.detach().requires_grad_()
+    encoder_outputs = encoder_outputs.detach().requires_grad_()
+    context = fn(query, encoder_outputs, tgt_index)
+    weights = torch.linspace(-1, 1, context.numel()).view_as(context)
+    torch.sum(context * weights).backward()
+    grads = [query.grad, encoder_outputs.grad] + [
+        p.grad if p.grad is not None else torch.zeros_like(p)
+        for p in attn.parameters()
+    ]
+    return context.detach(), grads
+
+
+def time_fn(decode, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        decode()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def decode_fn(fn, queries, encoder_outputs, tgt_index):
+    def decode():
+        for query in queries:
+            fn(query, encoder_outputs, tgt_index)
+
+    return decode
+
+
+def prepared_decode_fn(attn, queries, encoder_outputs, tgt_index):
+    def decode():
+        step = attn.prepare(encoder_outputs, tgt_index)
+        for query in queries:
+            step(query)
+
+    return decode
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--batch_size', default=params.batch_size, type=int)
+    parser.add_argument('--n_turns', default=params.max_dialog_len, type=int)
+    parser.add_argument('--dec_steps', default=params.max_dec_steps, type=int)
+    args = parser.parse_args(args)
+
+    torch.manual_seed(params.seed)
+    query_size = params.state_cell_size + 200
+    for method in ('dot', 'general', 'concat'):
+        hidden_size = query_size if method == 'dot' else \
+            params.encoding_cell_size
+        attn = Attn(method, query_size, hidden_size)
+        loop = lambda q, e, t: loop_attn(attn, q, e, t)
+
+        # every target turn, including the first and the last
+        for batch_size, n_turns in ((1, 1), (3, 4), (args.batch_size,
+                                                     args.n_turns)):
+            query = torch.randn(batch_size, query_size)
+            encoder_outputs = torch.randn(batch_size, n_turns, hidden_size)
+            tgt_index = torch.arange(batch_size) % n_turns
+            expected, expected_grads = run(loop, attn, query, encoder_outputs,
+                                           tgt_index)
+            actual, actual_grads = run(attn, attn, query, encoder_outputs,
+                                       tgt_index)
+            assert torch.allclose(actual, expected, rtol=1e-5, atol=1e-5), \
+                "contexts differ by %g" % (actual - expected).abs().max()
+            # summed over the batch and turns, so some of the gradients are
+            # large and only agree relative to their scale
+            for a, e in zip(actual_grads, expected_grads):
+                scale = float(e.abs().max())
+                atol = max(1e-4, 1e-5 * scale)
+                assert torch.allclose(a, e, rtol=1e-4, atol=atol), \
+                    "gradients differ by %g of up to %g" % (
+                        (a - e).abs().max(), scale)
+            print("%s, batch %d x %d turns: contexts and gradients match" %
+                  (method, batch_size, n_turns))
+
+        # the steps of one decode share the prepared keys
+        queries = torch.randn(args.dec_steps, args.batch_size, query_size)
+        step = attn.prepare(encoder_outputs, tgt_index)
+        for query in queries[:3]:
+            assert torch.equal(step(query),
+                               attn(query, encoder_outputs, tgt_index))
+
+        with torch.no_grad():
+            loop_time = time_fn(
+                decode_fn(loop, queries, encoder_outputs, tgt_index),
+                args.repeat)
+            vec_time = time_fn(
+                decode_fn(attn, queries, encoder_outputs, tgt_index),
+                args.repeat)
+            prepared_time = time_fn(
+                prepared_decode_fn(attn, queries, encoder_outputs,
+                                   tgt_index), args.repeat)
+        print("%s, %d decode steps: loop %.4fs, batched %.4fs (%.0fx), "
+              "prepared %.4fs (%.0fx)" %
+              (method, args.dec_steps, loop_time, vec_time,
+               loop_time / vec_time, prepared_time,
+               loop_time / prepared_time))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,63 @@
+"""Train LinearVRNN for a few steps in fp32 and under bf16 autocast on the
+same synthetic batches and compare the ELBO curves and step times.
+
+    python benchmarks/bf16_elbo.py --steps 30
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+from torch import optim
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import params
+from models.linear_vrnn import LinearVRNN
+from benchmarks.synthetic import synthetic_batch
+
+
+def train_curve(batches, bf16):
+    params.use_bf16 = bf16
+    torch.manual_seed(params.seed)
+    model = LinearVRNN()
+    optimizer = optim.Adam(model.parameters(), lr=params.init_lr)
+    model.train()
+    elbos = []
+    start = time.time()
+    for batch in batches:
+        optimizer.zero_grad()
+        loss = model(*batch)
+        loss[0].backward()
+        optimizer.step()
+        elbos.append(loss[0].item())
+    return elbos, (time.time() - start) / len(batches)
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', default=30, type=int)
+    parser.add_argument('--print_every', default=5, type=int)
+    args = parser.parse_args(args)
+
+    torch.manual_seed(params.seed)
+    batches = [
+        synthetic_batch(params.batch_size, params.max_dialog_len,
+                        params.max_utt_len, params.max_vocab_cnt)
+        for _ in range(args.steps)
+    ]
+    fp32_elbos, fp32_time = train_curve(batches, bf16=False)
+    bf16_elbos, bf16_time = train_curve(batches, bf16=True)
+
+    print("step  fp32 elbo  bf16 elbo  rel diff")
+    for step in range(0, args.steps, args.print_every):
+        print("%4d  %9.4f  %9.4f  %8.1e" %
+              (step + 1, fp32_elbos[step], bf16_elbos[step],
+               abs(bf16_elbos[step] - fp32_elbos[step]) / fp32_elbos[step]))
+    print("step time fp32 %.3fs, bf16 %.3fs" % (fp32_time, bf16_time))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,107 @@
+"""Check that models of several configurations run side by side in one
+process: LinearVRNN and TreeVRNN built from Config(n_state=n,
+temperature=--temperature) for every n of --n_states, with and without
+structured attention (and two-phase decoding for LinearVRNN), through a
+training forward and backward and an eval forward. Fails on the first
+configuration that does not run, gives non-finite losses or state
+probabilities of the wrong width, starts from another gumbel temperature,
+or changes the params module.
+
+    python benchmarks/config_sweep.py --n_states 5 10 20
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import params
+from benchmarks.synthetic import synthetic_batch, ubuntu_records, ubuntu_vocab
+from data_apis.UbuntuChatCorpus import Batch, RecordMaker
+from models.linear_vrnn import LinearVRNN
+from models.tree_vrnn import TreeVRNN
+from utils.config import Config
+
+LINEAR_SETTINGS = dict(batch_size=4, max_dialog_len=6, max_utt_len=10)
+# the synthetic Ubuntu records have up to params.max_dialog_len turns
+TREE_SETTINGS = dict(batch_size=4, max_enc_steps=12, max_dec_steps=12)
+
+
+def linear_inputs(config):
+    torch.manual_seed(config.seed)
+    return synthetic_batch(config.batch_size, config.max_dialog_len,
+                           config.max_utt_len, config.max_vocab_cnt)
+
+
+def tree_inputs(config):
+    directory = tempfile.mkdtemp()
+    try:
+        vocab = ubuntu_vocab(directory)
+    finally:
+        shutil.rmtree(directory)
+    examples = [
+        RecordMaker(record, vocab, config)
+        for record in ubuntu_records(config.batch_size)
+    ]
+    batch = Batch(examples, vocab, None, config=config)
+    return (batch.enc_batch, batch.enc_lens, batch.dec_batch,
+            batch.target_batch, batch.padding_mask, batch.tgt_index)
+
+
+def check(model_class, inputs, p_ts_index, config):
+    """Train and eval forward of one configuration, returns the losses."""
+    torch.manual_seed(config.seed)
+    model = model_class(config)
+    assert torch.isclose(model.vae_cell.tau,
+                         torch.tensor(config.temperature)).all(), \
+        "tau %s for temperature %s" % (model.vae_cell.tau.item(),
+                                       config.temperature)
+    losses = model(*inputs)
+    losses[0].backward()
+    for loss in losses:
+        assert torch.isfinite(loss), "non-finite loss %s" % float(loss)
+    with torch.no_grad():
+        outputs = model(*inputs, training=False)
+    p_ts = outputs[p_ts_index]
+    assert p_ts.shape[-1] == config.n_state, \
+        "p_ts of width %d for n_state %d" % (p_ts.shape[-1], config.n_state)
+    return [loss.item() for loss in losses]
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_states', nargs='+', default=[5, 10, 20], type=int)
+    parser.add_argument('--temperature', default=0.3, type=float)
+    args = parser.parse_args(args)
+
+    saved = repr(Config())
+    for n_state in args.n_states:
+        for struct in (True, False):
+            for two_phase in (False, True):
+                config = Config(n_state=n_state,
+                                temperature=args.temperature,
+                                use_struct_attention=struct,
+                                two_phase_decode=two_phase,
+                                **LINEAR_SETTINGS)
+                losses = check(LinearVRNN, linear_inputs(config), 3, config)
+                print("LinearVRNN n_state %d, struct %d, two-phase %d: %s" %
+                      (n_state, struct, two_phase, losses))
+
+            config = Config(n_state=n_state,
+                            temperature=args.temperature,
+                            use_struct_attention=struct,
+                            **TREE_SETTINGS)
+            losses = check(TreeVRNN, tree_inputs(config), 2, config)
+            print("TreeVRNN n_state %d, struct %d: %s" %
+                  (n_state, struct, losses))
+
+    assert repr(Config()) == saved, "params was changed"
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,361 @@
+"""Time the training and data paths on synthetic dialogs and compare the
+times with a stored baseline.
+
+    python benchmarks/run.py                      # all cases
+    python benchmarks/run.py --cases tree_forward swda_prepare_batch
+    python benchmarks/run.py --update_baseline    # after an intended change
+
+The times are written to --out as JSON. A case fails when its best time is
+more than --threshold times the one in --baseline, and the run then exits
+with status 1. Everything runs on the CPU, so a baseline is only comparable
+on the machine (and number of threads) it was recorded on.
+"""
+from __future__ import print_function
+
+import argparse
+from collections import OrderedDict
+from contextlib import contextmanager, redirect_stdout
+import io
+import json
+import os
+import pickle as pkl
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import params
+from benchmarks.synthetic import (synthetic_batch, simdial_data,
+                                  ubuntu_records, ubuntu_vocab)
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# smaller than the training configuration so that the suite runs in a few
+# minutes on a laptop CPU
+LINEAR_PARAMS = dict(batch_size=16, max_dialog_len=10, max_utt_len=20)
+TREE_PARAMS = dict(batch_size=8,
+                   max_dialog_len=10,
+                   max_enc_steps=30,
+                   max_dec_steps=30)
+CASES = OrderedDict()
+
+
+def case(name, **overrides):
+    """Register a benchmark. The decorated function sets the case up under
+    the params overrides and returns the function to time."""
+    def decorator(setup):
+        CASES[name] = (setup, overrides)
+        return setup
+
+    return decorator
+
+
+@contextmanager
+def params_overrides(**overrides):
+    saved = {key: getattr(params, key) for key in overrides}
+    for key, value in overrides.items():
+        setattr(params, key, value)
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            setattr(params, key, value)
+
+
+def _linear_step():
+    from models.linear_vrnn import LinearVRNN
+    model = LinearVRNN()
+    model.eval()  # no dropout, the same work in every repeat
+    batch = synthetic_batch(params.batch_size, params.max_dialog_len,
+                            params.max_utt_len, params.max_vocab_cnt)
+
+    def run():
+        model.zero_grad()
+        loss = model(*batch)
+        loss[0].backward()
+
+    return run
+
+
+@case("linear_struct",
+      use_struct_attention=True,
+      two_phase_decode=False,
+      **LINEAR_PARAMS)
+def linear_struct():
+    """LinearVRNN forward and backward with structured attention."""
+    return _linear_step()
+
+
+@case("linear_plain",
+      use_struct_attention=False,
+      two_phase_decode=False,
+      **LINEAR_PARAMS)
+def linear_plain():
+    """LinearVRNN forward and backward without structured attention."""
+    return _linear_step()
+
+
+@case("linear_two_phase", two_phase_decode=True, **LINEAR_PARAMS)
+def linear_two_phase():
+    """LinearVRNN forward and backward with params.two_phase_decode."""
+    return _linear_step()
+
+
+def _ubuntu_batch(directory, n_records):
+    from data_apis.UbuntuChatCorpus import RecordMaker
+    vocab = ubuntu_vocab(directory)
+    records = ubuntu_records(n_records)
+    return vocab, [RecordMaker(record, vocab) for record in records]
+
+
+@case("tree_forward", **TREE_PARAMS)
+def tree_forward():
+    """TreeVRNN forward of a training step, without the backward."""
+    from data_apis.UbuntuChatCorpus import Batch
+    from models.tree_vrnn import TreeVRNN
+    directory = tempfile.mkdtemp()
+    try:
+        vocab, examples = _ubuntu_batch(directory, params.batch_size)
+    finally:
+        shutil.rmtree(directory)
+    batch = Batch(examples, vocab, None)
+    model = TreeVRNN()
+    model.eval()
+
+    def run():
+        model(batch.enc_batch,
+              batch.enc_lens,
+              batch.dec_batch,
+              batch.target_batch,
+              batch.padding_mask,
+              batch.tgt_index,
+              training=True)
+
+    return run
+
+
+@case("ubuntu_batch", batch_size=40)
+def ubuntu_batch():
+    """UbuntuChatCorpus.Batch of five batches of RecordMakers."""
+    from data_apis.UbuntuChatCorpus import Batch
+    directory = tempfile.mkdtemp()
+    try:
+        vocab, examples = _ubuntu_batch(directory, 5 * params.batch_size)
+    finally:
+        shutil.rmtree(directory)
+
+    def run():
+        for i in range(0, len(examples), params.batch_size):
+            Batch(examples[i:i + params.batch_size], vocab, None)
+
+    return run
+
+
+def _simdial_corpus(data):
+    from data_apis.SWDADialogCorpus import SWDADialogCorpus
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "simdial.pkl")
+        with open(path, "wb") as f:
+            pkl.dump(data, f)
+        return SWDADialogCorpus(path), path, directory
+    except Exception:
+        shutil.rmtree(directory)
+        raise
+
+
+@case("swda_corpus_load")
+def swda_corpus_load():
+    """SWDADialogCorpus over a pickled SimDial-shaped corpus, then its id
+    corpus."""
+    from data_apis.SWDADialogCorpus import SWDADialogCorpus
+    _, path, directory = _simdial_corpus(simdial_data(n_train=2000))
+
+    def run():
+        SWDADialogCorpus(path).get_dialog_corpus()
+
+    run.cleanup = lambda: shutil.rmtree(directory)
+    return run
+
+
+def _swda_loader(api, n_train):
+    from data_apis.data_utils import SWDADataLoader
+    return SWDADataLoader("Train",
+                          api.get_dialog_corpus()["train"][:n_train],
+                          params.max_utt_len, params.max_dialog_len)
+
+
+@case("swda_prepare_batch", batch_size=40)
+def swda_prepare_batch():
+    """SWDADataLoader._prepare_batch of fifty batches."""
+    api, _, directory = _simdial_corpus(simdial_data(n_train=2000))
+    shutil.rmtree(directory)
+    loader = _swda_loader(api, 50 * params.batch_size)
+    index_lists = [
+        loader.indexes[i:i + params.batch_size]
+        for i in range(0, loader.data_size, params.batch_size)
+    ]
+
+    def run():
+        for index_list in index_lists:
+            loader._prepare_batch(index_list)
+
+    return run
+
+
+@case("interpretion_analysis", batch_size=40)
+def interpretion_analysis():
+    """The state and dialog act analysis of interpretion.py over decoded
+    SimDial-shaped dialogs with random state and BOW probabilities."""
+    import interpretion
+    data = simdial_data()
+    api, _, directory = _simdial_corpus(data)
+    shutil.rmtree(directory)
+    loader = _swda_loader(api, 200)
+    rng = np.random.RandomState(0)
+    results = []
+    for i in range(0, loader.data_size, params.batch_size):
+        usr, sys_, _, _, _ = loader._prepare_batch(
+            loader.indexes[i:i + params.batch_size])
+        shape = tuple(usr.shape[:2])
+        results.append([
+            usr.numpy(),
+            sys_.numpy(),
+            rng.rand(*(shape + (params.n_state, ))),
+            rng.rand(*(shape + (params.n_state, ))),
+            rng.randn(*(shape + (len(api.vocab), ))),
+            rng.randn(*(shape + (len(api.vocab), ))),
+        ])
+
+    def run():
+        labels, sents, _ = interpretion.convert_results(
+            results, api.id_to_vocab)
+        sents_by_state = [
+            interpretion.get_state_sents(i,
+                                         sents,
+                                         labels,
+                                         sys_side=0,
+                                         last_n=1)
+            for i in range(params.n_state)
+        ]
+        transition_prob = interpretion.transition_probs(labels)
+        state_map = interpretion.act_state_map(sents_by_state, data)
+        interpretion.act_transition_probs(state_map, transition_prob,
+                                          len(data["act_list"]))
+
+    return run
+
+
+def time_case(name, repeat):
+    setup, overrides = CASES[name]
+    with params_overrides(**overrides), redirect_stdout(io.StringIO()):
+        torch.manual_seed(params.seed)
+        np.random.seed(params.seed)
+        run = setup()
+        try:
+            run()  # warm up
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                times.append(time.perf_counter() - start)
+        finally:
+            if hasattr(run, "cleanup"):
+                run.cleanup()
+    return {"min": min(times), "median": float(np.median(times))}
+
+
+def compare(results, baseline, threshold):
+    """Print every case against the baseline, return the regressed ones."""
+    regressions = []
+    print("%-24s %10s %10s %10s %8s" %
+          ("case", "min (s)", "median (s)", "base (s)", "ratio"))
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print("%-24s %10.4f %10.4f %10s %8s" %
+                  (name, result["min"], result["median"], "-", "new"))
+            continue
+        ratio = result["min"] / base["min"]
+        flag = ""
+        if ratio > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("%-24s %10.4f %10.4f %10.4f %7.2fx%s" %
+              (name, result["min"], result["median"], base["min"], ratio,
+               flag))
+    return regressions
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases',
+                        nargs='+',
+                        default=list(CASES),
+                        choices=list(CASES))
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--threads',
+                        default=None,
+                        type=int,
+                        help='torch CPU threads, the default of torch if None')
+    parser.add_argument('--out',
+                        default=os.path.join(BENCH_DIR, "results.json"))
+    parser.add_argument('--baseline',
+                        default=os.path.join(BENCH_DIR, "baseline.json"))
+    parser.add_argument('--threshold',
+                        default=1.5,
+                        type=float,
+                        help='fail when a case is this many times slower')
+    parser.add_argument('--update_baseline',
+                        action='store_true',
+                        help='write the times of these cases to --baseline')
+    args = parser.parse_args(args)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    results = OrderedDict()
+    for name in args.cases:
+        results[name] = time_case(name, args.repeat)
+        print("%s: %.4fs" % (name, results[name]["min"]))
+        sys.stdout.flush()
+
+    report = {
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+        },
+        "repeat": args.repeat,
+        "cases": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+
+    baseline = {"cases": {}}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.update_baseline:
+        baseline["machine"] = report["machine"]
+        baseline["cases"].update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print("Baseline written to %s" % args.baseline)
+        return 0
+
+    regressions = compare(results, baseline["cases"], args.threshold)
+    if regressions:
+        print("%d case(s) more than %.2fx slower than the baseline: %s" %
+              (len(regressions), args.threshold, ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,130 @@
+"""Check LinearVRNN.encode_sentences, one packed sent_rnn call over the
+non-empty utterances of both speakers, against the per-row loop over the
+padded outputs it replaced, values and gradients, for GRU and LSTM cells,
+and compare their times.
+
+    python benchmarks/sentence_encoder.py --repeat 5
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import params
+from benchmarks.synthetic import synthetic_batch
+from models.linear_vrnn import LinearVRNN
+from utils.config import Config
+
+
+def loop_encode_sentences(model, usr_input_sent, sys_input_sent,
+                          usr_input_mask, sys_input_mask):
+    """The original encoder: sent_rnn over the padded utterances of each
+    speaker, then the output at len - 1 of every non-empty row."""
+    config = model.config
+    batch_size, dialog_len, max_utt_len = usr_input_sent.size()
+    sent_embeddings = []
+    for input_sent, input_mask in ((usr_input_sent, usr_input_mask),
+                                   (sys_input_sent, sys_input_mask)):
+        input_embedding = model.embedding(input_sent).view(
+            [-1, max_utt_len, config.embed_size])
+        sent_len = torch.sum(torch.sign(input_mask.view(-1, max_utt_len)),
+                             dim=1)
+        if config.cell_type == "gru":
+            outputs, _ = model.sent_rnn(input_embedding)
+        else:
+            outputs, (_, _) = model.sent_rnn(input_embedding)
+        sent_embedding = torch.zeros(batch_size * dialog_len,
+                                     config.encoding_cell_size)
+        for i in range(sent_embedding.shape[0]):
+            if sent_len[i] > 0:
+                sent_embedding[i] = outputs[i, sent_len[i] - 1, :]
+        sent_embeddings.append(
+            sent_embedding.view(-1, dialog_len, config.encoding_cell_size))
+    return sent_embeddings[0], sent_embeddings[1]
+
+
+def run(fn, model, batch):
+    """Embeddings and the gradients of a fixed projection of them with
+    respect to the parameters."""
+    model.zero_grad()
+    usr_embedding, sys_embedding = fn(*batch)
+    embeddings = torch.stack([usr_embedding, sys_embedding])
+    weights = torch.linspace(-1, 1, embeddings.numel()).view_as(embeddings)
+    # all-empty turns give constant zeros, without a graph in the packed
+    # encoder
+    if embeddings.requires_grad:
+        torch.sum(embeddings * weights).backward()
+    grads = [
+        p.grad if p.grad is not None else torch.zeros_like(p)
+        for p in list(model.embedding.parameters()) +
+        list(model.sent_rnn.parameters())
+    ]
+    return embeddings.detach(), grads
+
+
+def time_fn(fn, model, batch, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        run(fn, model, batch)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def encoder_batch(batch_size, dialog_len, max_utt_len, vocab_size,
+                  empty=False):
+    """(usr_input_sent, sys_input_sent, usr_input_mask, sys_input_mask) of
+    dialogs with padding turns, or with only empty turns."""
+    usr_sent, sys_sent, _, usr_mask, sys_mask = synthetic_batch(
+        batch_size, dialog_len, max_utt_len, vocab_size)
+    if empty:
+        usr_sent, sys_sent = usr_sent * 0, sys_sent * 0
+        usr_mask, sys_mask = usr_mask * 0, sys_mask * 0
+    return usr_sent, sys_sent, usr_mask, sys_mask
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--batch_size', default=params.batch_size, type=int)
+    parser.add_argument('--n_turns', default=params.max_dialog_len, type=int)
+    parser.add_argument('--max_utt_len', default=params.max_utt_len, type=int)
+    args = parser.parse_args(args)
+
+    for cell_type in ("gru", "lstm"):
+        torch.manual_seed(params.seed)
+        model = LinearVRNN(Config(cell_type=cell_type))
+        model.eval()
+        loop = lambda *batch: loop_encode_sentences(model, *batch)
+        vocab_size = model.config.max_vocab_cnt
+
+        for batch_size, n_turns, empty in ((1, 1, False), (1, 1, True),
+                                           (3, 4, True), (args.batch_size,
+                                                          args.n_turns, False)):
+            batch = encoder_batch(batch_size, n_turns, args.max_utt_len,
+                                  vocab_size, empty)
+            expected, expected_grads = run(loop, model, batch)
+            actual, actual_grads = run(model.encode_sentences, model, batch)
+            assert torch.allclose(actual, expected, rtol=1e-5, atol=1e-6), \
+                "embeddings differ by %g" % (actual - expected).abs().max()
+            for a, e in zip(actual_grads, expected_grads):
+                assert torch.allclose(a, e, rtol=1e-4, atol=1e-5), \
+                    "gradients differ by %g" % (a - e).abs().max()
+            print("%s, batch %d x %d turns%s: embeddings and gradients match" %
+                  (cell_type, batch_size, n_turns,
+                   ", all empty" if empty else ""))
+
+        loop_time = time_fn(loop, model, batch, args.repeat)
+        packed_time = time_fn(model.encode_sentences, model, batch,
+                              args.repeat)
+        print("%s, forward+backward: loop %.4fs, packed %.4fs (%.1fx)" %
+              (cell_type, loop_time, packed_time, loop_time / packed_time))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,112 @@
+"""Synthetic SimDial- and Ubuntu-shaped data for the benchmarks, built in
+memory from a fixed seed.
+"""
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+import torch
+
+import params
+
+
+def synthetic_batch(batch_size, max_dialog_len, max_utt_len, vocab_size):
+    """Random dialogs of 1 to max_dialog_len turns, in the SWDADataLoader
+    batch layout."""
+    dialog_lens = torch.randint(1, max_dialog_len + 1, (batch_size, ))
+    sents = []
+    for _ in range(2):
+        utt_lens = torch.randint(3, max_utt_len + 1,
+                                 (batch_size, max_dialog_len))
+        utt_lens[torch.arange(max_dialog_len).unsqueeze(0) >=
+                 dialog_lens.unsqueeze(1)] = 0
+        mask = (torch.arange(max_utt_len).view(1, 1, -1) <
+                utt_lens.unsqueeze(2)).long()
+        sent = torch.randint(1, vocab_size,
+                             (batch_size, max_dialog_len, max_utt_len)) * mask
+        sents.append((sent, mask))
+    return sents[0][0], sents[1][0], dialog_lens, sents[0][1], sents[1][1]
+
+
+def _words(rng, n_words, prefix):
+    return ["%s%d" % (prefix, i) for i in rng.permutation(n_words)]
+
+
+def simdial_data(n_train=400,
+                 n_test=100,
+                 n_acts=14,
+                 n_words=300,
+                 min_turns=4,
+                 max_turns=10,
+                 seed=0):
+    """A corpus in the layout of the SimDial pickles read by
+    SWDADialogCorpus and interpretion.py: every dialog is a walk over
+    n_acts dialog acts with a random transition matrix, and every act has
+    its own system and user utterances.
+    """
+    rng = np.random.RandomState(seed)
+    words = _words(rng, n_words, "w")
+    act_list = ["act%d-||reply%d-" % (i, i) for i in range(n_acts)]
+    trans_prob = rng.dirichlet(np.ones(n_acts) * 0.3, size=n_acts)
+    utts = []
+    for _ in range(n_acts):
+        act_utts = []
+        for _ in range(3):
+            sys_utt = " ".join(rng.choice(words, rng.randint(3, 12)))
+            usr_utt = " ".join(rng.choice(words, rng.randint(3, 12)))
+            act_utts.append((sys_utt, usr_utt))
+        utts.append(act_utts)
+
+    def dialog():
+        turns = []
+        act = 0
+        for _ in range(rng.randint(min_turns, max_turns + 1)):
+            sys_utt, usr_utt = utts[act][rng.randint(3)]
+            turns.append((0, sys_utt, usr_utt, act_list[act]))
+            act = rng.choice(n_acts, p=trans_prob[act])
+        return turns
+
+    return {
+        "train": [dialog() for _ in range(n_train)],
+        "test": [dialog() for _ in range(n_test)],
+        "trans_prob": trans_prob,
+        "act_list": act_list,
+    }
+
+
+def ubuntu_records(n_records, n_words=2000, seed=0):
+    """JSON lines in the layout of the Ubuntu chat corpus files read by
+    RecordMaker."""
+    rng = np.random.RandomState(seed)
+    words = _words(rng, n_words, "u")
+    records = []
+    for _ in range(n_records):
+        n_turns = rng.randint(2, params.max_dialog_len + 1)
+        context = [
+            " ".join(rng.choice(words, rng.randint(3, params.max_enc_steps)))
+            for _ in range(n_turns)
+        ]
+        relation_at = [[i, int(rng.randint(i + 1, n_turns))]
+                       for i in range(n_turns - 1)]
+        records.append(
+            json.dumps({
+                "context": context,
+                "answer": " ".join(
+                    rng.choice(words, rng.randint(3, params.max_dec_steps))),
+                "ans_idx": int(rng.randint(n_turns)),
+                "relation_at": relation_at,
+                "relation_user": relation_at[::2],
+            }))
+    return records
+
+
+def ubuntu_vocab(directory, n_words=2000):
+    """A Vocab over the words of ubuntu_records, written to directory."""
+    from data_apis.vocab import Vocab
+    path = os.path.join(directory, "vocab")
+    with open(path, "w") as f:
+        for i in range(n_words):
+            f.write("u%d %d\n" % (i, n_words - i))
+    return Vocab(path, params.max_vocab_cnt, False, None)
@@ -0,0 +1,119 @@
+"""Check TreeVRNN.tree_log_potentials against the per-element loop it
+replaced, values and gradients, and compare their times.
+
+    python benchmarks/tree_potentials.py --repeat 5
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import params
+from models.tree_vrnn import TreeVRNN
+
+
+def loop_log_potentials(model, sent_embedding, tgt_index):
+    """The original loop over batch x turns x turns."""
+    batch_size, n_turns = sent_embedding.size(0), sent_embedding.size(1)
+    log_potentials = torch.zeros(batch_size,
+                                 n_turns,
+                                 n_turns,
+                                 device=sent_embedding.device)
+    for b in range(batch_size):
+        for i in range(n_turns):
+            for j in range(n_turns):
+                if i == j:
+                    if i > tgt_index[b]:
+                        log_potentials[b, i, j] = 0
+                    else:
+                        log_potentials[b, i, j] = torch.tanh(
+                            torch.matmul(
+                                model.s,
+                                torch.tanh(
+                                    model.W_1.matmul(model.root) +
+                                    model.W_2.matmul(sent_embedding[b, i, :]) +
+                                    model.b)))
+                if i > j:
+                    log_potentials[b, i, j] = 0
+                else:
+                    if j > tgt_index[b]:
+                        log_potentials[b, i, j] = 0
+                    else:
+                        log_potentials[b, i, j] = torch.tanh(
+                            torch.matmul(
+                                model.s,
+                                torch.tanh(
+                                    model.W_1.matmul(sent_embedding[b, i, :]) +
+                                    model.W_2.matmul(sent_embedding[b, j, :]) +
+                                    model.b)))
+    return log_potentials
+
+
+def run(fn, model, sent_embedding, tgt_index):
+    """Potentials and the gradients of a fixed projection of them with
+    respect to the sentence embeddings and the parameters."""
+    model.zero_grad()
+    sent_embedding = sent_embedding.detach().requires_grad_()
+    log_potentials = fn(sent_embedding, tgt_index)
+    weights = torch.linspace(-1, 1, log_potentials.numel()).view_as(
+        log_potentials)
+    torch.sum(log_potentials * weights).backward()
+    grads = [sent_embedding.grad] + [
+        p.grad if p.grad is not None else torch.zeros_like(p)
+        for p in (model.W_1, model.W_2, model.b, model.s)
+    ]
+    return log_potentials.detach(), grads
+
+
+def time_fn(fn, model, sent_embedding, tgt_index, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        run(fn, model, sent_embedding, tgt_index)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--batch_size', default=params.batch_size, type=int)
+    parser.add_argument('--n_turns', default=params.max_dialog_len, type=int)
+    args = parser.parse_args(args)
+
+    torch.manual_seed(params.seed)
+    model = TreeVRNN()
+    loop = lambda e, t: loop_log_potentials(model, e, t)
+
+    # every target turn, including the first and the last
+    for batch_size, n_turns in ((1, 1), (3, 4), (args.batch_size,
+                                                 args.n_turns)):
+        sent_embedding = torch.randn(batch_size, n_turns,
+                                     params.encoding_cell_size)
+        tgt_index = torch.arange(batch_size) % n_turns
+        expected, expected_grads = run(loop, model, sent_embedding, tgt_index)
+        actual, actual_grads = run(model.tree_log_potentials, model,
+                                   sent_embedding, tgt_index)
+        assert torch.allclose(actual, expected, rtol=1e-4, atol=1e-4), \
+            "potentials differ by %g" % (actual - expected).abs().max()
+        for name, a, e in zip(["sent_embedding", "W_1", "W_2", "b", "s"],
+                              actual_grads, expected_grads):
+            assert torch.allclose(a, e, rtol=1e-4, atol=1e-4), \
+                "gradient of %s differs by %g" % (name, (a - e).abs().max())
+        print("batch %d x %d turns: potentials and gradients match" %
+              (batch_size, n_turns))
+
+    loop_time = time_fn(loop, model, sent_embedding, tgt_index, args.repeat)
+    vec_time = time_fn(model.tree_log_potentials, model, sent_embedding,
+                       tgt_index, args.repeat)
+    print("forward+backward: loop %.4fs, vectorized %.4fs (%.0fx)" %
+          (loop_time, vec_time, loop_time / vec_time))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,55 @@
+"""Compare the per-turn LinearVRNN forward with the two-phase forward.
+
+    python benchmarks/two_phase_decode.py --repeat 5
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import params
+from models.linear_vrnn import LinearVRNN
+from benchmarks.synthetic import synthetic_batch
+
+
+def time_step(model, batch, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        model.zero_grad()
+        loss = model(*batch)
+        loss[0].backward()
+        times.append(time.time() - start)
+    return min(times), loss[0].item()
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--no_struct_attention',
+                        dest='struct_attention',
+                        action='store_false')
+    args = parser.parse_args(args)
+
+    params.use_struct_attention = args.struct_attention
+    torch.manual_seed(params.seed)
+    model = LinearVRNN()
+    model.eval()  # no dropout, so both modes compute the same loss
+    batch = synthetic_batch(params.batch_size, params.max_dialog_len,
+                            params.max_utt_len, params.max_vocab_cnt)
+
+    for two_phase in (False, True):
+        params.two_phase_decode = two_phase
+        torch.manual_seed(params.seed)
+        step_time, loss = time_step(model, batch, args.repeat)
+        print("two_phase_decode=%s: forward+backward %.3fs, elbo %.4f" %
+              (two_phase, step_time, loss))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,7 +1,7 @@
 import glob
 import sys
 import time
-from random import shuffle
+import random
 from threading import Thread
 import queue
 
@@ -14,91 +14,97 @@ from .vocab import PAD_TOKEN, UNKNOWN_TOKEN, DECODING_START, DECODING_END
 
 
 class Batch(object):
-    def __init__(self, examples, vocab, struct_dist, device="cpu"):
+    def __init__(self,
+                 examples,
+                 vocab,
+                 struct_dist,
+                 device="cpu",
+                 config=params):
 
         # branch_batch_size = config['graph_structure_net']['branch_batch_size']
         # sen_batch_size = config['graph_structure_net']['sen_batch_size']
         # max_utt_len = params.max_utt_len
         # # max_dec_steps = config['graph_structure_net']['max_dec_steps']
         # sen_hidden_dim = config['graph_structure_net']['sen_hidden_dim']
+        batch_size = len(examples)
 
-        self.enc_batch = torch.zeros(params.batch_size,
-                                     params.max_dialog_len,
-                                     params.max_enc_steps,
+        self.enc_batch = torch.zeros(batch_size,
+                                     config.max_dialog_len,
+                                     config.max_enc_steps,
                                      dtype=torch.int64,
                                      device=device)
-        self.enc_lens = torch.zeros(params.batch_size,
-                                    params.max_dialog_len,
+        self.enc_lens = torch.zeros(batch_size,
+                                    config.max_dialog_len,
                                     dtype=torch.int32,
                                     device=device)
         self.attn_mask = -1e10 * torch.ones(
-            params.batch_size,
-            params.max_dialog_len,
-            params.max_enc_steps,
+            batch_size,
+            config.max_dialog_len,
+            config.max_enc_steps,
             dtype=torch.float32,
             device=device)  # attention mask batch
-        self.branch_lens_mask = torch.zeros(params.batch_size,
-                                            params.max_dialog_len,
-                                            params.max_dialog_len,
+        self.branch_lens_mask = torch.zeros(batch_size,
+                                            config.max_dialog_len,
+                                            config.max_dialog_len,
                                             dtype=torch.float32,
                                             device=device)
 
-        self.dec_batch = torch.zeros(params.batch_size,
-                                     params.max_dec_steps,
+        self.dec_batch = torch.zeros(batch_size,
+                                     config.max_dec_steps,
                                      dtype=torch.int64,
                                      device=device)  # decoder input
         self.target_batch = torch.zeros(
-            params.batch_size,
-            params.max_dec_steps,
+            batch_size,
+            config.max_dec_steps,
             dtype=torch.int32,
             device=device)  # target sequence index batch
-        self.padding_mask = torch.zeros(params.batch_size,
-                                        params.max_dec_steps,
+        self.padding_mask = torch.zeros(batch_size,
+                                        config.max_dec_steps,
                                         dtype=torch.float32,
                                         device=device)  # target mask batch
         # self.tgt_batch_len = torch.zeros(config.branch_batch_size, dtype=torch.int32,device=device)      # target batch length
 
         # use state_matrix to look up sentence embedding state
-        self.state_matrix = torch.zeros(params.batch_size,
-                                        params.max_dialog_len,
-                                        params.max_dialog_len,
+        self.state_matrix = torch.zeros(batch_size,
+                                        config.max_dialog_len,
+                                        config.max_dialog_len,
                                         dtype=torch.int64,
                                         device=device)
-        self.struct_conv = torch.zeros(params.batch_size,
-                                       params.max_dialog_len,
-                                       params.max_dialog_len,
+        self.struct_conv = torch.zeros(batch_size,
+                                       config.max_dialog_len,
+                                       config.max_dialog_len,
                                        dtype=torch.int64,
                                        device=device)
-        self.struct_dist = torch.zeros(params.batch_size,
-                                       params.max_dialog_len,
-                                       params.max_dialog_len,
+        self.struct_dist = torch.zeros(batch_size,
+                                       config.max_dialog_len,
+                                       config.max_dialog_len,
                                        dtype=torch.int64,
                                        device=device)
 
-        self.relate_user = torch.zeros(params.batch_size,
-                                       params.max_dialog_len,
-                                       params.max_dialog_len,
+        self.relate_user = torch.zeros(batch_size,
+                                       config.max_dialog_len,
+                                       config.max_dialog_len,
                                        dtype=torch.int64,
                                        device=device)
 
-        self.mask_emb = torch.zeros(params.batch_size,
-                                    params.max_dialog_len,
-                                    params.max_dialog_len,
-                                    params.encoding_cell_size * 2,
+        self.mask_emb = torch.zeros(batch_size,
+                                    config.max_dialog_len,
+                                    config.max_dialog_len,
+                                    config.encoding_cell_size * 2,
                                     dtype=torch.float32,
                                     device=device)
-        self.mask_user = torch.zeros(params.batch_size,
-                                     params.max_dialog_len,
-                                     params.max_dialog_len,
-                                     params.encoding_cell_size * 2,
+        self.mask_user = torch.zeros(batch_size,
+                                     config.max_dialog_len,
+                                     config.max_dialog_len,
+                                     config.encoding_cell_size * 2,
                                      dtype=torch.float32,
                                      device=device)
-        mask_tool = torch.ones(params.encoding_cell_size * 2,
+        mask_tool = torch.ones(config.encoding_cell_size * 2,
                                dtype=torch.float32,
                                device=device)
 
         # self.tgt_index = torch.zeros(config.branch_batch_size, config.sen_batch_size, dtype=torch.int32)
-        self.tgt_index = torch.zeros(params.batch_size,
+        self.tgt_index = torch.zeros(batch_size,
                                      dtype=torch.int64,
                                      device=device)
 
@@ -120,7 +126,7 @@ class Batch(object):
                 if enc_len != 0:
                     # initialization of state_matrix
                     self.state_matrix[i][enc_idx][
-                        enc_idx] = params.max_dialog_len * i + enc_idx + 1
+                        enc_idx] = config.max_dialog_len * i + enc_idx + 1
                 for j in range(enc_len):
                     self.attn_mask[i][enc_idx][j] = 0
 
@@ -157,8 +163,8 @@ class Batch(object):
             self.context.append(ex.original_context)
             self.response.append(ex.original_response)
 
-        self.enc_lens = self.enc_lens.view(params.batch_size *
-                                           params.max_dialog_len)
+        self.enc_lens = self.enc_lens.view(batch_size *
+                                           config.max_dialog_len)
         # self.enc_lens[:] = enc_lens_mid
 
 
@@ -167,15 +173,29 @@ class Batcher(object):
     """
     BATCH_QUEUE_MAX = 5
 
-    def __init__(self, data_path, vocab, mode="train", device="cpu"):
+    def __init__(self,
+                 data_path,
+                 vocab,
+                 mode="train",
+                 device="cpu",
+                 config=params):
         self.data_path = data_path
+        self.config = config
         self.vocab = vocab
         self.mode = mode
         self.device = device
 
         self.batch_queue = queue.Queue(self.BATCH_QUEUE_MAX)
+        # the input and batch threads shuffle with their own seeded streams,
+        # so the batch order is the same in every run and a resumed run can
+        # skip to its position
+        self._file_rng = random.Random(config.seed)
+        self._batch_rng = random.Random(config.seed + 1)
+        self._batches_built = 0
+        self._start_batch = 0
+        self.batches_served = 0
         self.input_queue = queue.Queue(self.BATCH_QUEUE_MAX *
-                                       params.batch_size)
+                                       config.batch_size)
 
         # with open('/'.join(data_path.split('/')[:-1]) + '/' + 'pred_struct_dist.pkl', 'r') as f_pred:
         # self.struct_dist = pkl.load(f_pred)
@@ -208,15 +228,41 @@ class Batcher(object):
         """Return a Batch from the batch queue.
         """
         if self.mode == 'eval':
-            if self.eval_num > params.eval_num / params.batch_size:
+            if self.eval_num > self.config.eval_num / self.config.batch_size:
                 self.eval_num = 0
                 return None
             else:
                 self.eval_num += 1
 
         batch = self.batch_queue.get()
+        # drop the batches queued before a load_state_dict()
+        while batch.index < self._start_batch:
+            batch = self.batch_queue.get()
+        self.batches_served = batch.index + 1
         return batch
 
+    def state_dict(self):
+        return {'batches_served': self.batches_served}
+
+    def load_state_dict(self, state):
+        """Continue from the first batch not served before the checkpoint.
+        The batches before it are not built."""
+        self._start_batch = state['batches_served']
+        self.batches_served = self._start_batch
+
+    def _put_batch(self, examples):
+        index = self._batches_built
+        self._batches_built += 1
+        if index < self._start_batch:
+            return
+        batch = Batch(examples,
+                      self.vocab,
+                      self.struct_dist,
+                      device=self.device,
+                      config=self.config)
+        batch.index = index
+        self.batch_queue.put(batch)
+
     def _fill_input_queue(self):
         """Reads data from file and put into input queue
         """
@@ -225,12 +271,13 @@ class Batcher(object):
             if self.mode == 'decode':
                 file_list = sorted(file_list)
             else:
-                shuffle(file_list)
+                self._file_rng.shuffle(file_list)
 
             for f in file_list:
                 with open(f, 'rb') as reader:
                     for record in reader:
-                        record = RecordMaker(record, self.vocab)
+                        record = RecordMaker(record, self.vocab,
+                                             self.config)
                         self.input_queue.put(record)
 
     def _fill_batch_queue(self):
@@ -238,26 +285,24 @@ class Batcher(object):
         """
         while True:
             if self.mode == 'decode':
+                # models take any batch size, decode one dialog at a time
                 ex = self.input_queue.get()
-                b = [ex for _ in range(params.batch_size)]
-                self.batch_queue.put(
-                    Batch(b, self.vocab, self.struct_dist, device=self.device))
+                self._put_batch([ex])
             else:
                 inputs = []
-                for _ in range(params.batch_size * self.cache_size):
+                for _ in range(self.config.batch_size * self.cache_size):
                     inputs.append(self.input_queue.get())
+                # batch dialogs with similar numbers of tree nodes (turns up
+                # to the target one), the models only run the batch's longest
+                inputs.sort(key=lambda record: record.tgt_idx)
 
                 batches = []
-                for i in range(0, len(inputs), params.batch_size):
-                    batches.append(inputs[i:i + params.batch_size])
+                for i in range(0, len(inputs), self.config.batch_size):
+                    batches.append(inputs[i:i + self.config.batch_size])
                 if self.mode not in ['eval', 'decode']:
-                    shuffle(batches)
+                    self._batch_rng.shuffle(batches)
                 for b in batches:
-                    self.batch_queue.put(
-                        Batch(b,
-                              self.vocab,
-                              self.struct_dist,
-                              device=self.device))
+                    self._put_batch(b)
 
     def _watch_threads(self):
         """Watch input queue and batch queue threads and restart if dead."""
@@ -280,7 +325,7 @@ class Batcher(object):
 
 
 class RecordMaker(object):
-    def __init__(self, record, vocab):
+    def __init__(self, record, vocab, config=params):
 
         start_id = vocab._word2id(DECODING_START)
         end_id = vocab._word2id(DECODING_END)
@@ -300,7 +345,7 @@ class RecordMaker(object):
         ### encoder
         context_words = []
         for context in context_list:
-            words = context.strip().split()[:params.max_enc_steps]
+            words = context.strip().split()[:config.max_enc_steps]
             context_words.append(words)
 
         self.branch_len = len(context_words)
@@ -310,11 +355,11 @@ class RecordMaker(object):
             self.enc_len.append(len(words))
             self.enc_input.append([vocab._word2id(w)
                                    for w in words] + [self.pad_id] *
-                                  (params.max_enc_steps - len(words)))
+                                  (config.max_enc_steps - len(words)))
 
-        self.pad_sent = [self.pad_id for _ in range(params.max_enc_steps)
+        self.pad_sent = [self.pad_id for _ in range(config.max_enc_steps)
                          ]  # the sentence which only have 'pad_id'
-        while len(self.enc_input) < params.max_dialog_len:
+        while len(self.enc_input) < config.max_dialog_len:
             self.enc_len.append(0)
             self.enc_input.append(self.pad_sent)
 
@@ -323,13 +368,13 @@ class RecordMaker(object):
         dec_ids = [vocab._word2id(w) for w in response_words]
         # dec_ids lens
         self.dec_len = len(dec_ids) + 1 if (
-            len(dec_ids) + 1) < params.max_dec_steps else params.max_dec_steps
+            len(dec_ids) + 1) < config.max_dec_steps else config.max_dec_steps
         # decoder input
-        self.dec_input = [start_id] + dec_ids[:params.max_dec_steps - 1] + \
-                         [self.pad_id] * (params.max_dec_steps - len(dec_ids) - 1)
+        self.dec_input = [start_id] + dec_ids[:config.max_dec_steps - 1] + \
+                         [self.pad_id] * (config.max_dec_steps - len(dec_ids) - 1)
         # decoder target
-        self.dec_target = dec_ids[:params.max_dec_steps - 1] + [end_id] + \
-                          [self.pad_id] * (params.max_dec_steps - len(dec_ids) - 1)
+        self.dec_target = dec_ids[:config.max_dec_steps - 1] + [end_id] + \
+                          [self.pad_id] * (config.max_dec_steps - len(dec_ids) - 1)
 
         self.original_context = ' '.join(context_list)
         self.original_response = response
@@ -16,6 +16,9 @@ class LongDataLoader(object):
     ptr = 0
     num_batch = None
     batch_indexes = None
+    epoch_batch_indexes = None
+    num_shards = 1
+    even_shards = True
     grid_indexes = None
     indexes = None
     data_lens = None
@@ -29,7 +32,13 @@ class LongDataLoader(object):
     def _prepare_batch(self, cur_grid, prev_grid):
         raise NotImplementedError("Have to override prepare batch")
 
-    def epoch_init(self, batch_size, shuffle=True, intra_shuffle=True):
+    def epoch_init(self,
+                   batch_size,
+                   shuffle=True,
+                   intra_shuffle=True,
+                   num_shards=1,
+                   shard_index=0,
+                   even_shards=True):
         assert len(self.indexes) == self.data_size and len(
             self.data_lens) == self.data_size
 
@@ -44,11 +53,24 @@ class LongDataLoader(object):
             self.batch_indexes.append(
                 self.indexes[i * self.batch_size:(i + 1) * self.batch_size])
 
+        # keep the tail of the epoch as a last, smaller batch
         left_over = self.data_size - temp_num_batch * batch_size
+        if left_over > 0:
+            self.batch_indexes.append(self.indexes[temp_num_batch *
+                                                   self.batch_size:])
 
         # shuffle batch indexes
         if shuffle:
             self._shuffle_batch_indexes()
+
+        # data-parallel workers shuffle with the same seed and take every
+        # num_shards-th batch. With even_shards the tail is dropped so that
+        # all of them run the same number of steps, otherwise (validation)
+        # every batch is kept and some workers may get none
+        self.epoch_batch_indexes = self.batch_indexes
+        self.num_shards = num_shards
+        self.even_shards = even_shards
+        self._shard(shard_index)
         """
         # create grid indexes
         self.grid_indexes = []
@@ -76,8 +98,38 @@ class LongDataLoader(object):
         """
 
         self.num_batch = len(self.batch_indexes)
-        print("%s begins with %d batches with %d left over samples" %
-              (self.name, self.num_batch, left_over))
+        print("%s begins with %d batches, the last one has %d samples" %
+              (self.name, self.num_batch, left_over or batch_size))
+
+    def _shard(self, shard_index):
+        self.batch_indexes = self.epoch_batch_indexes
+        if self.num_shards > 1:
+            n_batches = len(self.batch_indexes)
+            if self.even_shards:
+                n_batches -= n_batches % self.num_shards
+            self.batch_indexes = self.batch_indexes[
+                shard_index:n_batches:self.num_shards]
+
+    def state_dict(self):
+        """The batch order of the current epoch and the position in it."""
+        return {
+            'batch_size': self.batch_size,
+            'epoch_batch_indexes': self.epoch_batch_indexes,
+            'num_shards': self.num_shards,
+            'even_shards': self.even_shards,
+            'ptr': self.ptr,
+        }
+
+    def load_state_dict(self, state, shard_index=0):
+        """Continue an epoch saved with state_dict() from the next batch."""
+        self.batch_size = state['batch_size']
+        self.prev_alive_size = self.batch_size
+        self.epoch_batch_indexes = state['epoch_batch_indexes']
+        self.num_shards = state['num_shards']
+        self.even_shards = state.get('even_shards', True)
+        self._shard(shard_index)
+        self.num_batch = len(self.batch_indexes)
+        self.ptr = state['ptr']
 
     def next_batch(self):
         if self.ptr < self.num_batch:
@@ -176,5 +228,16 @@ class SWDADataLoader(LongDataLoader):
 
         # initial_prev_zt = np.ones()
 
+        # trim the padding to the longest utterance in this batch, keeping at
+        # least one decoder step
+        usr_full_mask = np.array(usr_full_mask)
+        sys_full_mask = np.array(sys_full_mask)
+        utt_len = max(np.max(np.sum(usr_full_mask, axis=2)),
+                      np.max(np.sum(sys_full_mask, axis=2)), 2)
+        usr_input_sent = np.array(usr_input_sent)[:, :, :utt_len]
+        sys_input_sent = np.array(sys_input_sent)[:, :, :utt_len]
+        usr_full_mask = usr_full_mask[:, :, :utt_len]
+        sys_full_mask = sys_full_mask[:, :, :utt_len]
+
         return torch.tensor(usr_input_sent).to(self.device), torch.tensor(sys_input_sent).to(self.device), torch.tensor(dialog_lens).to(self.device), \
                torch.tensor(usr_full_mask).to(self.device), torch.tensor(sys_full_mask).to(self.device)
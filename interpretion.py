@@ -10,12 +10,12 @@ import torch
 import networkx as nx
 from beeprint import pp
 import matplotlib.pyplot as plt
-from torch.utils.tensorboard import SummaryWriter
 
 import params
 from models.linear_vrnn import LinearVRNN
 from data_apis.SWDADialogCorpus import SWDADialogCorpus
 from utils.draw_struct import draw_networkx_nodes_ellipses
+from utils.summary import AsyncSummaryWriter
 
 
 def softmax(x):
@@ -97,6 +97,122 @@ def get_state_sents(state,
     return state_sents
 
 
+def convert_results(results, id_to_vocab):
+    """The state label, the sentences and the BOW log-likelihood of every
+    turn of the decoded dialogs."""
+    converted_labels = []
+    converted_sents = []
+    conv_probs = []
+    for batch_i in range(len(results)):
+        usr_sents = results[batch_i][0]
+        sys_sents = results[batch_i][1]
+        probs = results[batch_i][2]
+        trans_probs = results[batch_i][3]
+        bow_logits1 = results[batch_i][4]
+        bow_logits2 = results[batch_i][5]
+        for i in range(usr_sents.shape[0]):
+            this_dialog_labels = []
+            this_dialog_sents = []
+            prev_label = -1
+            this_conv_prob = 1
+            for turn_j in range(params.max_dialog_len):
+                if not usr_sents[i, turn_j, 0]:
+                    break
+                label = probs[i, turn_j].argmax()
+                usr_tokens = id_to_sent(id_to_vocab, usr_sents[i, turn_j])
+                sys_tokens = id_to_sent(id_to_vocab, sys_sents[i, turn_j])
+                usr_prob = id_to_log_probs(bow_logits1[i, turn_j],
+                                           usr_sents[i, turn_j],
+                                           id_to_vocab,
+                                           SOFTMAX=True)
+                sys_prob = id_to_log_probs(bow_logits2[i, turn_j],
+                                           sys_sents[i, turn_j],
+                                           id_to_vocab,
+                                           SOFTMAX=True)
+
+                this_dialog_labels += [label]
+                this_dialog_sents += [[usr_tokens, sys_tokens]]
+                this_turn_prob = usr_prob + sys_prob
+                this_conv_prob += this_turn_prob
+            # print(this_dialog_sents)
+            # print(this_dialog_labels)
+            conv_probs.append(this_conv_prob)
+            converted_labels.append(this_dialog_labels)
+            converted_sents.append(this_dialog_sents)
+    return converted_labels, converted_sents, conv_probs
+
+
+def transition_probs(converted_labels):
+    """State transition probabilities counted over the decoded dialogs."""
+    transition_count = np.zeros((params.n_state, params.n_state))
+
+    for labels in converted_labels:
+        for i in range(len(labels) - 1):
+            transition_count[labels[i], labels[i + 1]] += 1
+
+    transition_prob = np.zeros((params.n_state, params.n_state))
+    for i in range(params.n_state):
+        if transition_count[i].sum() != 0:
+            transition_prob[i] = transition_count[i] / transition_count[i].sum(
+            )
+    return transition_prob
+
+
+def act_state_map(sents_by_state, data):
+    """For every state, the distribution of the SimDial dialog acts of its
+    sentences, [n_state, n_acts]."""
+    act_dict = {}
+    for dialog in data["train"]:
+        for turn in dialog:
+            key = turn[3]
+            sys_utt = "".join(turn[1].lower().split(" "))
+            usr_utt = "".join(turn[2].lower().split(" "))
+            if key not in act_dict.keys():
+                act_dict[key] = [sys_utt, usr_utt]
+            else:
+                act_dict[key].append(sys_utt)
+                act_dict[key].append(usr_utt)
+
+    #### new interpretion
+    state_map = np.zeros((params.n_state, len(data['act_list'])))
+    for i in range(params.n_state):
+        states = []
+        for sent in sents_by_state[i]:
+            true_state = None
+            sent = "".join(sent.split(" "))
+            for key, value in act_dict.items():
+                if sent in value:
+                    true_state = data["act_list"].index(key)
+            if true_state is None:
+                raise Exception(sent + "is not in the training data!!")
+            states.append(true_state)
+        cnt = 0
+        for j in range(len(Counter(states).most_common())):
+            state_map[i, Counter(states).most_common()[j][0]] = Counter(
+                states).most_common()[j][1]
+            cnt += Counter(states).most_common()[j][1]
+        state_map[i] = state_map[i] / cnt
+    return state_map
+
+
+def act_transition_probs(state_map, transition_prob, n_acts):
+    """The state transition probabilities mapped onto the dialog acts."""
+    reverse_state_map = state_map.transpose().copy()
+    for i in range(reverse_state_map.shape[0]):
+        if np.sum(reverse_state_map[i]) != 0:
+            reverse_state_map[i] = reverse_state_map[i] / np.sum(
+                reverse_state_map[i])
+
+    new_trans_prob = np.zeros((n_acts, n_acts))
+    for x in range(n_acts):
+        for y in range(n_acts):
+            for i in range(params.n_state):
+                for j in range(params.n_state):
+                    new_trans_prob[x, y] += reverse_state_map[
+                        x, i] * transition_prob[i, j] * state_map[j, y]
+    return new_trans_prob
+
+
 def main(args):
     parser = argparse.ArgumentParser()
 
@@ -136,50 +252,14 @@ def main(args):
 
     state = torch.load(os.path.join(params.log_dir, "linear_vrnn",
                                     args.ckpt_dir, args.ckpt_name),
-                       map_location=device)
-    writer = SummaryWriter(
+                       map_location=device,
+                       weights_only=False)
+    writer = AsyncSummaryWriter(
         log_dir=os.path.join(params.log_dir, "linear_vrnn", args.ckpt_dir))
     # pp(state['state_dict'])
 
-    converted_labels = []
-    converted_sents = []
-    conv_probs = []
-    for batch_i in range(len(results)):
-        usr_sents = results[batch_i][0]
-        sys_sents = results[batch_i][1]
-        probs = results[batch_i][2]
-        trans_probs = results[batch_i][3]
-        bow_logits1 = results[batch_i][4]
-        bow_logits2 = results[batch_i][5]
-        for i in range(params.batch_size):
-            this_dialog_labels = []
-            this_dialog_sents = []
-            prev_label = -1
-            this_conv_prob = 1
-            for turn_j in range(params.max_dialog_len):
-                if not usr_sents[i, turn_j, 0]:
-                    break
-                label = probs[i, turn_j].argmax()
-                usr_tokens = id_to_sent(api2.id_to_vocab, usr_sents[i, turn_j])
-                sys_tokens = id_to_sent(api2.id_to_vocab, sys_sents[i, turn_j])
-                usr_prob = id_to_log_probs(bow_logits1[i, turn_j],
-                                           usr_sents[i, turn_j],
-                                           api2.id_to_vocab,
-                                           SOFTMAX=True)
-                sys_prob = id_to_log_probs(bow_logits2[i, turn_j],
-                                           sys_sents[i, turn_j],
-                                           api2.id_to_vocab,
-                                           SOFTMAX=True)
-
-                this_dialog_labels += [label]
-                this_dialog_sents += [[usr_tokens, sys_tokens]]
-                this_turn_prob = usr_prob + sys_prob
-                this_conv_prob += this_turn_prob
-            # print(this_dialog_sents)
-            # print(this_dialog_labels)
-            conv_probs.append(this_conv_prob)
-            converted_labels.append(this_dialog_labels)
-            converted_sents.append(this_dialog_sents)
+    converted_labels, converted_sents, conv_probs = convert_results(
+        results, api2.id_to_vocab)
 
     sents_by_state = []
     for i in range(params.n_state):
@@ -203,17 +283,7 @@ def main(args):
         sents_by_state = [['START']] + sents_by_state
         sents_by_state_sys = [['START']] + sents_by_state_sys
 
-    transition_count = np.zeros((params.n_state, params.n_state))
-
-    for labels in converted_labels:
-        for i in range(len(labels) - 1):
-            transition_count[labels[i], labels[i + 1]] += 1
-
-    transition_prob = np.zeros((params.n_state, params.n_state))
-    for i in range(params.n_state):
-        if transition_count[i].sum() != 0:
-            transition_prob[i] = transition_count[i] / transition_count[i].sum(
-            )
+    transition_prob = transition_probs(converted_labels)
 
     # direct transition only, for direct transition, the transition probs are from the fetch_results from the model
     if params.with_direct_transition:
@@ -250,50 +320,9 @@ def main(args):
     # Compare with the ground truth in SimDial
     # Change the name for different domains comparison!
     data = pkl.load(open(params.data_dir, "rb"))
-    act_dict = {}
-    for dialog in data["train"]:
-        for turn in dialog:
-            key = turn[3]
-            sys_utt = "".join(turn[1].lower().split(" "))
-            usr_utt = "".join(turn[2].lower().split(" "))
-            if key not in act_dict.keys():
-                act_dict[key] = [sys_utt, usr_utt]
-            else:
-                act_dict[key].append(sys_utt)
-                act_dict[key].append(usr_utt)
-
-    #### new interpretion
-    state_map = np.zeros((params.n_state, len(data['act_list'])))
-    for i in range(params.n_state):
-        states = []
-        for sent in sents_by_state[i]:
-            true_state = None
-            sent = "".join(sent.split(" "))
-            for key, value in act_dict.items():
-                if sent in value:
-                    true_state = data["act_list"].index(key)
-            if true_state is None:
-                raise Exception(sent + "is not in the training data!!")
-            states.append(true_state)
-        cnt = 0
-        for j in range(len(Counter(states).most_common())):
-            state_map[i, Counter(states).most_common()[j][0]] = Counter(
-                states).most_common()[j][1]
-            cnt += Counter(states).most_common()[j][1]
-        state_map[i] = state_map[i] / cnt
-    reverse_state_map = state_map.transpose().copy()
-    for i in range(reverse_state_map.shape[0]):
-        if np.sum(reverse_state_map[i]) != 0:
-            reverse_state_map[i] = reverse_state_map[i] / np.sum(
-                reverse_state_map[i])
-
-    new_trans_prob = np.zeros((len(data["act_list"]), len(data["act_list"])))
-    for x in range(len(data["act_list"])):
-        for y in range(len(data["act_list"])):
-            for i in range(params.n_state):
-                for j in range(params.n_state):
-                    new_trans_prob[x, y] += reverse_state_map[
-                        x, i] * transition_prob[i, j] * state_map[j, y]
+    state_map = act_state_map(sents_by_state, data)
+    new_trans_prob = act_transition_probs(state_map, transition_prob,
+                                          len(data["act_list"]))
 
     entropy_loss = 0
     for i in range(len(data["act_list"])):
@@ -3,7 +3,6 @@ from torch import nn
 from torch.autograd import Variable
 import torch.nn.functional as F
 
-import params
 import torch_struct
 
 
@@ -26,38 +25,59 @@ class Attn(nn.Module):
             self.v = nn.Parameter(torch.rand(query_size))
 
     def forward(self, query, encoder_outputs, tgt_index):
-        context = []
-        for b in range(encoder_outputs.size(0)):
-            this_len = tgt_index[b] + 1
-            # Create variable to store attention energies
-            attn_energies = torch.zeros(this_len)
-
-            if params.use_cuda and torch.cuda.is_available():
-                attn_energies = attn_energies.cuda()
-
-            # Calculate energy for each encoder output
-            for i in range(this_len):
-                attn_energies[i] = self.score(query[b, :], encoder_outputs[b,
-                                                                           i])
-            # Normalize energies to weights in range 0 to 1, resize to B x S
-            c = F.softmax(attn_energies,
-                          dim=0).matmul(encoder_outputs[b, :this_len, :])
-            context.append(c)
-        return torch.stack(context)
-
-    def score(self, query, encoder_output):
-
-        if self.method == 'dot':
-            energy = torch.dot(encoder_output, query)
-            return energy
+        """Attention of every query over the encoder outputs up to and
+        including its tgt_index position.
+        Args:
+            query: [batch, query_size]
+            encoder_outputs: [batch, turns, hidden_size]
+            tgt_index: [batch] last position to attend to
+        Returns:
+            [batch, hidden_size] context vectors
+        """
+        return self.prepare(encoder_outputs, tgt_index)(query)
 
-        elif self.method == 'general':
-            energy = self.attn(encoder_output)
-            energy = torch.dot(energy, query)
-            return energy
+    def prepare(self, encoder_outputs, tgt_index):
+        """Project the encoder outputs and build the length mask once for
+        all the queries over them, e.g. the steps of a decoder.
+        Returns:
+            step(query): the same context as
+            self(query, encoder_outputs, tgt_index)
+        """
+        positions = torch.arange(encoder_outputs.size(1),
+                                 device=encoder_outputs.device)
+        mask = positions.view(1, -1) > tgt_index.to(
+            encoder_outputs.device).view(-1, 1)
+        keys = self.project_keys(encoder_outputs)
+
+        def step(query):
+            attn_energies = self.score(query, keys).masked_fill(
+                mask, -float("inf"))
+            # Normalize energies to weights in range 0 to 1, the masked
+            # positions get exactly 0
+            attn_weights = F.softmax(attn_energies, dim=1)
+            context = attn_weights.unsqueeze(1).matmul(encoder_outputs)
+            return context.squeeze(1)
+
+        return step
+
+    def project_keys(self, encoder_outputs):
+        """The part of the energies that only depends on the encoder
+        outputs, [batch, turns, query_size] (hidden_size for dot)."""
+        if self.method == 'general':
+            return self.attn(encoder_outputs)
+        elif self.method == 'concat':
+            return self.attn_1(encoder_outputs)
+        return encoder_outputs
+
+    def score(self, query, keys):
+        """[batch, turns] energies of the query against the projected
+        encoder outputs of every turn."""
+        if self.method in ('dot', 'general'):
+            energy = torch.matmul(keys, query.unsqueeze(-1))
+            return energy.squeeze(-1)
 
         elif self.method == 'concat':
-            energy = self.attn_2(
-                torch.cat((query, self.attn_1(encoder_output)), 0))
-            energy = self.v.dot(energy)
+            query = query.unsqueeze(1).expand(-1, keys.size(1), -1)
+            energy = self.attn_2(torch.cat((query, keys), -1))
+            energy = energy.matmul(self.v)
             return energy
@@ -3,84 +3,86 @@ import sys
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
-from .sequential import MLP
+from .sequential import MLP, output_layer, project_bow
 sys.path.append("..")
-from utils.sample import gumbel_softmax
+from utils.sample import GumbelSampler
 from utils.loss import BPR_BOW_loss
+from utils.linear_chain import linear_chain_marginals
+from utils.workspace import Workspace
+from utils.profiler import profiled
 import params
 
-import torch_struct
-
 
 class LinearVAECell(nn.Module):
-    def __init__(self, state_is_tuple=True):
+    def __init__(self, state_is_tuple=True, config=params):
         super(LinearVAECell, self).__init__()
 
+        self.config = config
         self._state_is_tuple = state_is_tuple
-        # temperature of gumbel_softmax
-        self.tau = nn.Parameter(torch.tensor([5.0]))
-
-        self.enc_mlp = MLP(params.encoding_cell_size * 2 +
-                           params.state_cell_size, [400, 200],
-                           dropout_rate=params.dropout)
-        self.enc_fc = nn.Linear(200, params.n_state)
-        self.dec_mlp = MLP(params.n_state, [200, 200],
-                           dropout_rate=params.dropout)
-
-        if not params.use_struct_attention:
-            self.dec_rnn_1 = nn.LSTM(params.embed_size,
-                                     200 + params.n_state,
+        # temperature of gumbel_softmax, learned from config.temperature
+        self.tau = nn.Parameter(torch.tensor([float(config.temperature)]))
+        self.sampler = GumbelSampler(config=config)
+
+        self.enc_mlp = MLP(config.encoding_cell_size * 2 +
+                           config.state_cell_size, [400, 200],
+                           dropout_rate=config.dropout)
+        self.enc_fc = nn.Linear(200, config.n_state)
+        self.dec_mlp = MLP(config.n_state, [200, 200],
+                           dropout_rate=config.dropout)
+
+        if not config.use_struct_attention:
+            self.dec_rnn_1 = nn.LSTM(config.embed_size,
+                                     200 + config.n_state,
                                      1,
                                      batch_first=True)
-            self.dec_rnn_2 = nn.LSTM(params.embed_size,
-                                     2 * (200 + params.n_state),
+            self.dec_rnn_2 = nn.LSTM(config.embed_size,
+                                     2 * (200 + config.n_state),
                                      1,
                                      batch_first=True)
-            self.dec_fc_1 = nn.Linear(200 + params.n_state,
-                                      params.max_vocab_cnt)
+            self.dec_fc_1 = output_layer(200 + config.n_state, config)
 
-            self.dec_fc_2 = nn.Linear(2 * (200 + params.n_state),
-                                      params.max_vocab_cnt)
+            self.dec_fc_2 = output_layer(2 * (200 + config.n_state), config)
         else:
-            self.dec_rnn_1 = nn.LSTM(params.embed_size +
-                                     params.encoding_cell_size * 2,
-                                     200 + params.n_state,
+            self.dec_rnn_1 = nn.LSTM(config.embed_size +
+                                     config.encoding_cell_size * 2,
+                                     200 + config.n_state,
                                      1,
                                      batch_first=True)
-            self.dec_rnn_2 = nn.LSTM(params.embed_size +
-                                     params.encoding_cell_size * 2,
-                                     200 + params.n_state,
+            self.dec_rnn_2 = nn.LSTM(config.embed_size +
+                                     config.encoding_cell_size * 2,
+                                     200 + config.n_state,
                                      1,
                                      batch_first=True)
 
-            self.dec_fc_1 = nn.Linear(200 + params.n_state,
-                                      params.max_vocab_cnt)
+            self.dec_fc_1 = output_layer(200 + config.n_state, config)
 
-            self.dec_fc_2 = nn.Linear(200 + params.n_state,
-                                      params.max_vocab_cnt)
+            self.dec_fc_2 = output_layer(200 + config.n_state, config)
 
-        self.bow_fc1 = nn.Linear(params.state_cell_size + 200, 400)
-        self.bow_project1 = nn.Linear(400, params.max_vocab_cnt)
-        self.bow_fc2 = nn.Linear(2 * (params.state_cell_size + 200), 400)
-        self.bow_project2 = nn.Linear(400, params.max_vocab_cnt)
-        if params.with_direct_transition:
-            self.transit_mlp = MLP(params.n_state, [100, 100],
-                                   dropout_rate=params.dropout)
+        self.bow_fc1 = nn.Linear(config.state_cell_size + 200, 400)
+        self.bow_project1 = output_layer(400, config)
+        self.bow_fc2 = nn.Linear(2 * (config.state_cell_size + 200), 400)
+        self.bow_project2 = output_layer(400, config)
+        if config.with_direct_transition:
+            self.transit_mlp = MLP(config.n_state, [100, 100],
+                                   dropout_rate=config.dropout)
         else:
-            self.transit_mlp = MLP(params.state_cell_size, [100, 100],
-                                   dropout_rate=params.dropout)
-        self.transit_fc = nn.Linear(100, params.n_state)
+            self.transit_mlp = MLP(config.state_cell_size, [100, 100],
+                                   dropout_rate=config.dropout)
+        self.transit_fc = nn.Linear(100, config.n_state)
 
-        if params.cell_type == "gru":
-            self.state_rnn = nn.GRUCell(params.encoding_cell_size * 2 + 200,
-                                        params.state_cell_size)
+        if config.cell_type == "gru":
+            self.state_rnn = nn.GRUCell(config.encoding_cell_size * 2 + 200,
+                                        config.state_cell_size)
         else:
-            self.state_rnn = nn.LSTMCell(params.encoding_cell_size * 2 + 200,
-                                         params.state_cell_size)
-        if params.dropout not in (None, 0):
-            self.dropout = nn.Dropout(params.dropout)
+            self.state_rnn = nn.LSTMCell(config.encoding_cell_size * 2 + 200,
+                                         config.state_cell_size)
+        if config.dropout not in (None, 0):
+            self.dropout = nn.Dropout(config.dropout)
+        self.workspace = Workspace()
 
+    @profiled("vae_cell.encode")
     def encode(self, inputs, h_prev):
         enc_inputs = torch.cat(
             [h_prev, inputs],
@@ -92,26 +94,100 @@ class LinearVAECell(nn.Module):
 
         return logits_z, q_z, log_q_z
 
+    def query_log_potentials(self, hidden, input_query, input_potentials):
+        """Linear chain potentials of the previous turns for one query.
+        Args:
+            hidden: [1, batch, n_state + 200] decoder state used as the
+                query Q
+            input_query: [batch, utt + 1, 2, n_state + 200] X of the turns
+                so far
+            input_potentials: [batch, utt, 2, 2] cached X^K dot X^{K+1}
+        Returns:
+            [batch, utt, 2, 2] X^K dot X^{K+1} + X^K dot Q + Q dot X^{K+1}
+        """
+        batch_size, query_size = input_query.size(0), input_query.size(-1)
+        # X^K dot Q for every turn, [batch, utt + 1, 2]
+        query_scores = input_query.reshape(batch_size, -1, query_size).bmm(
+            hidden.squeeze(0).unsqueeze(2)).view(batch_size, -1, 2)
+        # both query terms only depend on the row (z_{K+1}) of the potential
+        return input_potentials + (query_scores[:, :-1] +
+                                   query_scores[:, 1:]).unsqueeze(3)
+
+    def struct_context(self,
+                       hidden,
+                       prev_embeddings,
+                       input_query,
+                       input_potentials,
+                       turn_mask=None):
+        """Structured attention over the previous turns for one query.
+        Without turn_mask every row attends over all prev_embeddings. With
+        turn_mask ([batch, utt], 1 for the turns before the decoded one) rows
+        of different turns can share one call: zero potentials past the end
+        of a chain leave the marginals of its turns unchanged.
+        """
+        # TODO: verify this with structured attention network formula in 4.2
+        log_potentials = self.query_log_potentials(hidden, input_query,
+                                                   input_potentials)
+        if turn_mask is not None:
+            log_potentials = log_potentials * turn_mask[:, :, None, None]
+
+        # Linear Chain
+        marginals_one_prob = linear_chain_marginals(log_potentials)[:, :, 1]
+        if turn_mask is not None:
+            marginals_one_prob = marginals_one_prob * turn_mask
+            num_turns = torch.clamp(torch.sum(turn_mask, dim=1, keepdim=True),
+                                    min=1)
+        else:
+            num_turns = prev_embeddings.size(1)
+        context = marginals_one_prob.unsqueeze(1).bmm(prev_embeddings).squeeze(
+            1)
+        return context / num_turns  # normalize attention
+
+    def dec_heads(self):
+        """The adaptive softmax heads the loss scores the decoder outputs
+        with, None when decode already returns logits.
+        """
+        if self.config.adaptive_softmax:
+            return self.dec_fc_1, self.dec_fc_2
+        return None
+
+    @profiled("decoder")
     def decode(self,
-               z_samples,
+               net2,
                h_prev,
                dec_input_embedding,
+               dec_seq_lens,
                prev_embeddings=None,
-               input_query=None):
-        net2 = self.dec_mlp(z_samples)  # [batch, 200]
+               input_query=None,
+               input_potentials=None,
+               turn_mask=None):
+        config = self.config
         dec_input_1 = torch.unsqueeze(
             torch.cat([h_prev, net2], dim=1),
             dim=0)  # [num_layer(1), batch, state_cell_size + 200]
         dec_input_embedding[0] = dec_input_embedding[
             0][:, 0:-1, :]  # batch x (40 - 1) x 300
         dec_input_embedding[1] = dec_input_embedding[1][:, 0:-1, :]
+        # the user decoder hands its state over to the system decoder after
+        # the last real step, so the padding width does not change it
+        dec_steps_1 = dec_seq_lens[0] - 1
 
         # decoder without structured attention
-        if not params.use_struct_attention:
+        if not config.use_struct_attention:
+            packed_input_1 = pack_padded_sequence(
+                dec_input_embedding[0],
+                torch.clamp(dec_steps_1, min=1).cpu(),
+                batch_first=True,
+                enforce_sorted=False)
             dec_outs_1, final_state_1 = self.dec_rnn_1(
-                dec_input_embedding[0], (dec_input_1, dec_input_1))
+                packed_input_1, (dec_input_1, dec_input_1))
+            dec_outs_1, _ = pad_packed_sequence(
+                dec_outs_1,
+                batch_first=True,
+                total_length=dec_input_embedding[0].size(1))
             dec_outs_1 = self.dropout(dec_outs_1)
-            dec_outs_1 = self.dec_fc_1(dec_outs_1)
+            if not config.adaptive_softmax:
+                dec_outs_1 = self.dec_fc_1(dec_outs_1)
 
             dec_input_2_h = torch.cat(
                 [dec_input_1, final_state_1[0]],
@@ -123,126 +199,67 @@ class LinearVAECell(nn.Module):
             dec_outs_2, final_state_2 = self.dec_rnn_2(
                 dec_input_embedding[1], (dec_input_2_h, dec_input_2_c))
             dec_outs_2 = self.dropout(dec_outs_2)
-            dec_outs_2 = self.dec_fc_2(dec_outs_2)
+            if not config.adaptive_softmax:
+                dec_outs_2 = self.dec_fc_2(dec_outs_2)
         # decoder with structured attention
         else:
             batch_size = dec_input_embedding[0].size(0)
             sentence_length = dec_input_embedding[0].size(1)
 
-            all_outs_1 = torch.zeros(
-                batch_size, sentence_length, 210
-            )  # 200 + params.n_state # 200 + params.n_state, record the output
-            if params.use_cuda and torch.cuda.is_available():
-                all_outs_1 = all_outs_1.cuda()
+            all_outs_1 = []  # record the output, 200 + config.n_state
             hidden_input_1 = dec_input_1  # LSTM : H
             cell_input_1 = dec_input_1  # LSTM : C
             utt_index = prev_embeddings.size(1)
-            X_prev = input_query[:, :utt_index, :, :]  # batch x utt x 2 x 210
-            X_cur = input_query[:, 1:(utt_index +
-                                      1), :, :]  # batch x utt x 2 x 210
-            X_prev_3d = X_prev.contiguous().view(params.batch_size * utt_index,
-                                                 2, 210)
-            X_cur_3d = X_cur.contiguous().view(params.batch_size * utt_index,
-                                               2, 210)
-
-            # X^K dot X^{K+1}
-            X_prev_times_X_cur = X_prev_3d.bmm(X_cur_3d.transpose(1, 2)).view(
-                params.batch_size, utt_index, 2, 2)
+            # the first turn has no previous turns to attend to
+            empty_context = self.workspace.zeros(
+                (batch_size, config.encoding_cell_size * 2), dec_input_1.device)
 
             # linear chain input query
             for t in range(sentence_length):
-                context = torch.zeros(params.batch_size,
-                                      params.encoding_cell_size * 2)
-                if params.use_cuda and torch.cuda.is_available():
-                    context = context.cuda()
                 if utt_index != None and utt_index >= 1:
-                    # TODO: verify this with structured attention network formula in 4.2
-                    Q = torch.transpose(hidden_input_1, 0,
-                                        1).unsqueeze(2).repeat(
-                                            1, utt_index, 2, 1).view(
-                                                params.batch_size * utt_index,
-                                                2, 210)
-
-                    # X^K dot Q
-                    X_prev_times_Q = X_prev_3d.bmm(Q.transpose(1, 2)).view(
-                        params.batch_size, utt_index, 2, 2)
-
-                    # Q dot X^{K+1}
-                    X_cur_times_Q = X_cur_3d.bmm(Q.transpose(1, 2)).view(
-                        params.batch_size, utt_index, 2, 2)
-
-                    log_potentials = X_prev_times_X_cur + X_prev_times_Q + X_cur_times_Q
-
-                    # Linear Chain
-                    # TODO: @torch-struct
-                    lengths = torch.tensor([utt_index + 1] * params.batch_size)
-                    if params.use_cuda and torch.cuda.is_available():
-                        lengths = lengths.cuda()
-                    dist = torch_struct.LinearChainCRF(log_potentials,
-                                                       lengths=lengths)
-                    marginals_one_prob = dist.marginals.sum(-1)[:, :, 1]
-                    marginals_one_prob = marginals_one_prob.unsqueeze(1)
-                    context = marginals_one_prob.bmm(prev_embeddings).squeeze(
-                        1)
-                    context = context / utt_index  # normalize attention)
+                    context = self.struct_context(hidden_input_1,
+                                                  prev_embeddings,
+                                                  input_query,
+                                                  input_potentials,
+                                                  turn_mask=turn_mask)
+                else:
+                    context = empty_context
                 dec_input_new = torch.cat(
                     [dec_input_embedding[0][:, t, :], context],
                     dim=1).unsqueeze(1)
 
                 ##RNN one word at one time
-                temp_out_1, (hidden_input_1, cell_input_1) = self.dec_rnn_1(
+                temp_out_1, (next_hidden_1, next_cell_1) = self.dec_rnn_1(
                     dec_input_new, (hidden_input_1, cell_input_1))
-                all_outs_1[:, t, :] = temp_out_1.squeeze(1)
+                all_outs_1.append(temp_out_1)
+                # keep the state of utterances that have already ended
+                ended = (t >= dec_steps_1).view(1, -1, 1)
+                hidden_input_1 = torch.where(ended, hidden_input_1,
+                                             next_hidden_1)
+                cell_input_1 = torch.where(ended, cell_input_1, next_cell_1)
 
-            dec_outs_1 = self.dropout(all_outs_1)
-            dec_outs_1 = self.dec_fc_1(dec_outs_1)
+            dec_outs_1 = self.dropout(torch.cat(all_outs_1, dim=1))
+            if not config.adaptive_softmax:
+                dec_outs_1 = self.dec_fc_1(dec_outs_1)
 
             dec_input_2_h = torch.cat(
                 [dec_input_1, hidden_input_1],
                 dim=2)  # [1, batch, 2 * (state_cell_size + 200)]
             # To keep two queries having the same dimension(state_cell_size + 200)
-            all_outs_2 = torch.zeros(
-                batch_size, sentence_length,
-                210)  # 200 + params.n_state, record the output
-            if params.use_cuda and torch.cuda.is_available():
-                all_outs_2 = all_outs_2.cuda()
+            all_outs_2 = []  # record the output, 200 + config.n_state
 
             hidden_input_2 = dec_input_1  # LSTM: H
             cell_input_2 = cell_input_1  #LSTM: C
 
             for t in range(sentence_length):
-                context = torch.zeros(params.batch_size,
-                                      params.encoding_cell_size * 2)
-                if params.use_cuda and torch.cuda.is_available():
-                    context = context.cuda()
                 if utt_index != None and utt_index >= 1:
-                    Q = torch.transpose(hidden_input_2, 0,
-                                        1).unsqueeze(2).repeat(
-                                            1, utt_index, 2, 1).view(
-                                                params.batch_size * utt_index,
-                                                2, 210)
-
-                    # X^K dot Q
-                    X_prev_times_Q = X_prev_3d.bmm(Q.transpose(1, 2)).view(
-                        params.batch_size, utt_index, 2, 2)
-
-                    # Q dot X^{K+1}
-                    X_cur_times_Q = X_cur_3d.bmm(Q.transpose(1, 2)).view(
-                        params.batch_size, utt_index, 2, 2)
-
-                    log_potentials = X_prev_times_X_cur + X_prev_times_Q + X_cur_times_Q
-
-                    # Linear Chain
-                    lengths = torch.tensor([utt_index + 1] * params.batch_size)
-                    if params.use_cuda and torch.cuda.is_available():
-                        lengths = lengths.cuda()
-                    dist = torch_struct.LinearChainCRF(log_potentials,
-                                                       lengths=lengths)
-                    marginals_one_prob = dist.marginals.sum(-1)[:, :, 1]
-                    marginals_one_prob = marginals_one_prob.unsqueeze(1)
-                    context = marginals_one_prob.bmm(prev_embeddings).squeeze(
-                        1)
-                    context = context / utt_index  # normalize attention
+                    context = self.struct_context(hidden_input_2,
+                                                  prev_embeddings,
+                                                  input_query,
+                                                  input_potentials,
+                                                  turn_mask=turn_mask)
+                else:
+                    context = empty_context
 
                 dec_input_new = torch.cat(
                     [dec_input_embedding[1][:, t, :], context],
@@ -252,38 +269,33 @@ class LinearVAECell(nn.Module):
                 temp_out_2, (hidden_input_2, cell_input_2) = self.dec_rnn_2(
                     dec_input_new, (hidden_input_2, cell_input_2))
 
-                all_outs_2[:, t, :] = temp_out_2.squeeze(1)
+                all_outs_2.append(temp_out_2)
 
-            dec_outs_2 = self.dropout(all_outs_2)
-            dec_outs_2 = self.dec_fc_2(dec_outs_2)
+            dec_outs_2 = self.dropout(torch.cat(all_outs_2, dim=1))
+            if not config.adaptive_softmax:
+                dec_outs_2 = self.dec_fc_2(dec_outs_2)
 
         # for computing BOW loss
         bow_logits1 = bow_logits2 = None
-        if params.with_BOW:
+        if config.with_BOW:
             bow_fc1 = self.bow_fc1(torch.squeeze(dec_input_1, dim=0))
             bow_fc1 = torch.tanh(bow_fc1)
-            if params.dropout not in (None, 0):
+            if config.dropout not in (None, 0):
                 bow_fc1 = self.dropout(bow_fc1)
-            bow_logits1 = self.bow_project1(
-                bow_fc1)  # [batch_size, vocab_size]
+            bow_logits1 = project_bow(self.bow_project1,
+                                      bow_fc1)  # [batch_size, vocab_size]
 
             bow_fc2 = self.bow_fc2(torch.squeeze(dec_input_2_h, dim=0))
             bow_fc2 = torch.tanh(bow_fc2)
-            if params.dropout not in (None, 0):
+            if config.dropout not in (None, 0):
                 bow_fc2 = self.dropout(bow_fc2)
-            bow_logits2 = self.bow_project2(bow_fc2)
-        return net2, dec_outs_1, dec_outs_2, bow_logits1, bow_logits2
+            bow_logits2 = project_bow(self.bow_project2, bow_fc2)
+        return dec_outs_1, dec_outs_2, bow_logits1, bow_logits2
 
-    def forward(self,
-                inputs,
-                state,
-                dec_input_embedding,
-                dec_seq_lens,
-                output_tokens,
-                prev_z_t=None,
-                prev_embeddings=None,
-                input_query=None):
-        if params.with_direct_transition:
+    def step(self, inputs, state, prev_z_t=None):
+        """The state recurrence of one turn, without the utterance decoders.
+        """
+        if self.config.with_direct_transition:
             assert prev_z_t is not None
         if self._state_is_tuple:
             (h_prev, _) = state
@@ -293,18 +305,12 @@ class LinearVAECell(nn.Module):
         logits_z, q_z, log_q_z = self.encode(inputs, h_prev)
 
         # sample
-        z_samples, logits_z_samples = gumbel_softmax(
+        z_samples, logits_z_samples = self.sampler(
             logits_z, self.tau, hard=False)  # [batch, n_state]
 
-        # decode
-        net2, dec_outs_1, dec_outs_2, bow_logits1, bow_logits2 = self.decode(
-            z_samples,
-            h_prev,
-            dec_input_embedding,
-            prev_embeddings=prev_embeddings,
-            input_query=input_query)
+        net2 = self.dec_mlp(z_samples)  # [batch, 200]
 
-        if params.with_direct_transition:
+        if self.config.with_direct_transition:
             net3 = self.transit_mlp(prev_z_t)
             p_z = self.transit_fc(net3)
             p_z = F.softmax(p_z, dim=1)
@@ -320,6 +326,36 @@ class LinearVAECell(nn.Module):
                                 dim=1)  # [batch, encoding_cell_size * 2 + 200]
         next_state = self.state_rnn(recur_input, state)
 
+        return z_samples, net2, next_state, p_z, q_z, log_p_z, log_q_z
+
+    def forward(self,
+                inputs,
+                state,
+                dec_input_embedding,
+                dec_seq_lens,
+                output_tokens,
+                prev_z_t=None,
+                prev_embeddings=None,
+                input_query=None,
+                input_potentials=None,
+                defer_bpr=False):
+        if self._state_is_tuple:
+            (h_prev, _) = state
+        else:
+            h_prev = state
+        z_samples, net2, next_state, p_z, q_z, log_p_z, log_q_z = self.step(
+            inputs, state, prev_z_t=prev_z_t)
+
+        # decode
+        dec_outs_1, dec_outs_2, bow_logits1, bow_logits2 = self.decode(
+            net2,
+            h_prev,
+            dec_input_embedding,
+            dec_seq_lens,
+            prev_embeddings=prev_embeddings,
+            input_query=input_query,
+            input_potentials=input_potentials)
+
         losses = BPR_BOW_loss(output_tokens,
                               dec_outs_1,
                               dec_outs_2,
@@ -328,6 +364,9 @@ class LinearVAECell(nn.Module):
                               p_z,
                               q_z,
                               bow_logits1=bow_logits1,
-                              bow_logits2=bow_logits2)
+                              bow_logits2=bow_logits2,
+                              dec_heads=self.dec_heads(),
+                              defer_bpr=defer_bpr,
+                              config=self.config)
 
-        return losses, z_samples, next_state, p_z, bow_logits1, bow_logits2
+        return losses, z_samples, next_state, p_z, q_z, bow_logits1, bow_logits2
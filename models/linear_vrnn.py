@@ -8,104 +8,237 @@ import sys
 import torch
 from torch import nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence
 import torch_struct
 
 sys.path.append("..")
 import params
 from .linear_vae_cell import LinearVAECell
+from utils.loss import BPR_BOW_loss
+from utils.workspace import Workspace
+from utils.precision import bf16_autocast
+from utils.profiler import profiled
+
+
+def onehot_straight_through(z_samples):
+    shape = z_samples.size()
+    _, ind = z_samples.max(dim=-1)
+    zts_onehot = torch.zeros_like(z_samples).view(-1, shape[-1])
+    zts_onehot.scatter_(1, ind.view(-1, 1), 1)
+    zts_onehot = zts_onehot.view(*shape)
+    # stop gradient
+    return (zts_onehot - z_samples).detach() + z_samples
 
 
 class LinearVRNN(nn.Module):
     """
-    VRNN with gumbel-softmax
+    VRNN with gumbel-softmax. config: the settings of the model, the
+    params module by default (see utils/config.py).
     """
-    def __init__(self):
+    def __init__(self, config=params):
         super(LinearVRNN, self).__init__()
 
-        self.embedding = nn.Embedding(params.max_vocab_cnt, params.embed_size)
+        self.config = config
+        self.embedding = nn.Embedding(config.max_vocab_cnt, config.embed_size)
 
-        if params.cell_type == "gru":
-            self.sent_rnn = nn.GRU(params.embed_size,
-                                   params.encoding_cell_size,
-                                   params.num_layer,
+        if config.cell_type == "gru":
+            self.sent_rnn = nn.GRU(config.embed_size,
+                                   config.encoding_cell_size,
+                                   config.num_layer,
                                    batch_first=True)
-            self.vae_cell = LinearVAECell(state_is_tuple=False)
+            self.vae_cell = LinearVAECell(state_is_tuple=False, config=config)
         else:
-            self.sent_rnn = nn.LSTM(params.embed_size,
-                                    params.encoding_cell_size,
-                                    params.num_layer,
+            self.sent_rnn = nn.LSTM(config.embed_size,
+                                    config.encoding_cell_size,
+                                    config.num_layer,
                                     batch_first=True)
-            self.vae_cell = LinearVAECell(state_is_tuple=True)
-        if params.dropout not in (None, 0):
-            self.dropout = nn.Dropout(params.dropout)
-        if params.use_struct_attention:
+            self.vae_cell = LinearVAECell(state_is_tuple=True, config=config)
+        if config.dropout not in (None, 0):
+            self.dropout = nn.Dropout(config.dropout)
+        if config.use_struct_attention:
             '''
-            Input Memory Net: Joint Embedding to Query Matrix [batch, length, params.encoding_cell_size * 2] -> [batch, length, 210 * 2]
+            Input Memory Net: Joint Embedding to Query Matrix [batch, length, config.encoding_cell_size * 2] -> [batch, length, (200 + config.n_state) * 2]
             '''
-            self.input_memory = nn.Linear(params.encoding_cell_size * 2,
-                                          (200 + params.n_state) * 2)
+            self.input_memory = nn.Linear(config.encoding_cell_size * 2,
+                                          (200 + config.n_state) * 2)
+        self.workspace = Workspace()
+        # (p_z, q_z) of the last forward with defer_bpr, [turns, batch, n_state]
+        self.posteriors = None
+
+    @staticmethod
+    def num_turns(usr_input_mask, sys_input_mask):
+        """Number of turns that are not padding in some dialog of the batch.
+        """
+        turn_lens = torch.sum(usr_input_mask, dim=2) + torch.sum(
+            sys_input_mask, dim=2)  # (16, 10)
+        return max(int(torch.max(torch.sum(torch.sign(turn_lens), dim=1))), 1)
+
+    @profiled("sentence_encoding")
+    def encode_sentences(self, usr_input_sent, sys_input_sent, usr_input_mask,
+                         sys_input_mask):
+        """Encode the user and system utterances of every turn in one packed
+        call of sent_rnn. Empty (padding) turns are skipped and get a zero
+        embedding.
+        """
+        config = self.config
+        dialog_len = usr_input_sent.size(1)
+        input_sent = torch.cat([usr_input_sent, sys_input_sent],
+                               dim=0)  # (32, 10, 40)
+        input_mask = torch.cat([usr_input_mask, sys_input_mask], dim=0)
+        input_sent = input_sent.view(-1, input_sent.size(-1))  # (320, 40)
+        sent_len = torch.sum(torch.sign(input_mask.view(-1,
+                                                        input_mask.size(-1))),
+                             dim=1)  # (320)
+
+        sent_embedding = torch.zeros(input_sent.size(0),
+                                     config.encoding_cell_size,
+                                     device=input_sent.device)
+        nonempty = torch.nonzero(sent_len > 0).squeeze(1)
+        if nonempty.numel() > 0:
+            input_embedding = self.embedding(input_sent.index_select(
+                0, nonempty))  # (n_turns, 40, 300)
+            packed_embedding = pack_padded_sequence(
+                input_embedding,
+                sent_len.index_select(0, nonempty).cpu(),
+                batch_first=True,
+                enforce_sorted=False)
+            if config.cell_type == "gru":
+                _, final_state = self.sent_rnn(packed_embedding)
+            else:
+                _, (final_state, _) = self.sent_rnn(packed_embedding)
+            # the last layer's final state is the output at step len - 1
+            sent_embedding = sent_embedding.index_copy(0, nonempty,
+                                                       final_state[-1])
 
+        sent_embedding = sent_embedding.view(2, -1, dialog_len,
+                                             config.encoding_cell_size)
+        return sent_embedding[0], sent_embedding[1]
+
+    def decode_all_turns(self, joint_embedding, input_query, input_potentials,
+                         dec_input_embedding, dec_seq_lens, output_tokens,
+                         state, prev_z, defer_bpr=False):
+        """Two-phase forward: run the state recurrence over all turns, then
+        the utterance decoders and the loss once over a (turns * batch)
+        super-batch. Row utt * batch + b of the super-batch is turn utt of
+        dialog b.
+        """
+        batch_size, dialog_len = joint_embedding.size(0), joint_embedding.size(
+            1)
+        h_prevs = []
+        net2s = []
+        z_ts = []
+        p_ts = []
+        q_zs = []
+        log_p_zs = []
+        log_q_zs = []
+        for utt in range(dialog_len):
+            if self.config.cell_type == "gru":
+                h_prevs.append(state)
+            else:
+                h_prevs.append(state[0])
+            z_samples, net2, state, p_z, q_z, log_p_z, log_q_z = self.vae_cell.step(
+                joint_embedding[:, utt, :], state, prev_z_t=prev_z)
+            prev_z = onehot_straight_through(z_samples)
+
+            net2s.append(net2)
+            z_ts.append(prev_z)
+            p_ts.append(p_z)
+            q_zs.append(q_z)
+            log_p_zs.append(log_p_z)
+            log_q_zs.append(log_q_z)
+
+        dec_input_emb = [
+            emb.transpose(0, 1).reshape(-1, emb.size(2), emb.size(3))
+            for emb in dec_input_embedding
+        ]  # (160, 40, 300)
+        dec_seq_len = [lens.transpose(0, 1).reshape(-1)
+                       for lens in dec_seq_lens]  # (160)
+        output_token = [
+            tokens.transpose(0, 1).reshape(-1, tokens.size(2))
+            for tokens in output_tokens
+        ]  # (160, 40)
+        if self.config.use_struct_attention:
+            # every row sees all turns, masked down to the ones before its own
+            turn_index = torch.arange(
+                dialog_len,
+                device=joint_embedding.device).repeat_interleave(batch_size)
+            turn_mask = (torch.arange(dialog_len - 1,
+                                      device=joint_embedding.device).unsqueeze(0)
+                         < turn_index.unsqueeze(1)).float()  # (160, 9)
+            prev_embeddings = joint_embedding[:, :-1, :].repeat(
+                dialog_len, 1, 1)  # (160, 9, 800)
+            input_query = input_query.repeat(dialog_len, 1, 1, 1)
+            input_potentials = input_potentials.repeat(dialog_len, 1, 1, 1)
+        else:
+            turn_mask = prev_embeddings = None
+
+        dec_outs_1, dec_outs_2, bow_logits1, bow_logits2 = self.vae_cell.decode(
+            torch.cat(net2s),
+            torch.cat(h_prevs),
+            dec_input_emb,
+            dec_seq_len,
+            prev_embeddings=prev_embeddings,
+            input_query=input_query,
+            input_potentials=input_potentials,
+            turn_mask=turn_mask)
+
+        p_ts = torch.stack(p_ts)  # (10, 16, n_state)
+        q_zs = torch.stack(q_zs)
+        losses = BPR_BOW_loss(output_token,
+                              dec_outs_1,
+                              dec_outs_2,
+                              torch.stack(log_p_zs),
+                              torch.stack(log_q_zs),
+                              p_ts,
+                              q_zs,
+                              bow_logits1=bow_logits1,
+                              bow_logits2=bow_logits2,
+                              dec_heads=self.vae_cell.dec_heads(),
+                              defer_bpr=defer_bpr,
+                              config=self.config)
+        if defer_bpr:
+            self.posteriors = (p_ts, q_zs)
+
+        bow_logits1 = bow_logits1.view(dialog_len, batch_size, -1)
+        bow_logits2 = bow_logits2.view(dialog_len, batch_size, -1)
+        return losses, torch.stack(z_ts), p_ts, bow_logits1, bow_logits2
+
+    @bf16_autocast
     def forward(self,
                 usr_input_sent,
                 sys_input_sent,
                 dialog_length_mask,
                 usr_input_mask,
                 sys_input_mask,
-                training=True):
+                training=True,
+                n_turns=None,
+                defer_bpr=False):
+        """n_turns: run this many turns instead of the ones of this batch, so
+        that the micro-batches of one step have the same turns. defer_bpr:
+        leave BPR's KL out of the losses and keep the priors and posteriors
+        of the turns in self.posteriors (see utils/accumulate.py).
+        """
+        config = self.config
         ########################## sentence embedding  ##################
         # print(usr_input_sent)
         # print(sys_input_sent)
+        input_sents = [usr_input_sent, sys_input_sent]
 
-        usr_input_embedding = self.embedding(
-            usr_input_sent)  # (16, 10, 40, 300)
-        usr_input_embedding = usr_input_embedding.view(
-            [-1, params.max_utt_len, params.embed_size])  # (160, 40, 300)
+        # only run the turns that are not padding in some dialog of the batch
+        batch_size, max_dialog_len = usr_input_sent.size(0), usr_input_sent.size(
+            1)
+        if n_turns is None:
+            n_turns = self.num_turns(usr_input_mask, sys_input_mask)
+        usr_input_sent = usr_input_sent[:, :n_turns]
+        sys_input_sent = sys_input_sent[:, :n_turns]
+        usr_input_mask = usr_input_mask[:, :n_turns]
+        sys_input_mask = sys_input_mask[:, :n_turns]
 
-        sys_input_embedding = self.embedding(
-            sys_input_sent)  # (16, 10, 40, 300)
-        sys_input_embedding = sys_input_embedding.view(
-            [-1, params.max_utt_len, params.embed_size])  # (160, 40, 300)
-
-        usr_sent_mask = torch.sign(usr_input_mask.view(
-            -1, params.max_utt_len))  # (160, 40)
-        sys_sent_mask = torch.sign(sys_input_mask.view(-1, params.max_utt_len))
-        usr_sent_len = torch.sum(usr_sent_mask, dim=1)  # (160)
-        sys_sent_len = torch.sum(sys_sent_mask, dim=1)
-        if params.cell_type == "gru":
-            usr_sent_embeddings, _ = self.sent_rnn(usr_input_embedding)
-            sys_sent_embeddings, _ = self.sent_rnn(sys_input_embedding)
-        else:
-            usr_sent_embeddings, (_, _) = self.sent_rnn(usr_input_embedding)
-            sys_sent_embeddings, (_, _) = self.sent_rnn(sys_input_embedding)
-
-        usr_sent_embedding = torch.zeros(
-            params.batch_size * params.max_dialog_len,
-            params.encoding_cell_size)
-        sys_sent_embedding = torch.zeros(
-            params.batch_size * params.max_dialog_len,
-            params.encoding_cell_size)
-        if params.use_cuda and torch.cuda.is_available():
-            usr_sent_embedding = usr_sent_embedding.cuda()
-            sys_sent_embedding = sys_sent_embedding.cuda()
-
-        for i in range(usr_sent_embedding.shape[0]):
-            if usr_sent_len[i] > 0:
-                usr_sent_embedding[i] = usr_sent_embeddings[i,
-                                                            usr_sent_len[i] -
-                                                            1, :]
-            if sys_sent_len[i] > 0:
-                sys_sent_embedding[i] = sys_sent_embeddings[i,
-                                                            sys_sent_len[i] -
-                                                            1, :]
-
-        usr_sent_embedding = usr_sent_embedding.view(
-            -1, params.max_dialog_len,
-            params.encoding_cell_size)  # (16, 10, 400)
-        sys_sent_embedding = sys_sent_embedding.view(
-            -1, params.max_dialog_len,
-            params.encoding_cell_size)  # (16, 10, 400)
-
-        if params.dropout not in (None, 0):
+        usr_sent_embedding, sys_sent_embedding = self.encode_sentences(
+            usr_input_sent, sys_input_sent, usr_input_mask,
+            sys_input_mask)  # (16, 10, 400)
+
+        if config.dropout not in (None, 0):
             usr_sent_embedding = self.dropout(usr_sent_embedding)
             sys_sent_embedding = self.dropout(sys_sent_embedding)
 
@@ -114,12 +247,16 @@ class LinearVRNN(nn.Module):
             dim=2)  # (batch, dialog_len, encoding_cell_size * 2) (16, 10, 800)
 
         # Pytorch-struct
-        if params.use_struct_attention:
+        if config.use_struct_attention:
             input_query = self.input_memory(joint_embedding)
-            input_query = input_query.view(params.batch_size, -1, 2,
-                                           200 + params.n_state)
+            input_query = input_query.view(batch_size, -1, 2,
+                                           200 + config.n_state)
+            # X^K dot X^{K+1} of every pair of adjacent turns, computed once
+            # per dialog batch and shared by all turns and decoder steps
+            input_potentials = input_query[:, :-1].matmul(
+                input_query[:, 1:].transpose(2, 3))  # (16, 9, 2, 2)
         else:
-            input_query = None
+            input_query = input_potentials = None
 
         ########################### state level ############################
         dec_input_embedding_usr = self.embedding(
@@ -138,97 +275,116 @@ class LinearVRNN(nn.Module):
 
         output_tokens = [usr_input_sent, sys_input_sent]
 
-        prev_z = torch.ones(params.batch_size, params.n_state)
-        elbo_ts = []
-        rc_losses = []
-        kl_losses = []
-        bow_losses = []
-        z_ts = []
-        p_ts = []
-        bow_logits_1 = []
-        bow_logits_2 = []
-        if params.cell_type == "gru":
-            state = torch.zeros(params.batch_size, params.state_cell_size)
-            if params.use_cuda and torch.cuda.is_available():
-                state = state.cuda()
+        device = joint_embedding.device
+        self.vae_cell.sampler.draw(n_turns, batch_size, config.n_state, device)
+        prev_z = self.workspace.ones((batch_size, config.n_state), device)
+        if config.cell_type == "gru":
+            state = self.workspace.zeros((batch_size, config.state_cell_size),
+                                         device)
         else:
-            h = c = torch.zeros(params.batch_size, params.state_cell_size)
-            if params.use_cuda and torch.cuda.is_available():
-                h = h.cuda()
-                c = c.cuda()
+            h = c = self.workspace.zeros((batch_size, config.state_cell_size),
+                                         device)
             state = (h, c)
-        for utt in range(params.max_dialog_len):
-            # print(utt)
-            # print("prev_z")
-            # print(prev_z)
-
-            inputs = joint_embedding[:, utt, :]
-            # print("input token")
-            # print(usr_input_sent[:, utt, :])
-            # print("input_embedding")
-            # print(inputs)
-
-            dec_input_emb = [
-                dec_input_embedding[0][:, utt, :, :],
-                dec_input_embedding[1][:, utt, :, :]
-            ]
-            dec_seq_len = [dec_seq_lens[0][:, utt], dec_seq_lens[1][:, utt]]
-            output_token = [
-                output_tokens[0][:, utt, :], output_tokens[1][:, utt, :]
-            ]
-
-            losses, z_samples, state, p_z, bow_logits1, bow_logits2 = self.vae_cell(
-                inputs,
-                state,
-                dec_input_emb,
-                dec_seq_len,
-                output_token,
-                prev_z_t=prev_z,
-                prev_embeddings=joint_embedding[:, :utt, :],
-                input_query=input_query)
-
-            shape = z_samples.size()
-            _, ind = z_samples.max(dim=-1)
-            zts_onehot = torch.zeros_like(z_samples).view(-1, shape[-1])
-            if params.use_cuda and torch.cuda.is_available():
-                zts_onehot = zts_onehot.cuda()
-            zts_onehot.scatter_(1, ind.view(-1, 1), 1)
-            zts_onehot = zts_onehot.view(*shape)
-            # stop gradient
-            zts_onehot = (zts_onehot - z_samples).detach() + z_samples
-            prev_z = zts_onehot
-            # TODO: check whether have converged to local minima
-
-            elbo_ts.append(losses[0])
-            rc_losses.append(losses[1])
-            kl_losses.append(losses[2])
-            bow_losses.append(losses[3])
-            z_ts.append(zts_onehot)
-            p_ts.append(p_z)
-            bow_logits_1.append(bow_logits1)
-            bow_logits_2.append(bow_logits2)
+
+        if config.two_phase_decode:
+            losses, z_ts, p_ts, bow_logits_1, bow_logits_2 = self.decode_all_turns(
+                joint_embedding, input_query, input_potentials,
+                dec_input_embedding, dec_seq_lens, output_tokens, state,
+                prev_z, defer_bpr=defer_bpr)
+            elbo_ts, rc_losses, kl_losses, bow_losses = losses
+        else:
+            elbo_ts = []
+            rc_losses = []
+            kl_losses = []
+            bow_losses = []
+            z_ts = []
+            p_ts = []
+            q_zs = []
+            bow_logits_1 = []
+            bow_logits_2 = []
+            for utt in range(n_turns):
+                # print(utt)
+                # print("prev_z")
+                # print(prev_z)
+
+                inputs = joint_embedding[:, utt, :]
+                # print("input token")
+                # print(usr_input_sent[:, utt, :])
+                # print("input_embedding")
+                # print(inputs)
+
+                dec_input_emb = [
+                    dec_input_embedding[0][:, utt, :, :],
+                    dec_input_embedding[1][:, utt, :, :]
+                ]
+                dec_seq_len = [dec_seq_lens[0][:, utt], dec_seq_lens[1][:, utt]]
+                output_token = [
+                    output_tokens[0][:, utt, :], output_tokens[1][:, utt, :]
+                ]
+                if config.use_struct_attention:
+                    query_prefix = input_query[:, :utt + 1]
+                    potentials_prefix = input_potentials[:, :utt]
+                else:
+                    query_prefix = potentials_prefix = None
+
+                losses, z_samples, state, p_z, q_z, bow_logits1, bow_logits2 = self.vae_cell(
+                    inputs,
+                    state,
+                    dec_input_emb,
+                    dec_seq_len,
+                    output_token,
+                    prev_z_t=prev_z,
+                    prev_embeddings=joint_embedding[:, :utt, :],
+                    input_query=query_prefix,
+                    input_potentials=potentials_prefix,
+                    defer_bpr=defer_bpr)
+
+                zts_onehot = onehot_straight_through(z_samples)
+                prev_z = zts_onehot
+                # TODO: check whether have converged to local minima
+
+                elbo_ts.append(losses[0])
+                rc_losses.append(losses[1])
+                kl_losses.append(losses[2])
+                bow_losses.append(losses[3])
+                z_ts.append(zts_onehot)
+                p_ts.append(p_z)
+                q_zs.append(q_z)
+                bow_logits_1.append(bow_logits1)
+                bow_logits_2.append(bow_logits2)
+
+            elbo_ts = torch.stack(elbo_ts)
+            rc_losses = torch.stack(rc_losses)
+            kl_losses = torch.stack(kl_losses)
+            bow_losses = torch.stack(bow_losses)
+
+            z_ts = torch.stack(z_ts)
+            p_ts = torch.stack(p_ts)
+            if defer_bpr:
+                self.posteriors = (p_ts, torch.stack(q_zs))
+            bow_logits_1 = torch.stack(bow_logits_1)
+            bow_logits_2 = torch.stack(bow_logits_2)
 
         mask_len = (torch.sum(usr_input_mask) + torch.sum(sys_input_mask))
-        elbo_ts = torch.stack(elbo_ts)
         elbo_t_avg = torch.sum(elbo_ts) / mask_len
-        rc_losses = torch.stack(rc_losses)
         rc_loss_avg = torch.sum(rc_losses) / mask_len
-        kl_losses = torch.stack(kl_losses)
         kl_loss_avg = torch.sum(kl_losses) / mask_len
-        bow_losses = torch.stack(bow_losses)
         bow_loss_avg = torch.sum(bow_losses) / mask_len
 
-        z_ts = torch.stack(z_ts)
-        p_ts = torch.stack(p_ts)
-        bow_logits_1 = torch.stack(bow_logits_1)
-        bow_logits_2 = torch.stack(bow_logits_2)
-
-        z_ts = z_ts.permute(1, 0, 2).cpu().detach().numpy()
-        p_ts = p_ts.permute(1, 0, 2).cpu().detach().numpy()
-        bow_logits_1 = bow_logits_1.permute(1, 0, 2).cpu().detach().numpy()
-        bow_logits_2 = bow_logits_2.permute(1, 0, 2).cpu().detach().numpy()
-
         if training:
             return elbo_t_avg, rc_loss_avg, kl_loss_avg, bow_loss_avg
-        else:
-            return usr_input_sent.cpu().detach().numpy(), sys_input_sent.cpu().detach().numpy(), z_ts, p_ts, bow_logits_1, bow_logits_2
+
+        # pad the skipped turns back to the fixed shape used by interpretion
+        turn_pad = (0, 0, 0, 0, 0, max_dialog_len - n_turns)
+        z_ts = F.pad(z_ts, turn_pad)
+        p_ts = F.pad(p_ts, turn_pad)
+        bow_logits_1 = F.pad(bow_logits_1, turn_pad)
+        bow_logits_2 = F.pad(bow_logits_2, turn_pad)
+
+        z_ts = z_ts.permute(1, 0, 2).float().cpu().detach().numpy()
+        p_ts = p_ts.permute(1, 0, 2).float().cpu().detach().numpy()
+        bow_logits_1 = bow_logits_1.permute(1, 0, 2).float().cpu().detach().numpy()
+        bow_logits_2 = bow_logits_2.permute(1, 0, 2).float().cpu().detach().numpy()
+
+        return input_sents[0].cpu().detach().numpy(), input_sents[1].cpu(
+        ).detach().numpy(), z_ts, p_ts, bow_logits_1, bow_logits_2
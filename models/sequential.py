@@ -1,8 +1,36 @@
+import sys
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as fn
 from torch.nn import init
 
+sys.path.append("..")
+import params
+
+
+def output_layer(input_size, config=params):
+    """Projection to the vocabulary: a Linear giving logits, or an adaptive
+    softmax head when config.adaptive_softmax is set.
+    """
+    if not config.adaptive_softmax:
+        return nn.Linear(input_size, config.max_vocab_cnt)
+    cutoffs = [
+        c for c in config.adaptive_softmax_cutoffs
+        if c < config.max_vocab_cnt - 1
+    ] or [config.max_vocab_cnt // 2]
+    return nn.AdaptiveLogSoftmaxWithLoss(input_size, config.max_vocab_cnt,
+                                         cutoffs)
+
+
+def project_bow(bow_project, bow_fc):
+    """BOW logits. An adaptive head gives normalized log-probabilities,
+    which the BOW loss takes like logits.
+    """
+    if isinstance(bow_project, nn.AdaptiveLogSoftmaxWithLoss):
+        return bow_project.log_prob(bow_fc)
+    return bow_project(bow_fc)
+
 
 class MLP(nn.Module):
 
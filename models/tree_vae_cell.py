@@ -4,65 +4,69 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from .sequential import MLP
+from .sequential import MLP, output_layer, project_bow
 sys.path.append("..")
-from utils.sample import gumbel_softmax
+from utils.sample import GumbelSampler
 from models.attention_module import Attn
+from utils.profiler import profiled
 import params
 
 
 class TreeVAECell(nn.Module):
 
-    def __init__(self, state_is_tuple=True):
+    def __init__(self, state_is_tuple=True, config=params):
         super(TreeVAECell, self).__init__()
 
+        self.config = config
         self._state_is_tuple = state_is_tuple
-        # temperature of gumbel_softmax
-        self.tau = nn.Parameter(torch.tensor([5.0]))
+        # temperature of gumbel_softmax, learned from config.temperature
+        self.tau = nn.Parameter(torch.tensor([float(config.temperature)]))
+        self.sampler = GumbelSampler(config=config)
 
-        self.enc_mlp = MLP(params.encoding_cell_size + params.state_cell_size,
+        self.enc_mlp = MLP(config.encoding_cell_size + config.state_cell_size,
                            [400, 200],
-                           dropout_rate=params.dropout)
-        self.enc_fc = nn.Linear(200, params.n_state)
-        self.dec_mlp = MLP(params.n_state, [200, 200],
-                           dropout_rate=params.dropout)
+                           dropout_rate=config.dropout)
+        self.enc_fc = nn.Linear(200, config.n_state)
+        self.dec_mlp = MLP(config.n_state, [200, 200],
+                           dropout_rate=config.dropout)
 
-        self.dec_rnn = nn.LSTMCell(params.embed_size, 200 + params.n_state)
+        self.dec_rnn = nn.LSTMCell(config.embed_size, 200 + config.n_state)
 
-        self.dec_fc = nn.Linear(200 + params.n_state, params.max_vocab_cnt)
+        self.dec_fc = output_layer(200 + config.n_state, config)
 
-        self.bow_fc = nn.Linear(params.state_cell_size + 200, 400)
-        self.bow_project = nn.Linear(400, params.max_vocab_cnt)
+        self.bow_fc = nn.Linear(config.state_cell_size + 200, 400)
+        self.bow_project = output_layer(400, config)
 
-        if params.with_direct_transition:
-            self.transit_mlp = MLP(params.n_state, [100, 100],
-                                   dropout_rate=params.dropout)
+        if config.with_direct_transition:
+            self.transit_mlp = MLP(config.n_state, [100, 100],
+                                   dropout_rate=config.dropout)
         else:
-            self.transit_mlp = MLP(params.state_cell_size, [100, 100],
-                                   dropout_rate=params.dropout)
-        self.transit_fc = nn.Linear(100, params.n_state)
+            self.transit_mlp = MLP(config.state_cell_size, [100, 100],
+                                   dropout_rate=config.dropout)
+        self.transit_fc = nn.Linear(100, config.n_state)
 
-        if params.cell_type == "gru":
-            self.state_rnn = nn.GRUCell(params.encoding_cell_size + 200,
-                                        params.state_cell_size)
+        if config.cell_type == "gru":
+            self.state_rnn = nn.GRUCell(config.encoding_cell_size + 200,
+                                        config.state_cell_size)
         else:
-            self.state_rnn = nn.LSTMCell(params.encoding_cell_size + 200,
-                                         params.state_cell_size)
-        if params.dropout not in (None, 0):
-            self.dropout = nn.Dropout(params.dropout)
-        if params.use_struct_attention:
-            self.attn = Attn(params.attention_type,
-                             params.state_cell_size + 200,
-                             params.encoding_cell_size * 2)
-            self.attn_fc = nn.Linear(params.encoding_cell_size * 2,
-                                     params.state_cell_size + 200)
+            self.state_rnn = nn.LSTMCell(config.encoding_cell_size + 200,
+                                         config.state_cell_size)
+        if config.dropout not in (None, 0):
+            self.dropout = nn.Dropout(config.dropout)
+        if config.use_struct_attention:
+            self.attn = Attn(config.attention_type,
+                             config.state_cell_size + 200,
+                             config.encoding_cell_size * 2)
+            self.attn_fc = nn.Linear(config.encoding_cell_size * 2,
+                                     config.state_cell_size + 200)
         else:
-            self.attn = Attn(params.attention_type,
-                             params.state_cell_size + 200,
-                             params.encoding_cell_size)
-            self.attn_fc = nn.Linear(params.encoding_cell_size,
-                                     params.state_cell_size + 200)
+            self.attn = Attn(config.attention_type,
+                             config.state_cell_size + 200,
+                             config.encoding_cell_size)
+            self.attn_fc = nn.Linear(config.encoding_cell_size,
+                                     config.state_cell_size + 200)
 
+    @profiled("vae_cell.encode")
     def encode(self, inputs, h_prev):
         enc_inputs = torch.cat([h_prev, inputs],
                                1)  # [batch, sen_hidden_dim + state_cell_size]
@@ -73,12 +77,14 @@ class TreeVAECell(nn.Module):
 
         return logits_z, q_z, log_q_z
 
+    @profiled("decoder")
     def decode(self,
                z_samples,
                h_prev,
                dec_input_embedding,
                prev_embeddings=None,
                tgt_index=None):
+        config = self.config
         net2 = self.dec_mlp(z_samples)  # [batch, 200]
         # decoder for user utterance
         dec_input = torch.cat([h_prev, net2],
@@ -87,28 +93,34 @@ class TreeVAECell(nn.Module):
         # use standard attention for decoding
         h = dec_input
         dec_outs = []
+        # the keys of the attention are the same at every step
+        attend = self.attn.prepare(prev_embeddings, tgt_index)
         for i in range(dec_input_embedding.shape[1]):
-            context = self.attn(h, prev_embeddings, tgt_index)
+            context = attend(h)
             h, c = self.dec_rnn(dec_input_embedding[:, i, :],
                                 (h, self.attn_fc(context)))
             dec_outs.append(h)
-        if params.dropout not in (None, 0):
-            dec_outs = self.dropout(torch.stack(dec_outs))
-        dec_outs = self.dec_fc(dec_outs)
+        # batch-major like the targets, [batch, dec_steps, dec_cell_size]
+        dec_outs = torch.stack(dec_outs, dim=1)
+        if config.dropout not in (None, 0):
+            dec_outs = self.dropout(dec_outs)
+        if not config.adaptive_softmax:
+            dec_outs = self.dec_fc(dec_outs)
 
         # for computing BOW loss
         bow_logits = None
-        if params.with_BOW:
-            bow_fc = self.bow_fc(torch.squeeze(dec_input, dim=0))
+        if config.with_BOW:
+            bow_fc = self.bow_fc(dec_input)
             bow_fc = torch.tanh(bow_fc)
-            if params.dropout not in (None, 0):
+            if config.dropout not in (None, 0):
                 bow_fc = self.dropout(bow_fc)
-            bow_logits = self.bow_project(bow_fc)  # [batch_size, vocab_size]
+            bow_logits = project_bow(self.bow_project,
+                                     bow_fc)  # [batch_size, vocab_size]
 
         return dec_outs, bow_logits
 
     def forward(self, inputs, state, prev_z_t=None):
-        if params.with_direct_transition:
+        if self.config.with_direct_transition:
             assert prev_z_t is not None
         if self._state_is_tuple:
             (h_prev, _) = state
@@ -118,12 +130,12 @@ class TreeVAECell(nn.Module):
         logits_z, q_z, log_q_z = self.encode(inputs, h_prev)
 
         # sample
-        z_samples, logits_z_samples = gumbel_softmax(
+        z_samples, logits_z_samples = self.sampler(
             logits_z, self.tau, hard=False)  # [batch, n_state]
 
         net2 = self.dec_mlp(z_samples)  # [batch, 200]
 
-        if params.with_direct_transition:
+        if self.config.with_direct_transition:
             net3 = self.transit_mlp(prev_z_t)
             p_z = self.transit_fc(net3)
             p_z = F.softmax(p_z, dim=1)
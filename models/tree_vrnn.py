@@ -13,8 +13,10 @@ sys.path.append("..")
 import params
 from .tree_vae_cell import TreeVAECell
 from utils.loss import BPR_BOW_loss_single
-
-import torch_struct
+from utils.workspace import Workspace
+from utils.precision import bf16_autocast
+from utils.profiler import profiled
+from utils.matrix_tree import dependency_tree_marginals
 
 
 def show_deps(tree):
@@ -22,113 +24,153 @@ def show_deps(tree):
 
 
 class TreeVRNN(nn.Module):
-
-    def __init__(self):
+    """config: the settings of the model, the params module by default (see
+    utils/config.py).
+    """
+    def __init__(self, config=params):
         super(TreeVRNN, self).__init__()
 
-        self.embedding = nn.Embedding(params.max_vocab_cnt, params.embed_size)
+        self.config = config
+        self.embedding = nn.Embedding(config.max_vocab_cnt, config.embed_size)
 
-        if params.cell_type == "gru":
-            self.sent_rnn = nn.GRU(params.embed_size,
-                                   params.encoding_cell_size,
-                                   params.num_layer,
+        if config.cell_type == "gru":
+            self.sent_rnn = nn.GRU(config.embed_size,
+                                   config.encoding_cell_size,
+                                   config.num_layer,
                                    batch_first=True)
-            self.vae_cell = TreeVAECell(state_is_tuple=False)
+            self.vae_cell = TreeVAECell(state_is_tuple=False, config=config)
         else:
-            self.sent_rnn = nn.LSTM(params.embed_size,
-                                    params.encoding_cell_size,
-                                    params.num_layer,
+            self.sent_rnn = nn.LSTM(config.embed_size,
+                                    config.encoding_cell_size,
+                                    config.num_layer,
                                     batch_first=True)
-            self.vae_cell = TreeVAECell(state_is_tuple=True)
-        if params.dropout not in (None, 0):
-            self.dropout = nn.Dropout(params.dropout)
-        self.W_1 = nn.Parameter(torch.rand(200, params.encoding_cell_size))
-        self.W_2 = nn.Parameter(torch.rand(200, params.encoding_cell_size))
+            self.vae_cell = TreeVAECell(state_is_tuple=True, config=config)
+        if config.dropout not in (None, 0):
+            self.dropout = nn.Dropout(config.dropout)
+        self.W_1 = nn.Parameter(torch.rand(200, config.encoding_cell_size))
+        self.W_2 = nn.Parameter(torch.rand(200, config.encoding_cell_size))
         self.b = nn.Parameter(torch.zeros(200))
         self.s = nn.Parameter(torch.rand(200))
-        self.root = nn.Parameter(torch.zeros(params.encoding_cell_size))
-
-    def forward(self,
-                enc_batch,
-                enc_lens,
-                dec_batch,
-                target_batch,
-                padding_mask,
-                tgt_index,
-                training=True):
-        ########################## sentence embedding  ##################
+        self.root = nn.Parameter(torch.zeros(config.encoding_cell_size))
+        self.workspace = Workspace()
+        # (p_z, q_z) of the target turns of the last forward with defer_bpr
+        self.posteriors = None
+
+    @staticmethod
+    def num_turns(tgt_index):
+        """The turns after the last target turn of the batch are never used.
+        """
+        return int(torch.max(tgt_index)) + 1
+
+    @profiled("sentence_encoding")
+    def encode_sentences(self, enc_batch, enc_lens):
+        """Last RNN state of every utterance, [batch, turns, encoding_cell_size]
+        """
+        config = self.config
+        batch_size, n_turns = enc_batch.size(0), enc_batch.size(1)
         input_embedding = self.embedding(enc_batch)  # (5, 9, 50, 300)
 
         input_embedding = input_embedding.view(
-            [-1, params.max_enc_steps, params.embed_size])  # (45, 50, 300)
+            [-1, enc_batch.size(2), config.embed_size])  # (45, 50, 300)
 
-        if params.cell_type == "gru":
+        if config.cell_type == "gru":
             sent_embeddings, _ = self.sent_rnn(input_embedding)
         else:
             sent_embeddings, (_, _) = self.sent_rnn(
                 input_embedding)  # (45, 50, 400)
 
-        sent_embedding = torch.zeros(params.batch_size * params.max_dialog_len,
-                                     params.encoding_cell_size)
-
-        if params.use_cuda and torch.cuda.is_available():
-            sent_embedding = sent_embedding.cuda()
+        sent_embedding = torch.zeros(batch_size * n_turns,
+                                     config.encoding_cell_size,
+                                     device=enc_batch.device)
 
         for i in range(sent_embedding.shape[0]):
             if enc_lens[i] > 0:
                 sent_embedding[i] = sent_embeddings[i, enc_lens[i] - 1, :]
 
-        sent_embedding = sent_embedding.view(
-            -1, params.max_dialog_len, params.encoding_cell_size)  # (5, 9, 400)
+        return sent_embedding.view(-1, n_turns,
+                                   config.encoding_cell_size)  # (5, 9, 400)
+
+    @profiled("tree_log_potentials")
+    def tree_log_potentials(self, sent_embedding, tgt_index):
+        """Arc scores of the dependency tree over the turns of each dialog,
+        [batch, turns, turns]: tanh(s . tanh(W_1 e_i + W_2 e_j + b)) for
+        i <= j <= tgt_index, 0 elsewhere. The diagonal (the root scores of
+        the CRF) is the arc score of a turn with itself.
+        """
+        n_turns = sent_embedding.size(1)
+        heads = sent_embedding.matmul(self.W_1.t())  # (5, 9, 200)
+        deps = sent_embedding.matmul(self.W_2.t())
+        scores = torch.tanh(
+            torch.tanh(heads.unsqueeze(2) + deps.unsqueeze(1) +
+                       self.b).matmul(self.s))  # (5, 9, 9)
+        turns = torch.arange(n_turns, device=sent_embedding.device)
+        mask = (turns.view(-1, 1) <= turns.view(1, -1)).unsqueeze(0) & (
+            turns.view(1, 1, -1) <= tgt_index.view(-1, 1, 1))
+        return scores.masked_fill(~mask, 0)
+
+    @bf16_autocast
+    def forward(self,
+                enc_batch,
+                enc_lens,
+                dec_batch,
+                target_batch,
+                padding_mask,
+                tgt_index,
+                training=True,
+                n_turns=None,
+                defer_bpr=False):
+        """n_turns: run this many turns instead of the ones of this batch, so
+        that the micro-batches of one step have the same dependency trees.
+        defer_bpr: leave BPR's KL out of the losses and keep the priors and
+        posteriors of the target turns in self.posteriors (see
+        utils/accumulate.py).
+        """
+        config = self.config
+        ########################## sentence embedding  ##################
+        batch_size, max_dialog_len = enc_batch.size(0), enc_batch.size(1)
+        if n_turns is None:
+            n_turns = self.num_turns(tgt_index)
+        input_sents = enc_batch
+        enc_batch = enc_batch[:, :n_turns]
+        enc_lens = enc_lens.view(-1, max_dialog_len)[:, :n_turns].reshape(-1)
+
+        device = enc_batch.device
+        sent_embedding = self.encode_sentences(enc_batch, enc_lens)
 
-        if params.dropout not in (None, 0):
+        if config.dropout not in (None, 0):
             sent_embedding = self.dropout(sent_embedding)
 
         ########################### state level ############################
         dec_input_embedding = self.embedding(dec_batch)  # (5, 50, 300)
 
-        prev_z = torch.ones(params.batch_size, params.n_state)
+        self.vae_cell.sampler.draw(n_turns, batch_size, config.n_state, device)
+        prev_z = self.workspace.ones((batch_size, config.n_state), device)
 
-        z_samples_list = []
-        h_list = []
+        # per turn: h, z_samples, p_z, q_z, log_p_z, log_q_z side by side
+        turn_states = []
         z_onehot_list = []
-        p_z_list = []
-        q_z_list = []
-        log_p_z_list = []
-        log_q_z_list = []
-
-        if params.cell_type == "gru":
-            state = torch.zeros(params.batch_size, params.state_cell_size)
-            if params.use_cuda and torch.cuda.is_available():
-                state = state.cuda()
+
+        if config.cell_type == "gru":
+            state = self.workspace.zeros((batch_size, config.state_cell_size),
+                                         device)
         else:
-            h = c = torch.zeros(params.batch_size, params.state_cell_size)
-            if params.use_cuda and torch.cuda.is_available():
-                h = h.cuda()
-                c = c.cuda()
+            h = c = self.workspace.zeros((batch_size, config.state_cell_size),
+                                         device)
             state = (h, c)
 
-        for utt in range(params.max_dialog_len):
+        for utt in range(n_turns):
             inputs = sent_embedding[:, utt, :]
 
             z_samples, state, p_z, q_z, log_p_z, log_q_z = self.vae_cell(
                 inputs, state, prev_z_t=prev_z)
             # save the previous state
-            z_samples_list.append(z_samples)
-            if params.cell_type == "gru":
-                h_list.append(state)
-            else:
-                h_list.append(state[0])
-            p_z_list.append(p_z)
-            q_z_list.append(q_z)
-            log_p_z_list.append(log_p_z)
-            log_q_z_list.append(log_q_z)
+            h = state if config.cell_type == "gru" else state[0]
+            turn_states.append(
+                torch.cat([h, z_samples, p_z, q_z, log_p_z, log_q_z], dim=1))
 
             shape = z_samples.size()
             _, ind = z_samples.max(dim=-1)
             zts_onehot = torch.zeros_like(z_samples).view(-1, shape[-1])
-            if params.use_cuda and torch.cuda.is_available():
-                zts_onehot = zts_onehot.cuda()
             zts_onehot.scatter_(1, ind.view(-1, 1), 1)
             zts_onehot = zts_onehot.view(*shape)
             # stop gradient
@@ -138,77 +180,29 @@ class TreeVRNN(nn.Module):
             z_onehot_list.append(zts_onehot)
 
         # decode
-        # pick tgt_idx from encoder
-        h_prev = torch.zeros(params.batch_size, params.n_state)
-        z_samples_dec = torch.zeros(params.batch_size, params.n_state)
-        p_z_dec = torch.zeros(params.batch_size, params.n_state)
-        q_z_dec = torch.zeros(params.batch_size, params.n_state)
-        log_p_z_dec = torch.zeros(params.batch_size, params.n_state)
-        log_q_z_dec = torch.zeros(params.batch_size, params.n_state)
-        if params.use_cuda and torch.cuda.is_available():
-            h_prev = h_prev.cuda()
-            z_samples_dec = z_samples_dec.cuda()
-            p_z_dec = p_z_dec.cuda()
-            q_z_dec = q_z_dec.cuda()
-            log_p_z_dec = log_p_z_dec.cuda()
-            log_q_z_dec = log_q_z_dec.cuda()
-        for i in range(params.batch_size):
-            h_prev[i, :] = h_list[tgt_index[i]][i, :]
-            z_samples_dec[i, :] = z_samples_list[tgt_index[i]][i, :]
-            p_z_dec[i, :] = p_z_list[tgt_index[i]][i, :]
-            q_z_dec[i, :] = q_z_list[tgt_index[i]][i, :]
-            log_p_z_dec[i, :] = p_z_list[tgt_index[i]][i, :]
-            log_q_z_dec[i, :] = log_q_z_list[tgt_index[i]][i, :]
+        # pick the tgt_idx turn of every dialog in one gather
+        turn_states = torch.stack(turn_states)  # [n_turns, batch, ...]
+        state_sizes = [config.state_cell_size] + [config.n_state] * 5
+        (h_prev, z_samples_dec, p_z_dec, q_z_dec, log_p_z_dec,
+         log_q_z_dec) = torch.split(
+             turn_states[tgt_index,
+                         torch.arange(batch_size, device=device)],
+             state_sizes,
+             dim=1)
 
         # Calculate non-projective dependency tree structured attention
-        log_potentials = torch.zeros(params.batch_size, params.max_dialog_len,
-                                     params.max_dialog_len)
-        for b in range(params.batch_size):
-            for i in range(params.max_dialog_len):
-                for j in range(params.max_dialog_len):
-                    if i == j:
-                        if i > tgt_index[b]:
-                            log_potentials[b, i, j] = 0
-                        else:
-                            log_potentials[b, i, j] = torch.tanh(
-                                torch.dot(
-                                    self.s,
-                                    torch.tanh(
-                                        self.W_1.matmul(self.root) +
-                                        self.W_2.matmul(sent_embedding[b,
-                                                                       i, :]) +
-                                        self.b)))
-                    if i > j:
-                        log_potentials[b, i, j] = 0
-                    else:
-                        if j > tgt_index[b]:
-                            log_potentials[b, i, j] = 0
-                        else:
-                            log_potentials[b, i, j] = torch.tanh(
-                                torch.dot(
-                                    self.s,
-                                    torch.tanh(
-                                        self.W_1.matmul(sent_embedding[b,
-                                                                       i, :]) +
-                                        self.W_2.matmul(sent_embedding[b,
-                                                                       j, :]) +
-                                        self.b)))
-        dist = torch_struct.NonProjectiveDependencyCRF(log_potentials)
-        # show_deps(dist.marginals[0])
+        log_potentials = self.tree_log_potentials(sent_embedding, tgt_index)
+        # the trees span the turns up to the target one, the later turns are
+        # padding and take no probability mass
+        marginals = dependency_tree_marginals(log_potentials, tgt_index + 1)
+        # show_deps(marginals[0])
         # plt.show()
 
-        context_embedding = torch.zeros_like(sent_embedding)
-        if params.use_cuda and torch.cuda.is_available():
-            context_embedding = context_embedding.cuda()
-
-        for j in range(params.max_dialog_len):
-            # print(dist.marginals[b, :, j].shape)
-            # print(sent_embedding[b, :, :].shape)
-            context_embedding[:,
-                              j, :] = dist.marginals[:, :, j].unsqueeze(1).bmm(
-                                  sent_embedding[:, :, :]).squeeze(1)
+        # expected head embedding of every turn, [batch, turns, encoding_size]
+        context_embedding = marginals.transpose(1, 2).bmm(sent_embedding).to(
+            sent_embedding.dtype)
 
-        if params.use_struct_attention:
+        if config.use_struct_attention:
             sent_embedding = torch.cat((sent_embedding, context_embedding),
                                        dim=2)
         dec_outs, bow_logits = self.vae_cell.decode(
@@ -225,7 +219,12 @@ class TreeVRNN(nn.Module):
             log_q_z_dec,
             p_z_dec,
             q_z_dec,
-            bow_logits=bow_logits)
+            bow_logits=bow_logits,
+            dec_head=self.vae_cell.dec_fc if config.adaptive_softmax else None,
+            defer_bpr=defer_bpr,
+            config=self.config)
+        if defer_bpr:
+            self.posteriors = (p_z_dec, q_z_dec)
 
         mask_len = torch.sum(padding_mask)
         elbo_t_avg = elbo_t / mask_len
@@ -233,13 +232,16 @@ class TreeVRNN(nn.Module):
         kl_loss_avg = kl_loss / mask_len
         bow_loss_avg = bow_loss / mask_len
 
-        z_ts = torch.stack(z_onehot_list)
-        p_ts = torch.stack(p_z_list)
-        z_ts = z_ts.permute(1, 0, 2).cpu().detach().numpy()
-        p_ts = p_ts.permute(1, 0, 2).cpu().detach().numpy()
-        bow_logits = bow_logits.cpu().detach().numpy()
-
         if training:
             return elbo_t_avg, rc_loss_avg, kl_loss_avg, bow_loss_avg
-        else:
-            return enc_batch.cpu().detach().numpy(), z_ts, p_ts, bow_logits
+
+        # pad the skipped turns back to max_dialog_len
+        turn_pad = (0, 0, 0, 0, 0, max_dialog_len - n_turns)
+        z_ts = F.pad(torch.stack(z_onehot_list), turn_pad)
+        p_ts = F.pad(torch.split(turn_states, state_sizes, dim=2)[2],
+                     turn_pad)
+        z_ts = z_ts.permute(1, 0, 2).float().cpu().detach().numpy()
+        p_ts = p_ts.permute(1, 0, 2).float().cpu().detach().numpy()
+        bow_logits = bow_logits.float().cpu().detach().numpy()
+
+        return input_sents.cpu().detach().numpy(), z_ts, p_ts, bow_logits
@@ -33,7 +33,8 @@ eval_num = 100  # number of samples to evaluate
 
 # linear_vae config
 n_state = 10  # Number of states.with open(FLAGS.result_path, "w") as fh:
-temperature = 0.5  # temperature for gumbel softmax
+temperature = 5.0  # initial temperature for gumbel softmax, learned with the model
+gumbel_seed = None  # seed of the gumbel noise stream, None to follow the torch seed
 
 # Network general
 cell_type = "lstm"  # gru or lstm
@@ -45,6 +46,10 @@ max_dialog_len = 13  # max number of turns in a dialog
 num_layer = 1  # number of context RNN layers
 use_struct_attention = True
 attention_type = "concat"  #dot, general, concat
+two_phase_decode = False  # run the state recurrence first, then decode all turns in one batch
+adaptive_softmax = False  # adaptive softmax heads for the decoders and BOW, word ids must be sorted by frequency
+adaptive_softmax_cutoffs = [2000, 10000]  # cluster boundaries, the ones >= max_vocab_cnt are dropped
+use_bf16 = False  # run RNNs and projections under CPU bf16 autocast, losses and CRF marginals stay fp32
 
 # Optimization parameters
 op = "adam"  # adam, rmsprop, sgd
@@ -58,6 +63,14 @@ improve_threshold = 0.996  # for early stopping
 patient_increase = 2.0  # for early stopping
 early_stop = True
 grad_noise = 0.0  # inject gradient noise?
+grad_accum_steps = 1  # micro-batches of batch_size per optimizer step, e.g. 20 for an effective batch of 320 with batch_size 16
+print_loss_every = 1  # steps between the training loss reports of train_linear_vrnn.py
+loss_window = 100  # number of steps of the windowed loss statistics
+loss_ema_decay = 0.99  # decay of the loss moving average
+ckpt_every = 500  # training steps between rolling mid-epoch checkpoints, 0 to disable
+keep_checkpoints = 3  # number of rolling checkpoints kept on disk
+summary_queue_size = 10000  # events the background TensorBoard writer can hold
+summary_queue_policy = "drop"  # drop or block new scalars when that queue is full
 
 with_BOW = True
 kl_loss_weight = 1  # weight of the kl_loss
@@ -65,31 +78,4 @@ bow_loss_weight = 0.5  # weight of the bow_loss
 with_label_loss = False  # semi-supervised or not
 with_BPR = True
 with_direct_transition = False  # direct prior transition prob
-with_word_weights = False
-
-if with_word_weights:
-    with open(rev_vocab_dir, "r") as fh:
-        rev_vocab = pkl.load(fh)
-
-    slot_value_id_list = []
-    for k, v in rev_vocab.items():
-        # print(type(k))
-        if ("slot_" in k) or ("value_" in k):
-            #print(k)
-            slot_value_id_list.append(v)
-
-    multiply_factor = 3
-    one_weight = 1.0 / (len(rev_vocab) +
-                        (multiply_factor - 1) * len(slot_value_id_list))
-    word_weights = [one_weight] * len(rev_vocab)
-    for i in slot_value_id_list:
-        word_weights[i] = multiply_factor * word_weights[i]
-
-    sum_word_weights = np.sum(word_weights)
-    # print(sum_word_weights)
-    # print(type(sum_word_weights))
-    assert (sum_word_weights == float(1.0))
-    word_weights = list(len(rev_vocab) * np.array(word_weights))
-
-else:
-    word_weights = None
+with_word_weights = False  # weigh the slot and value words of rev_vocab_dir 3x in the losses, see utils/config.py
@@ -10,14 +10,24 @@ import inspect
 import pickle as pkl
 import torch
 from torch import nn, optim
-from torch.utils.tensorboard import SummaryWriter
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import numpy as np
 from beeprint import pp
 
 from models.linear_vrnn import LinearVRNN
 from data_apis.data_utils import SWDADataLoader
 from data_apis.SWDADialogCorpus import SWDADialogCorpus
-from utils.loss import print_loss
+from utils.loss import print_loss, bpr_kl_loss
+from utils.accumulate import GradientAccumulator
+from utils import profiler
+from utils.profiler import stage
+from utils.metrics import Metrics
+from utils.summary import AsyncSummaryWriter
+from utils.checkpoint import CheckpointManager, rng_state, set_rng_state
+from utils.distributed import (get_rank, get_world_size, is_master,
+                               broadcast_parameters, all_reduce_gradients,
+                               all_reduce_sum)
 import params
 
 
@@ -48,51 +58,79 @@ def get_dataset(device):
         return train_loader, valid_loader, test_loader, None
 
 
-def train(model, train_loader, optimizer, writer, epoch):
-    elbo_t = []
-    rc_loss = []
-    kl_loss = []
-    bow_loss = []
+def train(model,
+          train_loader,
+          optimizer,
+          writer,
+          epoch,
+          save_checkpoint=None):
     local_t = 0
     start_time = time.time()
     loss_names = ["elbo_t", "rc_loss", "kl_loss", "bow_loss"]
+    metrics = Metrics(loss_names,
+                      window=params.loss_window,
+                      ema_decay=params.loss_ema_decay,
+                      report_every=params.print_loss_every)
     model.train()
 
     while True:
-        optimizer.zero_grad()
-        batch = train_loader.next_batch()
-        if batch is None:
+        # one optimizer step over grad_accum_steps micro-batches
+        micro_batches = []
+        for _ in range(params.grad_accum_steps):
+            with stage("next_batch"):
+                batch = train_loader.next_batch()
+            if batch is None:
+                break
+            micro_batches.append(batch)
+        if not micro_batches:
             break
         local_t += 1
-        loss = model(*batch)
-        # use .data to free the loss Variable
-        elbo_t.append(loss[0].data)
-        rc_loss.append(loss[1].data)
-        kl_loss.append(loss[2].data)
-        bow_loss.append(loss[3].data)
-        writer.add_scalars(
-            'Loss/train', {
-                'elbo_t': loss[0].data,
-                'rc_loss': loss[1].data,
-                'kl_loss': loss[2].data,
-                'bow_loss': loss[3].data
-            }, epoch * train_loader.num_batch + local_t)
-        loss[0].backward(
-        )  # loss[0] = elbo_t = rc_loss + weight_kl * kl_loss + weight_bow * bow_loss
-        optimizer.step()
+        optimizer.zero_grad()
+        # batch[3], batch[4]: usr_input_mask, sys_input_mask
+        n_turns = max(model.num_turns(b[3], b[4]) for b in micro_batches)
+        num_tokens = [torch.sum(b[3]) + torch.sum(b[4]) for b in micro_batches]
+        accumulator = GradientAccumulator(model, bpr_kl_loss,
+                                          sum(num_tokens), len(micro_batches))
+        for batch, batch_num_tokens in zip(micro_batches, num_tokens):
+            # loss[0] = elbo_t = rc_loss + weight_kl * kl_loss + weight_bow * bow_loss
+            with stage("forward"):
+                loss = model(*batch,
+                             n_turns=n_turns,
+                             defer_bpr=accumulator.defer_bpr)
+            accumulator.backward(loss, batch_num_tokens)
+        loss = accumulator.finish()
+        metrics.update(loss)
+        if writer is not None:
+            writer.add_scalars('Loss/train',
+                               dict(zip(loss_names, loss)),
+                               epoch * train_loader.num_batch + train_loader.ptr)
+        with stage("all_reduce_gradients"):
+            all_reduce_gradients(model)
+        with stage("optimizer_step"):
+            optimizer.step()
+
+        step = -(-train_loader.ptr // params.grad_accum_steps)
+        # the end of the epoch is saved by main() after its validation
+        if (save_checkpoint is not None and params.ckpt_every
+                and step % params.ckpt_every == 0
+                and train_loader.ptr < train_loader.num_batch):
+            save_checkpoint("last_%d_%d.pt" % (epoch, train_loader.ptr))
 
         # if local_t % (train_loader.num_batch // 20) == 0:
-        print_loss("%.2f" % (train_loader.ptr / float(train_loader.num_batch)),
-                   loss_names, [elbo_t, rc_loss, kl_loss, bow_loss],
-                   postfix='')
+        if is_master() and metrics.should_report():
+            print_loss(
+                "%.2f" % (train_loader.ptr / float(train_loader.num_batch)),
+                loss_names, metrics,
+                postfix='')
     # finish epoch!
     epoch_time = time.time() - start_time
-    print_loss("Epoch Done", loss_names, [elbo_t, rc_loss, kl_loss, bow_loss],
-               "step time %.4f" % (epoch_time / train_loader.num_batch))
+    if is_master():
+        print_loss("Epoch Done", loss_names, metrics,
+                   "step time %.4f" % (epoch_time / max(local_t, 1)))
 
 
 def valid(model, valid_loader, writer, epoch):
-    elbo_t = []
+    elbo_t_sum = 0.0
     model.eval()
     local_t = 0
     while True:
@@ -101,22 +139,31 @@ def valid(model, valid_loader, writer, epoch):
             break
         local_t += 1
         loss = model(*batch)
-        elbo_t.append(loss[0].data)
-        writer.add_scalar('Loss/valid/elbo_t', loss[0].data,
-                          epoch * valid_loader.num_batch + local_t)
+        elbo_t_sum += loss[0].item()
+        if writer is not None:
+            writer.add_scalar('Loss/valid/elbo_t', loss[0].data,
+                              epoch * valid_loader.num_batch + local_t)
 
-    print_loss("Valid", ["elbo_t"], [elbo_t], "")
-    return torch.mean(torch.stack(elbo_t))
+    # the mean over the batches of all workers, a worker without validation
+    # batches adds nothing to either sum
+    totals = all_reduce_sum(
+        torch.tensor([elbo_t_sum, local_t], dtype=torch.float64))
+    valid_loss = (totals[0] / totals[1]).float()
+    if is_master():
+        print_loss("Valid", ["elbo_t"], [[valid_loss]], "")
+    return valid_loss
 
 
 def decode(model, data_loader):
     results = []
     model.eval()
     while True:
-        batch = data_loader.next_batch()
+        with stage("next_batch"):
+            batch = data_loader.next_batch()
         if batch is None:
             break
-        result = model(*batch, training=False)
+        with stage("forward"):
+            result = model(*batch, training=False)
         results.append(result)
     return results
 
@@ -164,19 +211,61 @@ def main(args):
                         help='Not saving checkpoints')
     parser.set_defaults(save_model=True)
 
+    parser.add_argument('--profile',
+                        dest='profile',
+                        action='store_true',
+                        help='Time the stages of every step, print a table '
+                        'and write a Chrome trace to the log directory')
+    parser.set_defaults(profile=False)
+
+    parser.add_argument(
+        '--num_workers',
+        default=1,
+        type=int,
+        help='Number of data-parallel CPU training processes (gloo)')
+
     args = parser.parse_args(args)
     print(args)
     pp(params)
 
-    # set random seeds
+    if not (args.forward_only or args.resume):
+        args.ckpt_dir = "run" + str(int(time.time()))
+
+    if args.num_workers > 1:
+        assert not args.forward_only, "decoding runs in a single process"
+        # fork, so the workers see params as set up by the caller
+        result_queue = mp.get_context("fork").SimpleQueue()
+        mp.start_processes(run,
+                           args=(args, result_queue),
+                           nprocs=args.num_workers,
+                           start_method="fork")
+        return result_queue.get()
+    return run(0, args)
+
+
+def run(rank, args, result_queue=None):
+    if args.num_workers > 1:
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        os.environ.setdefault("MASTER_PORT", "29500")
+        dist.init_process_group("gloo",
+                                rank=rank,
+                                world_size=args.num_workers)
+        # share the cores between the workers
+        torch.set_num_threads(
+            max(1,
+                torch.get_num_threads() // args.num_workers))
+
+    # set random seeds, the data order is the same in every worker and the
+    # gumbel and dropout noise differs
     seed = params.seed
     random.seed(seed)
     np.random.seed(seed + 1)
-    torch.manual_seed(seed + 2)
+    torch.manual_seed(seed + 2 + rank)
 
     print("Available GPUs: %d" % torch.cuda.device_count())
     sys.stdout.flush()
-    use_cuda = params.use_cuda and torch.cuda.is_available()
+    use_cuda = params.use_cuda and torch.cuda.is_available(
+    ) and get_world_size() == 1
     if use_cuda:
         assert params.gpu_idx < torch.cuda.device_count(
         ), "params.gpu_idx must be one of the available GPUs"
@@ -189,16 +278,20 @@ def main(args):
         print("Using CPU for training")
 
     train_loader, valid_loader, test_loader, word2vec = get_dataset(device)
+    if args.profile:
+        profiler.enable(sync=device.type == "cuda")
 
+    log_dir = os.path.join(params.log_dir, "linear_vrnn", args.ckpt_dir)
     if args.forward_only or args.resume:
-        log_dir = os.path.join(params.log_dir, "linear_vrnn", args.ckpt_dir)
         checkpoint_path = os.path.join(log_dir, args.ckpt_name)
-    else:
-        ckpt_dir = "run" + str(int(time.time()))
-        log_dir = os.path.join(params.log_dir, "linear_vrnn", ckpt_dir)
-    os.makedirs(log_dir, exist_ok=True)
-    print("Writing logs to %s" % log_dir)
-    writer = SummaryWriter(log_dir=log_dir)
+    writer = None
+    ckpt_manager = None
+    if is_master():
+        os.makedirs(log_dir, exist_ok=True)
+        print("Writing logs to %s" % log_dir)
+        writer = AsyncSummaryWriter(log_dir=log_dir)
+        ckpt_manager = CheckpointManager(log_dir,
+                                         keep_last=params.keep_checkpoints)
 
     model = LinearVRNN().to(device)
     if params.op == "adam":
@@ -217,7 +310,7 @@ def main(args):
                                         freeze=False)
 
     # # write config to a file for logging
-    if not args.forward_only:
+    if not args.forward_only and is_master():
         #     with open(os.path.join(log_dir, "run.log"), "w") as f:
         #         f.write(pp(params, output=False))
         variables = dir(params)
@@ -233,19 +326,50 @@ def main(args):
 
         writer.add_text('Hyperparameters', pp(params, output=False))
 
+    patience = params.max_epoch
+    dev_loss_threshold = np.inf
+    best_dev_loss = np.inf
     last_epoch = 0
     if args.resume:
         print("Resuming training from %s" % checkpoint_path)
         sys.stdout.flush()
-        state = torch.load(checkpoint_path, map_location=device)
+        state = torch.load(checkpoint_path,
+                           map_location=device,
+                           weights_only=False)
         model.load_state_dict(state['state_dict'])
         optimizer.load_state_dict(state['optimizer'])
         last_epoch = state['epoch']
+        if 'loader' in state:
+            # continue from the batch after the checkpoint
+            train_loader.load_state_dict(state['loader'], shard_index=rank)
+            # saved at the end of the epoch, after its validation
+            if train_loader.ptr >= train_loader.num_batch:
+                last_epoch += 1
+            patience = state['patience']
+            dev_loss_threshold = state['dev_loss_threshold']
+            best_dev_loss = state['best_dev_loss']
+            # the workers of a data-parallel run keep their own noise seeds
+            if get_world_size() == 1:
+                set_rng_state(state['rng'], model.vae_cell.sampler)
+    broadcast_parameters(model)
+
+    def save_checkpoint(name, keep=False):
+        ckpt_manager.save(
+            {
+                'epoch': epoch,
+                'state_dict': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'loader': train_loader.state_dict(),
+                'rng': rng_state(model.vae_cell.sampler),
+                'patience': patience,
+                'dev_loss_threshold': dev_loss_threshold,
+                'best_dev_loss': best_dev_loss,
+            },
+            name,
+            keep=keep)
 
     # Train and evaluate
-    patience = params.max_epoch
-    dev_loss_threshold = np.inf
-    best_dev_loss = np.inf
+    ckpt_name = None
     if not args.forward_only:
         start = time.time()
         for epoch in range(last_epoch, params.max_epoch):
@@ -256,12 +380,24 @@ def main(args):
                 sys.stdout.flush()
 
             if train_loader.num_batch is None or train_loader.ptr >= train_loader.num_batch:
-                train_loader.epoch_init(params.batch_size, shuffle=True)
-            train(model, train_loader, optimizer, writer, epoch)
+                train_loader.epoch_init(params.batch_size,
+                                        shuffle=True,
+                                        num_shards=get_world_size(),
+                                        shard_index=rank)
+            train(model,
+                  train_loader,
+                  optimizer,
+                  writer,
+                  epoch,
+                  save_checkpoint=save_checkpoint if is_master() else None)
 
             print("Best valid loss before this validation: %f" % best_dev_loss)
             sys.stdout.flush()
-            valid_loader.epoch_init(params.batch_size, shuffle=False)
+            valid_loader.epoch_init(params.batch_size,
+                                    shuffle=False,
+                                    num_shards=get_world_size(),
+                                    shard_index=rank,
+                                    even_shards=False)
             valid_loss = valid(model, valid_loader, writer, epoch)
             if valid_loss < best_dev_loss:
                 print("Get a smaller valid loss, update the best valid loss")
@@ -273,26 +409,37 @@ def main(args):
                     dev_loss_threshold = valid_loss
 
                 # still save the best train model
-                if args.save_model:
+                if args.save_model and is_master():
                     print("Saving the model")
                     sys.stdout.flush()
-                    state = {
-                        'epoch': epoch,
-                        'state_dict': model.state_dict(),
-                        'optimizer': optimizer.state_dict(),
-                    }
                     ckpt_name = "vrnn_" + str(epoch) + ".pt"
-                    torch.save(state, os.path.join(log_dir, ckpt_name))
+                    save_checkpoint(ckpt_name, keep=True)
+            # after the validation, so that a resume from it goes on with the
+            # next epoch
+            if params.ckpt_every and is_master():
+                save_checkpoint("last_%d_%d.pt" % (epoch, train_loader.ptr))
             if params.early_stop and patience <= epoch:
                 print("Early stop due to run out of patience!!")
                 sys.stdout.flush()
                 break
         time_elapsed = float(time.time() - start) / 60.00
         print("Total training time: %.2f" % time_elapsed)
-        return ckpt_dir, ckpt_name
+        if is_master():
+            profiler.report(os.path.join(log_dir, "profile_trace.json"))
+        if writer is not None:
+            writer.close()
+        if ckpt_manager is not None:
+            ckpt_manager.close()
+        if get_world_size() > 1:
+            dist.destroy_process_group()
+        if result_queue is not None and rank == 0:
+            result_queue.put((args.ckpt_dir, ckpt_name))
+        return args.ckpt_dir, ckpt_name
     # Inference only
     else:
-        state = torch.load(checkpoint_path, map_location=device)
+        state = torch.load(checkpoint_path,
+                           map_location=device,
+                           weights_only=False)
         print("Load model from %s" % checkpoint_path)
         sys.stdout.flush()
         model.load_state_dict(state['state_dict'])
@@ -306,7 +453,9 @@ def main(args):
             )  # [num_batches(8), 4, batch_size(16), max_dialog_len(10), n_state(10)]
         with open(os.path.join(log_dir, "result.pkl"), "wb") as fh:
             pkl.dump(results, fh)
+        profiler.report(os.path.join(log_dir, "profile_trace.json"))
     writer.close()
+    ckpt_manager.close()
 
 
 if __name__ == "__main__":
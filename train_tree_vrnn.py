@@ -14,7 +14,13 @@ from data_apis.vocab import Vocab
 from data_apis.UbuntuChatCorpus import Batcher
 from models.tree_vrnn import TreeVRNN
 import params
-from utils.loss import print_loss
+from utils.loss import print_loss, bpr_kl_loss_single
+from utils.accumulate import GradientAccumulator
+from utils import profiler
+from utils.profiler import stage
+from utils.metrics import Metrics
+from utils.summary import AsyncSummaryWriter
+from utils.checkpoint import CheckpointManager, rng_state, set_rng_state
 
 
 def get_dataset(device):
@@ -36,24 +42,39 @@ def get_dataset(device):
 
 
 def train(model, train_loader, optimizer, step):
-    optimizer.zero_grad()
-    batch = train_loader._next_batch()
-    if batch is None:
+    # one optimizer step over grad_accum_steps micro-batches
+    micro_batches = []
+    for _ in range(params.grad_accum_steps):
+        with stage("next_batch"):
+            batch = train_loader._next_batch()
+        if batch is None:
+            break
+        micro_batches.append(batch)
+    if not micro_batches:
         return
-    loss = model(batch.enc_batch,
-                 batch.enc_lens,
-                 batch.dec_batch,
-                 batch.target_batch,
-                 batch.padding_mask,
-                 batch.tgt_index,
-                 training=True)
-
-    loss[0].backward(
-    )  # loss[0] = elbo_t = rc_loss + weight_kl * kl_loss + weight_bow * bow_loss
-    optimizer.step()
+    optimizer.zero_grad()
+    n_turns = max(model.num_turns(batch.tgt_index) for batch in micro_batches)
+    num_tokens = [torch.sum(batch.padding_mask) for batch in micro_batches]
+    accumulator = GradientAccumulator(model, bpr_kl_loss_single,
+                                      sum(num_tokens), len(micro_batches))
+    for batch, batch_num_tokens in zip(micro_batches, num_tokens):
+        # loss[0] = elbo_t = rc_loss + weight_kl * kl_loss + weight_bow * bow_loss
+        with stage("forward"):
+            loss = model(batch.enc_batch,
+                         batch.enc_lens,
+                         batch.dec_batch,
+                         batch.target_batch,
+                         batch.padding_mask,
+                         batch.tgt_index,
+                         training=True,
+                         n_turns=n_turns,
+                         defer_bpr=accumulator.defer_bpr)
+        accumulator.backward(loss, batch_num_tokens)
+    loss = accumulator.finish()
+    with stage("optimizer_step"):
+        optimizer.step()
 
-    # use .data to free the loss Variable
-    return loss[0].data, loss[1].data, loss[2].data, loss[3].data
+    return loss
 
 
 def valid(model, valid_loader):
@@ -88,14 +109,18 @@ def main():
     device = torch.device("cuda" if use_cuda else "cpu")
 
     train_loader, valid_loader, test_loader, vocab = get_dataset(device)
+    if args.profile:
+        profiler.enable(sync=device.type == "cuda")
 
     if args.forward_only or args.resume:
         log_dir = os.path.join(params.log_dir, "tree_vrnn", args.ckpt_dir)
-        checkpoint_path = os.path.join(log_dir, "tree_vrnn", args.ckpt_name)
+        checkpoint_path = os.path.join(log_dir, args.ckpt_name)
     else:
         log_dir = os.path.join(params.log_dir, "tree_vrnn",
                                "run" + str(int(time.time())))
     os.makedirs(log_dir, exist_ok=True)
+    writer = AsyncSummaryWriter(log_dir=log_dir)
+    ckpt_manager = CheckpointManager(log_dir, keep_last=params.keep_checkpoints)
 
     model = TreeVRNN().to(device)
     if params.op == "adam":
@@ -115,42 +140,66 @@ def main():
     if not args.forward_only:
         with open(os.path.join(log_dir, "run.log"), "w") as f:
             f.write(pp(params, output=False))
+        writer.add_text('Hyperparameters', pp(params, output=False))
 
+    patience = params.n_training_steps
+    dev_loss_threshold = np.inf
+    best_dev_loss = np.inf
     last_step = 0
     if args.resume:
         print("Resuming training from %s" % checkpoint_path)
-        state = torch.load(checkpoint_path)
+        state = torch.load(checkpoint_path,
+                           map_location=device,
+                           weights_only=False)
         model.load_state_dict(state['state_dict'])
         optimizer.load_state_dict(state['optimizer'])
         last_step = state['step']
+        if 'loader' in state:
+            # continue from the batch after the checkpoint
+            train_loader.load_state_dict(state['loader'])
+            patience = state['patience']
+            dev_loss_threshold = state['dev_loss_threshold']
+            best_dev_loss = state['best_dev_loss']
+            set_rng_state(state['rng'], model.vae_cell.sampler)
+
+    def save_checkpoint(name, keep=False):
+        ckpt_manager.save(
+            {
+                'step': step,
+                'state_dict': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'loader': train_loader.state_dict(),
+                'rng': rng_state(model.vae_cell.sampler),
+                'patience': patience,
+                'dev_loss_threshold': dev_loss_threshold,
+                'best_dev_loss': best_dev_loss,
+            },
+            name,
+            keep=keep)
 
-    elbo_t = []
-    rc_loss = []
-    kl_loss = []
-    bow_loss = []
     loss_names = ["elbo_t", "rc_loss", "kl_loss", "bow_loss"]
-    patience = params.n_training_steps
-    dev_loss_threshold = np.inf
-    best_dev_loss = np.inf
+    metrics = Metrics(loss_names,
+                      window=params.loss_window,
+                      ema_decay=params.loss_ema_decay)
     for step in range(last_step + 1, params.n_training_steps + 1):
         start_time = time.time()
         model.train()
         losses = train(model, train_loader, optimizer, step)
-        elbo_t.append(losses[0])
-        rc_loss.append(losses[1])
-        kl_loss.append(losses[2])
-        bow_loss.append(losses[3])
+        metrics.update(losses)
+        writer.add_scalars('Loss/train', dict(zip(loss_names, losses)), step)
 
         if step % params.print_after == 0:
             for param_group in optimizer.param_groups:
                 print("Learning rate %f" % param_group['lr'])
             print_loss("%.2f" % (step / float(params.n_training_steps)),
-                       loss_names, [elbo_t, rc_loss, kl_loss, bow_loss],
+                       loss_names,
+                       metrics,
                        postfix='')
             # valid
             print("Best valid loss so far %f" % best_dev_loss)
             model.eval()
             valid_loss = valid(model, valid_loader)
+            writer.add_scalar('Loss/valid/elbo_t', valid_loss, step)
             if valid_loss < best_dev_loss:
                 print("Get a smaller valid loss, update the best valid loss")
                 best_dev_loss = valid_loss
@@ -162,24 +211,22 @@ def main():
                 # still save the best train model
                 if args.save_model:
                     print("Saving the model.")
-                    state = {
-                        'step': step,
-                        'state_dict': model.state_dict(),
-                        'optimizer': optimizer.state_dict(),
-                    }
-                    torch.save(
-                        state, os.path.join(log_dir,
-                                            "vrnn_" + str(step) + ".pt"))
+                    save_checkpoint("vrnn_" + str(step) + ".pt", keep=True)
 
             if params.early_stop and patience <= step:
                 print("Early stop due to run out of patience!!")
                 break
 
+        if params.ckpt_every and step % params.ckpt_every == 0:
+            save_checkpoint("last_%d.pt" % step)
+
         if step == params.n_training_steps:
-            print_loss("Training Done", loss_names,
-                       [elbo_t, rc_loss, kl_loss, bow_loss], "")
+            print_loss("Training Done", loss_names, metrics, "")
     training_time = time.time() - start_time
     print("step time %.4f" % (training_time / params.n_training_steps))
+    profiler.report(os.path.join(log_dir, "profile_trace.json"))
+    writer.close()
+    ckpt_manager.close()
 
 
 if __name__ == "__main__":
@@ -206,6 +253,12 @@ if __name__ == "__main__":
                         default=True,
                         type=bool,
                         help='whether save checkpoints')
+    parser.add_argument(
+        '--profile',
+        default=False,
+        type=bool,
+        help='Time the stages of every step, print a table and write a '
+        'Chrome trace to the log directory')
     parser.add_argument(
         '--use_test_batch',
         default=False,
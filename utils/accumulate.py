@@ -0,0 +1,66 @@
+import torch
+
+from utils.profiler import stage
+
+
+class GradientAccumulator(object):
+    """Sums the gradients of the micro-batches of one optimizer step so that
+    the step is the one of a single batch made of all of them, e.g.
+
+        accumulator = GradientAccumulator(model, bpr_kl_loss, num_tokens,
+                                          len(micro_batches))
+        for batch in micro_batches:
+            losses = model(*batch, defer_bpr=accumulator.defer_bpr)
+            accumulator.backward(losses, batch_num_tokens)
+        losses = accumulator.finish()
+
+    The losses are sums over the batch divided by its number of tokens, so
+    each micro-batch is weighted by its share of the step's tokens. BPR's
+    KL is taken between the batch means of the posterior and the prior and
+    does not split over micro-batches: the model leaves it out and keeps
+    the posteriors and priors in model.posteriors. Only their graphs, not
+    the decoder logits, stay alive until finish() computes the KL over the
+    whole step with kl_loss_fn and backpropagates it.
+    """
+    def __init__(self, model, kl_loss_fn, num_tokens, num_micro_batches):
+        self.model = model
+        self.kl_loss_fn = kl_loss_fn
+        self.num_tokens = float(num_tokens)
+        self.config = model.config
+        # a single micro-batch keeps the loss as it is
+        self.defer_bpr = self.config.with_BPR and num_micro_batches > 1
+        self.losses = [0., 0., 0., 0.]
+        self.p_zs = []
+        self.q_zs = []
+
+    def backward(self, losses, num_tokens):
+        """losses: (elbo_t, rc_loss, kl_loss, bow_loss) of a micro-batch with
+        num_tokens tokens, averaged over them."""
+        scale = float(num_tokens) / self.num_tokens
+        if self.defer_bpr:
+            p_z, q_z = self.model.posteriors
+            self.model.posteriors = None
+            self.p_zs.append(p_z)
+            self.q_zs.append(q_z)
+        # the posterior graphs are needed again for the KL in finish()
+        with stage("backward"):
+            (losses[0] * scale).backward(retain_graph=self.defer_bpr)
+        for i, loss in enumerate(losses):
+            self.losses[i] = self.losses[i] + loss.detach() * scale
+
+    def finish(self):
+        """Backpropagate BPR's KL over the step and return the step's
+        (elbo_t, rc_loss, kl_loss, bow_loss)."""
+        elbo_t, rc_loss, kl_loss, bow_loss = self.losses
+        if self.defer_bpr:
+            with stage("BPR_BOW_loss"):
+                bpr_kl = self.kl_loss_fn(torch.cat(self.p_zs, dim=-2),
+                                         torch.cat(self.q_zs, dim=-2),
+                                         config=self.config) / self.num_tokens
+            with stage("backward"):
+                bpr_kl.backward()
+            elbo_t = elbo_t + bpr_kl.detach()
+            kl_loss = kl_loss + bpr_kl.detach()
+            self.p_zs = []
+            self.q_zs = []
+        return elbo_t, rc_loss, kl_loss, bow_loss
@@ -0,0 +1,125 @@
+import copy
+import os
+import queue
+import random
+import re
+import sys
+from threading import Thread
+
+import numpy as np
+import torch
+
+# names of the rolling checkpoints of the training scripts, last_<step>.pt
+# or last_<epoch>_<batch>.pt
+ROLLING_NAME = re.compile(r"last_(\d+(?:_\d+)*)\.pt$")
+
+
+def _snapshot(obj):
+    """Copy of a checkpoint state with every tensor cloned to the CPU, so
+    training can go on while it is written."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def rng_state(sampler=None):
+    """Python, numpy and torch random states, plus the Gumbel noise stream."""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    if sampler is not None:
+        state['sampler'] = sampler.state_dict()
+    return state
+
+
+def set_rng_state(state, sampler=None):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    if sampler is not None and 'sampler' in state:
+        sampler.load_state_dict(state['sampler'])
+
+
+class CheckpointManager(object):
+    """Saves checkpoints from a background thread.
+
+    save() snapshots the state on the calling thread and returns. The
+    writer thread saves to a temporary file, fsyncs it and renames it over
+    the target, so a killed run never leaves a truncated checkpoint. Only
+    the last keep_last rolling checkpoints stay on disk; the ones saved with
+    keep=True (e.g. the best model) are never removed. The rolling
+    checkpoints already in ckpt_dir (those of a run that is resumed) count
+    as the oldest ones, ordered by their step.
+    """
+    def __init__(self, ckpt_dir, keep_last=3):
+        self.ckpt_dir = ckpt_dir
+        self.keep_last = keep_last
+        self._rolling = self._existing_rolling()
+        self._queue = queue.Queue()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _existing_rolling(self):
+        if not os.path.isdir(self.ckpt_dir):
+            return []
+        steps = []
+        for name in os.listdir(self.ckpt_dir):
+            match = ROLLING_NAME.match(name)
+            if match:
+                step = tuple(int(i) for i in match.group(1).split("_"))
+                steps.append((step, os.path.join(self.ckpt_dir, name)))
+        return [path for _, path in sorted(steps)]
+
+    def save(self, state, name, keep=False):
+        self._queue.put((_snapshot(state), name, keep))
+
+    def _write(self, state, name, keep):
+        path = os.path.join(self.ckpt_dir, name)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        if keep:
+            return
+        if path in self._rolling:
+            self._rolling.remove(path)
+        self._rolling.append(path)
+        while len(self._rolling) > self.keep_last:
+            old_path = self._rolling.pop(0)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            try:
+                self._write(*item)
+            except Exception as e:  # keep the thread alive for close()
+                print("CheckpointManager: saving %s failed: %s" % (item[1], e))
+                sys.stdout.flush()
+            self._queue.task_done()
+
+    def wait(self):
+        """Block until every checkpoint saved so far is on disk."""
+        self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
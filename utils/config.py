@@ -0,0 +1,78 @@
+import copy
+import functools
+import pickle as pkl
+import types
+
+import numpy as np
+
+import params
+
+
+class Config(object):
+    """A model configuration: the settings of the params module with some
+    of them replaced, e.g.
+
+        config = Config(n_state=20, temperature=0.3)
+        model = LinearVRNN(config)
+
+    The models, cells, losses and loaders take one as `config` and read the
+    params module when they are not given one, so several configurations
+    can live in one process, e.g. the workers of a sweep that share one
+    loaded corpus. The settings are copied when the Config is made: later
+    changes of params do not reach it. Setting n_state alone also sets
+    state_cell_size, which follows it in params.
+    """
+    def __init__(self, base=params, **overrides):
+        settings = {
+            key: value
+            for key, value in vars(base).items()
+            if not key.startswith("_")
+            and not isinstance(value, types.ModuleType)
+        }
+        unknown = sorted(set(overrides) - set(settings))
+        if unknown:
+            raise AttributeError("Unknown settings: %s" % ", ".join(unknown))
+        if ("n_state" in overrides and "state_cell_size" not in overrides
+                and settings["state_cell_size"] == settings["n_state"]):
+            overrides["state_cell_size"] = overrides["n_state"]
+        settings.update(overrides)
+        self.__dict__.update(copy.deepcopy(settings))
+
+    def replace(self, **overrides):
+        """A copy of this configuration with some settings replaced."""
+        return Config(self, **overrides)
+
+    def __repr__(self):
+        return "Config(%s)" % ", ".join(
+            "%s=%r" % item for item in sorted(vars(self).items()))
+
+
+@functools.lru_cache(maxsize=None)
+def load_word_weights(rev_vocab_dir, multiply_factor=3):
+    """Loss weight of every word id of the rev_vocab pickle: the slot and
+    value words weigh multiply_factor times the others, scaled to a mean
+    of 1."""
+    with open(rev_vocab_dir, "rb") as fh:
+        rev_vocab = pkl.load(fh)
+
+    slot_value_id_list = []
+    for k, v in rev_vocab.items():
+        if ("slot_" in k) or ("value_" in k):
+            slot_value_id_list.append(v)
+
+    one_weight = 1.0 / (len(rev_vocab) +
+                        (multiply_factor - 1) * len(slot_value_id_list))
+    word_weights = [one_weight] * len(rev_vocab)
+    for i in slot_value_id_list:
+        word_weights[i] = multiply_factor * word_weights[i]
+
+    assert np.isclose(np.sum(word_weights), 1.0)
+    return list(len(rev_vocab) * np.array(word_weights))
+
+
+def word_weights(config=params):
+    """The word weights of the losses, None unless config.with_word_weights.
+    """
+    if not config.with_word_weights:
+        return None
+    return load_word_weights(config.rev_vocab_dir)
@@ -0,0 +1,55 @@
+import torch
+import torch.distributed as dist
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def is_master():
+    """Only the first worker writes logs and checkpoints."""
+    return get_rank() == 0
+
+
+def broadcast_parameters(model):
+    """Start every worker from the first worker's weights."""
+    if get_world_size() == 1:
+        return
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, 0)
+
+
+def all_reduce_gradients(model):
+    """Average the gradients over the workers with one all_reduce on a flat
+    buffer. Parameters without a gradient take part with zeros, so every
+    worker sends the same buffer layout.
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return
+    grads = []
+    for p in model.parameters():
+        if p.requires_grad:
+            if p.grad is None:
+                p.grad = torch.zeros_like(p)
+            grads.append(p.grad)
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= world_size
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def all_reduce_sum(tensor):
+    """Sum of a tensor (e.g. loss sums and counts) over the workers."""
+    if get_world_size() == 1:
+        return tensor
+    tensor = tensor.clone()
+    dist.all_reduce(tensor)
+    return tensor
@@ -0,0 +1,44 @@
+import torch
+
+from utils.precision import fp32
+from utils.profiler import profiled
+
+
+@profiled("crf_marginals")
+@fp32
+def linear_chain_marginals(log_potentials):
+    """Node marginals of a linear-chain CRF by one forward-backward pass.
+    Every chain in the batch is assumed to span all N nodes, so no length
+    masking is needed.
+    Args:
+        log_potentials: [..., N - 1, C, C] edge scores phi(n, z_{n+1}, z_n),
+            laid out as for torch_struct.LinearChainCRF
+    Returns:
+        [..., N - 1, C] marginal probabilities of z_1 ... z_{N-1}, the same as
+        torch_struct.LinearChainCRF(log_potentials).marginals.sum(-1)
+    """
+    n_edges = log_potentials.size(-3)
+
+    # forward: alpha_{n+1}(i) = logsumexp_j phi(n, i, j) + alpha_n(j)
+    alpha = torch.logsumexp(log_potentials[..., 0, :, :], dim=-1)
+    alphas = [alpha]
+    for n in range(1, n_edges):
+        alpha = torch.logsumexp(log_potentials[..., n, :, :] +
+                                alpha.unsqueeze(-2),
+                                dim=-1)
+        alphas.append(alpha)
+
+    # backward: beta_n(j) = logsumexp_i phi(n, i, j) + beta_{n+1}(i)
+    beta = torch.zeros_like(alpha)
+    betas = [beta]
+    for n in range(n_edges - 1, 0, -1):
+        beta = torch.logsumexp(log_potentials[..., n, :, :] +
+                               beta.unsqueeze(-1),
+                               dim=-2)
+        betas.append(beta)
+    betas.reverse()
+
+    log_z = torch.logsumexp(alpha, dim=-1)
+    log_marginals = torch.stack(alphas, dim=-2) + torch.stack(
+        betas, dim=-2) - log_z[..., None, None]
+    return torch.exp(log_marginals)
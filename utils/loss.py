@@ -8,8 +8,76 @@ import numpy as np
 
 sys.path.append("..")
 import params
-
-
+from utils.config import word_weights
+from utils.precision import fp32
+from utils.profiler import profiled
+from utils.metrics import Metrics, RunningStat
+
+
+def bow_nll(bow_logits, labels, label_mask, weights=None):
+    """Bag-of-words negative log-likelihood without tiling the logits over
+    the target positions: log_softmax once per row, weighted by the target
+    token counts. Same value and gradients as CrossEntropyLoss on the tiled
+    logits.
+    Args:
+        bow_logits: [batch, vocab_size]
+        labels: [batch, len] target tokens
+        label_mask: [batch, len] 1 for the tokens to score
+        weights: optional [vocab_size] word weights
+    Returns:
+        [batch] loss summed over the positions
+    """
+    log_probs = F.log_softmax(bow_logits, dim=1)
+    counts = torch.zeros_like(log_probs).scatter_add_(
+        1, labels, label_mask.to(log_probs.dtype))  # [batch, vocab_size]
+    if weights is not None:
+        counts = counts * weights
+    return -torch.sum(counts * log_probs, dim=1)
+
+
+def reconstruction_nll(dec_outs, labels, weights=None, head=None):
+    """Per-token negative log-likelihood of the decoder outputs: logits
+    for a full softmax, or the hidden states scored by an adaptive softmax
+    head, which only evaluates the clusters of the targets. Both are exact
+    likelihoods.
+    """
+    if head is None:
+        return nn.CrossEntropyLoss(weight=weights, reduction='none')(
+            dec_outs.reshape(-1, dec_outs.size(-1)), labels)
+    nll = -head(dec_outs.reshape(-1, head.in_features), labels).output
+    if weights is not None:
+        nll = nll * weights[labels]
+    return nll
+
+
+def aggregate_kl(p_z, q_z):
+    """KL(q' || p') between the batch means q', p' of the posterior and the
+    prior. q_z, p_z: [..., batch, n_state], summed over the leading dims.
+    """
+    q_z_prime = torch.mean(q_z, dim=-2)
+    log_q_z_prime = torch.log(q_z_prime + 1e-20)
+
+    p_z_prime = torch.mean(p_z, dim=-2)
+    log_p_z_prime = torch.log(p_z_prime + 1e-20)
+
+    return torch.sum((log_q_z_prime - log_p_z_prime) * q_z_prime)
+
+
+@fp32
+def bpr_kl_loss(p_z, q_z, config=params):
+    """The weighted BPR KL of BPR_BOW_loss, per turn and scaled by the batch
+    size."""
+    return config.kl_loss_weight * (aggregate_kl(p_z, q_z) * q_z.size(-2))
+
+
+@fp32
+def bpr_kl_loss_single(p_z, q_z, config=params):
+    """The weighted BPR KL of BPR_BOW_loss_single."""
+    return config.kl_loss_weight * aggregate_kl(p_z, q_z)
+
+
+@profiled("BPR_BOW_loss")
+@fp32
 def BPR_BOW_loss(output_tokens,
                  dec_outs_1,
                  dec_outs_2,
@@ -18,76 +86,65 @@ def BPR_BOW_loss(output_tokens,
                  p_z,
                  q_z,
                  bow_logits1=None,
-                 bow_logits2=None):
-    dec_outs_1 = dec_outs_1.view(-1, params.max_vocab_cnt)
+                 bow_logits2=None,
+                 dec_heads=None,
+                 defer_bpr=False,
+                 config=params):
+    """dec_heads: the two adaptive softmax heads when dec_outs_1/2 are
+    decoder states instead of logits. defer_bpr: leave the BPR KL out (0)
+    for the caller to compute over several micro-batches. config: the
+    settings of the model, params by default."""
     labels_1 = output_tokens[0][:, 1:].reshape(-1)
     label_mask_1 = torch.sign(labels_1)
-    dec_outs_2 = dec_outs_2.view(-1, params.max_vocab_cnt)
     labels_2 = output_tokens[1][:, 1:].reshape(-1)
     label_mask_2 = torch.sign(labels_2)
 
-    if params.word_weights is not None:
-        weights = torch.tensor(params.word_weights, requires_grad=False)
-        if params.use_cuda and torch.cuda.is_available():
-            weights = weights.cuda()
-        rc_loss1 = nn.CrossEntropyLoss(weight=weights, reduction='none')(
-            dec_outs_1, labels_1) * label_mask_1.float()
-        rc_loss2 = nn.CrossEntropyLoss(weight=weights, reduction='none')(
-            dec_outs_2, labels_2) * label_mask_2.float()
-    else:
-        rc_loss1 = nn.CrossEntropyLoss(reduction='none')(
-            dec_outs_1, labels_1) * label_mask_1.float()
-        rc_loss2 = nn.CrossEntropyLoss(reduction='none')(
-            dec_outs_2, labels_2) * label_mask_2.float()
+    weights = word_weights(config)
+    if weights is not None:
+        weights = torch.tensor(weights,
+                               dtype=torch.float32,
+                               device=dec_outs_1.device)
+    head_1, head_2 = dec_heads if dec_heads is not None else (None, None)
+    rc_loss1 = reconstruction_nll(dec_outs_1, labels_1, weights,
+                                  head_1) * label_mask_1.float()
+    rc_loss2 = reconstruction_nll(dec_outs_2, labels_2, weights,
+                                  head_2) * label_mask_2.float()
     rc_loss_1 = torch.sum(rc_loss1)
     rc_loss_2 = torch.sum(rc_loss2)
 
     # KL_loss
-    kl_loss = (log_q_z - log_p_z) * q_z
-    kl_loss = torch.sum(kl_loss)
-
-    if params.with_BPR:
-        q_z_prime = torch.mean(q_z, dim=0)
-        log_q_z_prime = torch.log(q_z_prime + 1e-20)
-
-        p_z_prime = torch.mean(p_z, dim=0)
-        log_p_z_prime = torch.log(p_z_prime + 1e-20)
-
-        kl_loss = (log_q_z_prime - log_p_z_prime) * q_z_prime
-        kl_loss = torch.sum(kl_loss) * params.batch_size
-    kl_loss = params.kl_loss_weight * kl_loss
+    if config.with_BPR:
+        # q_z, p_z: [batch, n_state], or [turns, batch, n_state] when all
+        # turns are scored at once, the aggregate is taken per turn
+        if defer_bpr:
+            kl_loss = q_z.new_zeros(())
+        else:
+            kl_loss = bpr_kl_loss(p_z, q_z, config=config)
+    else:
+        kl_loss = config.kl_loss_weight * torch.sum(
+            (log_q_z - log_p_z) * q_z)
 
     elbo_t = rc_loss_1 + rc_loss_2 + kl_loss
 
     # BOW_loss
     bow_loss_1 = bow_loss_2 = 0
-    if params.with_BOW:
-        tile_bow_logits1 = (torch.unsqueeze(
-            bow_logits1, 1).repeat(1, params.max_utt_len - 1, 1)).view(
-                -1,
-                params.max_vocab_cnt)  # [batch * (max_utt - 1), vocab_size]
-        tile_bow_logits2 = (torch.unsqueeze(bow_logits2, 1).repeat(
-            1, params.max_utt_len - 1, 1)).view(-1, params.max_vocab_cnt)
-
-        if params.word_weights is not None:
-            bow_loss1 = nn.CrossEntropyLoss(weight=weights, reduction='none')(
-                tile_bow_logits1, labels_1) * label_mask_1.float()
-            bow_loss2 = nn.CrossEntropyLoss(weight=weights, reduction='none')(
-                tile_bow_logits2, labels_2) * label_mask_2.float()
-        else:
-            bow_loss1 = nn.CrossEntropyLoss(reduction='none')(
-                tile_bow_logits1, labels_1) * label_mask_1.float()
-            bow_loss2 = nn.CrossEntropyLoss(reduction='none')(
-                tile_bow_logits2, labels_2) * label_mask_2.float()
+    if config.with_BOW:
+        batch_size = bow_logits1.size(0)
+        bow_loss1 = bow_nll(bow_logits1, labels_1.view(batch_size, -1),
+                            label_mask_1.view(batch_size, -1), weights)
+        bow_loss2 = bow_nll(bow_logits2, labels_2.view(batch_size, -1),
+                            label_mask_2.view(batch_size, -1), weights)
 
-        bow_loss_1 = params.bow_loss_weight * torch.sum(bow_loss1)
-        bow_loss_2 = params.bow_loss_weight * torch.sum(bow_loss2)
+        bow_loss_1 = config.bow_loss_weight * torch.sum(bow_loss1)
+        bow_loss_2 = config.bow_loss_weight * torch.sum(bow_loss2)
 
         elbo_t = elbo_t + bow_loss_1 + bow_loss_2
 
     return elbo_t, rc_loss_1 + rc_loss_2, kl_loss, bow_loss_1 + bow_loss_2
 
 
+@profiled("BPR_BOW_loss")
+@fp32
 def BPR_BOW_loss_single(output_tokens,
                         dec_outs,
                         dec_mask,
@@ -95,65 +152,55 @@ def BPR_BOW_loss_single(output_tokens,
                         log_q_z,
                         p_z,
                         q_z,
-                        bow_logits=None):
-    dec_outs = dec_outs.view(-1, params.max_vocab_cnt)
+                        bow_logits=None,
+                        dec_head=None,
+                        defer_bpr=False,
+                        config=params):
     labels = output_tokens.long().reshape(-1)
     label_mask = dec_mask.float().reshape(-1)
 
-    if params.word_weights is not None:
-        weights = torch.tensor(params.word_weights, requires_grad=False)
-        if params.use_cuda and torch.cuda.is_available():
-            weights = weights.cuda()
-        rc_loss = nn.CrossEntropyLoss(weight=weights, reduction='none')(
-            dec_outs, labels) * label_mask
-
-    else:
-        rc_loss = nn.CrossEntropyLoss(reduction='none')(dec_outs,
-                                                        labels) * label_mask
-
+    weights = word_weights(config)
+    if weights is not None:
+        weights = torch.tensor(weights,
+                               dtype=torch.float32,
+                               device=dec_outs.device)
+    rc_loss = reconstruction_nll(dec_outs, labels, weights,
+                                 dec_head) * label_mask
     rc_loss = torch.sum(rc_loss)
 
     # KL_loss
     kl_loss = (log_q_z - log_p_z) * q_z
     kl_loss = torch.sum(kl_loss)
 
-    if params.with_BPR:
-        q_z_prime = torch.mean(q_z, dim=0)
-        log_q_z_prime = torch.log(q_z_prime + 1e-20)
-
-        p_z_prime = torch.mean(p_z, dim=0)
-        log_p_z_prime = torch.log(p_z_prime + 1e-20)
-
-        kl_loss = (log_q_z_prime - log_p_z_prime) * q_z_prime
+    if config.with_BPR:
         # TODO: BPR?
-        kl_loss = params.kl_loss_weight * torch.sum(kl_loss)
+        if defer_bpr:
+            kl_loss = q_z.new_zeros(())
+        else:
+            kl_loss = bpr_kl_loss_single(p_z, q_z, config=config)
         # kl_loss = torch.div(torch.sum(kl_loss), params.batch_size)
 
     elbo_t = rc_loss + kl_loss
 
     # BOW_loss
     bow_loss = 0
-    if params.with_BOW:
-        tile_bow_logits = (torch.unsqueeze(
-            bow_logits, 1).repeat(1, params.max_dec_steps, 1)).view(
-                -1,
-                params.max_vocab_cnt)  # [batch * (max_utt - 1), vocab_size]
-
-        if params.word_weights is not None:
-            bow_loss = nn.CrossEntropyLoss(weight=weights, reduction='none')(
-                tile_bow_logits, labels) * label_mask
-        else:
-            bow_loss = nn.CrossEntropyLoss(reduction='none')(
-                tile_bow_logits, labels) * label_mask
+    if config.with_BOW:
+        batch_size = bow_logits.size(0)
+        bow_loss = bow_nll(bow_logits, labels.view(batch_size, -1),
+                           label_mask.view(batch_size, -1), weights)
 
-        bow_loss = params.bow_loss_weight * torch.sum(bow_loss)
+        bow_loss = config.bow_loss_weight * torch.sum(bow_loss)
 
         elbo_t = elbo_t + bow_loss
 
     return elbo_t, rc_loss, kl_loss, bow_loss
 
 
-def print_loss(prefix, loss_names, losses, postfix):
+def print_loss(prefix, loss_names, losses, postfix, stat="mean"):
+    """losses: a Metrics, or one entry per name that is a RunningStat (the
+    stat is printed: mean, ema, window_mean) or a list of loss tensors."""
+    if isinstance(losses, Metrics):
+        losses = [losses[name] for name in loss_names]
     template = "%s "
     for name in loss_names:
         template += "%s " % name
@@ -163,7 +210,10 @@ def print_loss(prefix, loss_names, losses, postfix):
     values = [prefix]
 
     for loss in losses:
-        values.append(torch.mean(torch.stack(loss)))
+        if isinstance(loss, RunningStat):
+            values.append(loss.get(stat))
+        else:
+            values.append(torch.mean(torch.stack(loss)))
     values.append(postfix)
 
     print(template % tuple(values))
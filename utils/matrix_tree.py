@@ -0,0 +1,48 @@
+import torch
+
+from utils.precision import fp32
+from utils.profiler import profiled
+
+
+@profiled("crf_marginals")
+@fp32
+def dependency_tree_marginals(log_potentials, lengths, eps=1e-5):
+    """Arc marginals of single-root non-projective dependency trees by the
+    matrix-tree theorem, each tree spanning the first lengths[b] nodes.
+    The padding nodes are given an identity block in the Laplacian, so one
+    batched inverse solves dialogs of every length exactly and the padding
+    takes no probability mass.
+    Args:
+        log_potentials: [batch, N, N] arc scores phi(head, child) with the
+            root scores on the diagonal, laid out as for
+            torch_struct.NonProjectiveDependencyCRF
+        lengths: [batch] number of nodes of each tree, 1 <= lengths <= N
+    Returns:
+        [batch, N, N] arc marginals, the same as
+        NonProjectiveDependencyCRF(log_potentials[b, :n, :n]).marginals for
+        n = lengths[b] and 0 outside that block
+    """
+    n_nodes = log_potentials.size(-1)
+    nodes = torch.arange(n_nodes, device=log_potentials.device)
+    real = nodes.view(1, -1) < lengths.view(-1, 1)  # [batch, N]
+    pairs = real.unsqueeze(2) & real.unsqueeze(1)
+    first = nodes == 0
+
+    scores = log_potentials.exp().masked_fill(~pairs, 0)
+    root_scores = torch.diagonal(scores, dim1=-2, dim2=-1)
+    arcs = (scores + eps).masked_fill(
+        ~pairs | torch.eye(n_nodes, dtype=torch.bool,
+                           device=log_potentials.device), 0)
+    laplacian = torch.diag_embed(arcs.sum(-2)) - arcs
+    # the first row of the Laplacian takes the root scores (Koo et al., 2007)
+    laplacian = torch.where(first.view(-1, 1), root_scores.unsqueeze(-2),
+                            laplacian)
+    laplacian = laplacian + torch.diag_embed((~real).to(laplacian.dtype))
+    inv_t = torch.linalg.inv(laplacian).transpose(-1, -2)
+
+    heads = scores * torch.diagonal(inv_t, dim1=-2,
+                                    dim2=-1).unsqueeze(-2)  # [:, 1:] only
+    children = scores * inv_t  # [1:] only
+    marginals = heads.masked_fill(first.view(1, -1), 0) - children.masked_fill(
+        first.view(-1, 1), 0)
+    return marginals + torch.diag_embed(root_scores * inv_t[..., 0, :])
@@ -0,0 +1,82 @@
+from collections import OrderedDict, deque
+import math
+
+import torch
+
+
+class RunningStat(object):
+    """Running mean, exponential moving average and statistics over the last
+    `window` values of one scalar, each update in O(1).
+    """
+    def __init__(self, window=100, ema_decay=0.99):
+        self.ema_decay = ema_decay
+        self.count = 0
+        self.total = 0.
+        self.ema = None
+        self.window = deque(maxlen=window)
+        self._window_sum = 0.
+        self._window_sq_sum = 0.
+
+    def update(self, value):
+        if torch.is_tensor(value):
+            value = value.item()
+        self.count += 1
+        self.total += value
+        if self.ema is None:
+            self.ema = value
+        else:
+            self.ema = self.ema_decay * self.ema + (1 -
+                                                    self.ema_decay) * value
+        if len(self.window) == self.window.maxlen:
+            old = self.window[0]
+            self._window_sum -= old
+            self._window_sq_sum -= old * old
+        self.window.append(value)
+        self._window_sum += value
+        self._window_sq_sum += value * value
+
+    @property
+    def mean(self):
+        return self.total / max(self.count, 1)
+
+    @property
+    def window_mean(self):
+        return self._window_sum / max(len(self.window), 1)
+
+    @property
+    def window_std(self):
+        n = max(len(self.window), 1)
+        return math.sqrt(max(self._window_sq_sum / n - self.window_mean**2,
+                             0.))
+
+    def get(self, stat="mean"):
+        return getattr(self, stat)
+
+
+class Metrics(object):
+    """Streaming training losses by name, e.g.
+
+        metrics = Metrics(["elbo_t", "rc_loss"])
+        metrics.update([elbo_t, rc_loss])
+        if metrics.should_report():
+            print_loss("Train", loss_names, metrics, "")
+    """
+    def __init__(self, names, window=100, ema_decay=0.99, report_every=1):
+        self.names = list(names)
+        self.report_every = report_every
+        self.steps = 0
+        self.stats = OrderedDict(
+            (name, RunningStat(window, ema_decay)) for name in self.names)
+
+    def update(self, values):
+        if isinstance(values, dict):
+            values = [values[name] for name in self.names]
+        for name, value in zip(self.names, values):
+            self.stats[name].update(value)
+        self.steps += 1
+
+    def should_report(self):
+        return self.steps % self.report_every == 0
+
+    def __getitem__(self, name):
+        return self.stats[name]
@@ -0,0 +1,46 @@
+import functools
+
+import torch
+
+
+def bf16_autocast(forward):
+    """Run a model forward under CPU bfloat16 autocast when use_bf16 is set
+    in the model's config: embeddings stay fp32, the RNNs and linear
+    projections run in bf16.
+    """
+    @functools.wraps(forward)
+    def wrapper(self, *args, **kwargs):
+        with torch.autocast("cpu",
+                            dtype=torch.bfloat16,
+                            enabled=self.config.use_bf16):
+            return forward(self, *args, **kwargs)
+
+    return wrapper
+
+
+def full_precision():
+    """Region that runs in fp32 inside a bf16 autocast forward."""
+    return torch.autocast("cpu", enabled=False)
+
+
+def _to_fp32(x):
+    if torch.is_tensor(x) and x.dtype in (torch.float16, torch.bfloat16):
+        return x.float()
+    if isinstance(x, (list, tuple)):
+        return type(x)(_to_fp32(v) for v in x)
+    return x
+
+
+def fp32(fn):
+    """Cast the half precision tensor arguments of fn to fp32 and run it
+    without autocast, for the losses and the CRF marginals. fp64 arguments
+    are passed as they are.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with full_precision():
+            return fn(*_to_fp32(args),
+                      **{k: _to_fp32(v)
+                         for k, v in kwargs.items()})
+
+    return wrapper
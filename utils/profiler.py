@@ -0,0 +1,119 @@
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+import functools
+import json
+import os
+import threading
+import time
+
+import torch
+
+_NULL = nullcontext()
+_profiler = None
+
+
+class Profiler(object):
+    """Wall-clock timers of the named stages of a step.
+
+    Keeps the calls and total time of every stage for table(), and the
+    first max_events stage spans for export_chrome_trace(). Stages nest, so
+    the time of an outer stage includes the inner ones. With sync (a model
+    on the GPU) the stage boundaries synchronize the device.
+    """
+    def __init__(self, max_events=200000, sync=False):
+        self.max_events = max_events
+        self.stats = OrderedDict()  # name -> [calls, total seconds]
+        self.events = []
+        self.origin = time.perf_counter()
+        self.sync = sync
+
+    @contextmanager
+    def stage(self, name):
+        if self.sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize()
+            end = time.perf_counter()
+            stat = self.stats.setdefault(name, [0, 0.])
+            stat[0] += 1
+            stat[1] += end - start
+            if len(self.events) < self.max_events:
+                self.events.append((name, start, end, threading.get_ident()))
+
+    def table(self):
+        elapsed = time.perf_counter() - self.origin
+        lines = [
+            "%-24s %10s %12s %10s %8s" %
+            ("stage", "calls", "total (s)", "mean (ms)", "% wall")
+        ]
+        for name, (calls, total) in sorted(self.stats.items(),
+                                           key=lambda item: -item[1][1]):
+            lines.append("%-24s %10d %12.3f %10.3f %7.1f%%" %
+                         (name, calls, total, 1000. * total / calls,
+                          100. * total / elapsed))
+        lines.append("wall time %.3f s" % elapsed)
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        """Write the stage spans in the Trace Event Format, for
+        chrome://tracing or https://ui.perfetto.dev."""
+        trace = [{
+            "name": name,
+            "ph": "X",
+            "ts": 1e6 * (start - self.origin),
+            "dur": 1e6 * (end - start),
+            "pid": os.getpid(),
+            "tid": tid,
+        } for name, start, end, tid in self.events]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+
+def enable(max_events=200000, sync=False):
+    """Start profiling. sync: synchronize the GPU at the stage boundaries,
+    set it when training on CUDA."""
+    global _profiler
+    _profiler = Profiler(max_events, sync=sync)
+    return _profiler
+
+
+def disable():
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def report(trace_path):
+    """Print the stage table of the enabled profiler and write its Chrome
+    trace to trace_path."""
+    if _profiler is None:
+        return
+    print(_profiler.table())
+    _profiler.export_chrome_trace(trace_path)
+    print("Chrome trace written to %s" % trace_path)
+
+
+def stage(name):
+    """Time a block as stage `name`, a no-op unless profiling is enabled."""
+    if _profiler is None:
+        return _NULL
+    return _profiler.stage(name)
+
+
+def profiled(name):
+    """Time every call of the decorated function as stage `name`."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return fn(*args, **kwargs)
+            with _profiler.stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
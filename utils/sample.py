@@ -3,42 +3,122 @@ from __future__ import division
 import torch
 import torch.nn.functional as F
 import params
+from utils.profiler import profiled
 
 
 # Thanks for the implementation at https://github.com/dev4488/VAE_gumble_softmax/blob/master/vae_gumbel_softmax.py
 # Note: PyTorch also has this in their official API now.
-def sample_gumbel(shape, eps=1e-20, device='cpu'):
-    """Sample from Gumbel(0, 1)"""
-    U = torch.rand(shape, requires_grad=True).to(device)
+def sample_gumbel(shape, eps=1e-20, device='cpu', generator=None):
+    """Sample from Gumbel(0, 1), outside of the autograd graph"""
+    U = torch.rand(shape, device=device, generator=generator)
     return -torch.log(-torch.log(U + eps) + eps)
 
 
-def gumbel_softmax_sample(logits, temperature):
+def gumbel_softmax_sample(logits, temperature, noise=None):
     """ Draw a sample from the Gumbel-Softmax distribution"""
-    device = "cuda" if params.use_cuda and torch.cuda.is_available() else "cpu"
-    y = logits + sample_gumbel(logits.size(), 1e-20, device)
+    if noise is None:
+        noise = sample_gumbel(logits.size(), 1e-20, logits.device)
+    y = logits + noise
     return F.softmax(y / temperature, dim=1), y / temperature
 
 
-def gumbel_softmax(logits, temperature, hard=False):
+def gumbel_softmax(logits, temperature, hard=False, noise=None):
     """Sample from the Gumbel-Softmax distribution and optionally discretize.
     Args:
         logits: [batch_size, n_class] unnormalized log-probs
         temperature: non-negative scalar
         hard: if True, take argmax, but differentiate w.r.t. soft sample y
+        noise: optional [batch_size, n_class] Gumbel noise to use
     Returns:
         [batch_size, n_class] sample from the Gumbel-Softmax distribution.
         If hard=True, then the returned sample will be one-hot, otherwise it will
         be a probabilitiy distribution that sums to 1 across classes
     """
-    y, logits = gumbel_softmax_sample(logits, temperature)
+    y, logits = gumbel_softmax_sample(logits, temperature, noise=noise)
     if hard:
         shape = y.size()
         _, ind = y.max(dim=-1)
         y_hard = torch.zeros_like(y).view(-1, shape[-1])
         y_hard.scatter_(1, ind.view(-1, 1), 1)
-        if params.use_cuda and torch.cuda.is_available():
-            y_hard = y_hard.cuda()
         y_hard = y_hard.view(*shape)
         y = (y_hard - y).detach() + y
     return y, logits
+
+
+class GumbelSampler(object):
+    """Gumbel-softmax sampler with its own random stream.
+
+    draw() takes the noise for every turn of a batch in one call, and each
+    call of the sampler then uses the next turn's slice. Without a matching
+    draw() the noise is taken per call from the same stream. The stream is
+    seeded with the gumbel_seed of config, or with the torch seed of the process
+    when that is None, and has one generator per device.
+    """
+    def __init__(self, seed=None, eps=1e-20, config=params):
+        self.seed = seed
+        self.eps = eps
+        self.config = config
+        self._generators = {}
+        self._noise = None
+        self._turn = 0
+
+    def manual_seed(self, seed):
+        self.seed = seed
+        self._generators = {}
+        self._noise = None
+
+    def generator(self, device):
+        device = torch.device(device)
+        key = str(device)
+        if key not in self._generators:
+            seed = self.seed
+            if seed is None:
+                seed = self.config.gumbel_seed
+            if seed is None:
+                seed = torch.initial_seed()
+            self._generators[key] = torch.Generator(
+                device=device).manual_seed(seed)
+        return self._generators[key]
+
+    def state_dict(self):
+        return {
+            'seed': self.seed,
+            'generators': {
+                key: generator.get_state()
+                for key, generator in self._generators.items()
+            }
+        }
+
+    def load_state_dict(self, state):
+        self.manual_seed(state['seed'])
+        for key, generator_state in state['generators'].items():
+            self.generator(key).set_state(generator_state)
+
+    @profiled("gumbel_sampling")
+    def draw(self, n_turns, batch_size, n_class, device):
+        """Gumbel noise for the next n_turns calls, [n_turns, batch, n_class]
+        """
+        self._noise = sample_gumbel((n_turns, batch_size, n_class),
+                                    self.eps,
+                                    device,
+                                    generator=self.generator(device))
+        self._turn = 0
+
+    def next_noise(self, logits):
+        noise = self._noise
+        if (noise is not None and self._turn < noise.size(0)
+                and noise.shape[1:] == logits.shape
+                and noise.device == logits.device):
+            self._turn += 1
+            return noise[self._turn - 1]
+        return sample_gumbel(logits.size(),
+                             self.eps,
+                             logits.device,
+                             generator=self.generator(logits.device))
+
+    @profiled("gumbel_sampling")
+    def __call__(self, logits, temperature, hard=False):
+        return gumbel_softmax(logits,
+                              temperature,
+                              hard=hard,
+                              noise=self.next_noise(logits))
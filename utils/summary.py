@@ -0,0 +1,102 @@
+import queue
+import sys
+from threading import Thread
+
+import torch
+from torch.utils.tensorboard import SummaryWriter
+
+import params
+
+_CLOSE = object()
+
+
+class AsyncSummaryWriter(object):
+    """TensorBoard writer that queues the events and writes them in batches
+    from a background thread, flushing once per batch.
+
+    The queue holds at most max_queue events. When it is full, scalars are
+    dropped (policy "drop", counted in self.dropped) or the caller waits
+    (policy "block"). Text, hparams and figures always wait. close() writes
+    out everything that is queued before closing the event files.
+    """
+    def __init__(self, log_dir, max_queue=None, policy=None, batch_size=256):
+        self.policy = policy or params.summary_queue_policy
+        assert self.policy in ("drop", "block")
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._writer = SummaryWriter(log_dir=log_dir)
+        self._queue = queue.Queue(max_queue or params.summary_queue_size)
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item, droppable=False):
+        if droppable and self.policy == "drop":
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+        else:
+            self._queue.put(item)
+
+    def add_scalar(self, tag, scalar_value, global_step=None):
+        self._put(("add_scalar", (tag, scalar_value, global_step), {}),
+                  droppable=True)
+
+    def add_scalars(self, main_tag, tag_scalar_dict, global_step=None):
+        # written as main_tag/tag scalars, SummaryWriter.add_scalars would
+        # open one event file per tag
+        for tag, value in tag_scalar_dict.items():
+            self.add_scalar(main_tag + "/" + tag, value, global_step)
+
+    def add_text(self, *args, **kwargs):
+        self._put(("add_text", args, kwargs))
+
+    def add_hparams(self, *args, **kwargs):
+        self._put(("add_hparams", args, kwargs))
+
+    def add_figure(self, *args, **kwargs):
+        self._put(("add_figure", args, kwargs))
+
+    def _write(self, item):
+        name, args, kwargs = item
+        if name == "add_scalar" and torch.is_tensor(args[1]):
+            args = (args[0], args[1].item(), args[2])
+        try:
+            getattr(self._writer, name)(*args, **kwargs)
+        except Exception as e:  # keep the thread alive for close()
+            print("AsyncSummaryWriter: %s failed: %s" % (name, e))
+            sys.stdout.flush()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = False
+            for item in batch:
+                if item is _CLOSE:
+                    closing = True
+                else:
+                    self._write(item)
+            self._writer.flush()
+            for _ in batch:
+                self._queue.task_done()
+            if closing:
+                return
+
+    def flush(self):
+        """Wait until everything queued so far is written."""
+        self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_CLOSE)
+            self._thread.join()
+        self._writer.close()
+        if self.dropped:
+            print("AsyncSummaryWriter dropped %d scalars" % self.dropped)
+            sys.stdout.flush()
@@ -0,0 +1,39 @@
+import torch
+
+
+class Workspace(object):
+    """Constant scratch tensors (zero states, the all-ones first prev_z, the
+    empty context of the first turn) cached by shape, value, dtype and
+    device, so the per-turn and per-token loops stop allocating them and
+    moving them to the GPU on every call.
+
+    The tensors are shared between calls: never write to them in place.
+    allocations and requests count the tensors built and asked for.
+    """
+    def __init__(self):
+        self._buffers = {}
+        self.allocations = 0
+        self.requests = 0
+
+    def full(self, shape, fill_value, device, dtype=torch.float32):
+        self.requests += 1
+        key = (tuple(shape), fill_value, str(device), dtype)
+        buf = self._buffers.get(key)
+        if buf is None:
+            buf = torch.full(shape, fill_value, dtype=dtype, device=device)
+            self._buffers[key] = buf
+            self.allocations += 1
+        return buf
+
+    def zeros(self, shape, device, dtype=torch.float32):
+        return self.full(shape, 0., device, dtype=dtype)
+
+    def ones(self, shape, device, dtype=torch.float32):
+        return self.full(shape, 1., device, dtype=dtype)
+
+    def reset_counters(self):
+        self.allocations = 0
+        self.requests = 0
+
+    def clear(self):
+        self._buffers = {}